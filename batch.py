@@ -0,0 +1,73 @@
+import copy,json,argparse
+from datetime import datetime
+from pathlib import Path
+from common import *
+from feed_cache import parseSettings
+from selection import selectItems,writeResult,writeDuplicates,writeNames
+
+def variantConfig(Cfg, overrides):
+    # top level settings are replaced, settings of a supplier are merged with the base ones
+    cfg = copy.deepcopy(Cfg)
+    for key,val in overrides.items():
+        if key == 'suppliers':
+            for name,settings in val.items():
+                cfg['suppliers'][name] = dict(cfg['suppliers'].get(name, {}), **settings)
+        else:
+            cfg[key] = val
+    return cfg
+
+def variantFilename(fn, variant):
+    fn = Path(fn)
+    return fn.with_name(f'{fn.stem}_{variant}{fn.suffix}')
+
+def runBatch(Args, variantsFn, verbose):
+    # every datafeed is read once into raw rows, every variant parses them with its own supplier settings,
+    # selects items and writes its own output files, a supplier parsed with the same settings by several variants is parsed once
+    with open(variantsFn) as f:
+        Variants = json.load(f)
+    base = readConfig(Args, verbose)
+    # file names given on the command line get the variant name appended, the other settings come from the variant
+    vArgs = argparse.Namespace(**dict(vars(Args), output=None, duplicates=None, names=None, delta=None, store=None, fetch=False))
+    Raw = {}        # datafeed, columns, encodings : (RawFeed, encoding)
+    Parsed = {}     # parse settings of all files of a supplier : (items, encodings of the files)
+    for variant,overrides in Variants.items():
+        t0 = datetime.utcnow()
+        cfg = variantConfig(base, overrides)
+        for key,arg in ((fOutputFilename,Args.output), (fDuplicatesFilename,Args.duplicates), (fAllNamesFilename,Args.names)):
+            fn = arg if arg is not None else cfg.get(key)
+            if key not in overrides and (fn is not None or key == fOutputFilename):
+                cfg[key] = variantFilename(fn or 'results.csv', variant)
+        Cfg,Suppliers = prepareInputs(vArgs, verbose, cfg)
+        encodings = Cfg['encodings']
+        Items = {}
+        output_encoding = OutputEncoding(verbose)
+        for name,supp in Suppliers.items():
+            parts = supplierParts(supp)
+            key = json.dumps([[str(p.data), parseSettings(p)] for p in parts] + [supp.merge_parts, list(encodings)], sort_keys=True, default=str)
+            if key not in Parsed:
+                loaded = []
+                for part in parts:
+                    rawKey = json.dumps([str(part.data), part.columns, list(encodings)], sort_keys=True, default=str)
+                    if rawKey not in Raw:
+                        Raw[rawKey] = readRawFeed(part, encodings, verbose)
+                    raw,encoding = Raw[rawKey]
+                    if raw is not None:
+                        loaded.append((parseRawFeed(part, raw, encoding, verbose), encoding))
+                itms = [i for i,_ in loaded]
+                if len(itms) > 1:
+                    itms = [mergeParts(name, itms, supp.merge_parts, verbose)]
+                Parsed[key] = (itms[0] if itms else None, [e for _,e in loaded])
+            else:
+                verbose(f'variant {variant} : {name} items parsed with the same settings by an earlier variant')
+            itms,encs = Parsed[key]
+            if itms is not None:
+                Items[name] = itms
+                for e in encs:
+                    output_encoding.add(name, e)
+        SelectedItems,Offers = selectItems(Items, verbose, Cfg['top_k'], Cfg['availability_weight'])
+        writeResult(SelectedItems, Path(Cfg[fOutputFilename]), output_encoding.value, Cfg['output_format'])
+        if Cfg.get(fDuplicatesFilename) is not None:
+            writeDuplicates(Offers, Cfg[fDuplicatesFilename], output_encoding.value, Cfg['output_format'])
+        if Cfg.get(fAllNamesFilename) is not None:
+            writeNames(Items, Cfg[fAllNamesFilename], output_encoding.value, Cfg['output_format'])
+        verbose(f'variant {variant} : {len(SelectedItems)} selected items written to {Cfg[fOutputFilename]} time {datetime.utcnow()-t0}')
@@ -0,0 +1,158 @@
+import sys,argparse,json,random,time,tracemalloc,platform
+from datetime import datetime
+from pathlib import Path
+from common import prepareInputs,LoadItems
+from selection import selectItems,writeResult,writeDuplicates,writeNames
+
+# synthetic datafeeds modeled on the suppliers from config.json
+AVAILABILITY = ['0','1','2','5','10','20','>10','<5','B','CALL','3-']
+WEIGHTS = ['','0.5','1.5','2','3','4.2','5','7','12.5']
+DESCRIPTIONS = ['Motherboard','Graphics Card','Router','Power Supply','Gerät','Câble réseau','Straße Adapter']
+
+def skuVariant(rnd, sku):
+    # the same product is spelled differently by every supplier
+    r = rnd.random()
+    if r < 0.3: return sku.replace(' ','-')
+    if r < 0.5: return sku.lower()
+    return sku
+
+def makeSkus(rnd, rows, overlap):
+    # every supplier gets `overlap` share of its rows from a pool common to all suppliers
+    shared = [f'PRIME B{i:06d}M-K' for i in range(int(rows*overlap))]
+    def pick(prefix):
+        own = [f'{prefix} {i:06d}-X' for i in range(rows - len(shared))]
+        skus = shared + own
+        rnd.shuffle(skus)
+        return skus
+    return pick
+
+def price(rnd):
+    return f'{rnd.uniform(1,2500):.2f}' if rnd.random() > 0.02 else rnd.choice(['','0','n/a'])
+
+def generateLeader(fn, rnd, skus, encoding):
+    with open(fn,'w',encoding=encoding,errors='replace') as f:
+        f.write('"MANUFACTURER SKU","DESCRIPTION","DBP","RRP","AT","weight","BAR CODE","CATEGORY"\n')
+        for sku in skus:
+            f.write(f'"{skuVariant(rnd,sku)}","{rnd.choice(DESCRIPTIONS)}","{price(rnd)}","{rnd.uniform(1,3000):.2f}",'
+                    f'"{rnd.choice(AVAILABILITY)}","{rnd.choice(WEIGHTS)}","{rnd.randint(10**11,10**12)}","Components"\n')
+
+def generateSynnex(fn, rnd, skus, encoding):
+    extra = [f'COL_{i}' for i in range(20)]
+    with open(fn,'w',encoding=encoding,errors='replace') as f:
+        f.write('\t'.join(['SUPPLIER_PART_NUMBER','DESCRIPTION','RESELLER_BUY_EX','AVAILABILITY_M','AVAILABILITY_S','weight','UPC'] + extra) + '\n')
+        for sku in skus:
+            f.write('\t'.join([skuVariant(rnd,sku), rnd.choice(DESCRIPTIONS), price(rnd), rnd.choice(AVAILABILITY), rnd.choice(AVAILABILITY),
+                               rnd.choice(WEIGHTS), str(rnd.randint(10**11,10**12))] + ['x']*len(extra)) + '\n')
+
+def generateIngram(fn, rnd, skus, encoding):
+    extra = [f'Field {i}' for i in range(30)]
+    with open(fn,'w',encoding=encoding,errors='replace') as f:
+        f.write('\t'.join(['Vendor Part Number','Vendor Name','Customer Price','Available Quantity','weight','EANUPC Code'] + extra) + '\n')
+        for sku in skus:
+            f.write('\t'.join([skuVariant(rnd,sku), rnd.choice(DESCRIPTIONS), price(rnd), rnd.choice(AVAILABILITY),
+                               rnd.choice(WEIGHTS), str(rnd.randint(10**11,10**12))] + ['y']*len(extra)) + '\n')
+
+def generateFeeds(directory, rows, overlap, mixedEncodings=True, seed=1):
+    directory.mkdir(parents=True, exist_ok=True)
+    rnd = random.Random(seed)
+    pick = makeSkus(rnd, rows, overlap)
+    encodings = ('cp1252','utf-8','ISO-8859-1') if mixedEncodings else ('utf-8','utf-8','utf-8')
+    generateLeader(directory/'LNR45_bench.csv', rnd, pick('LNR'), encodings[0])
+    generateSynnex(directory/'LNRGAMING_synnex_au.txt', rnd, pick('SYN'), encodings[1])
+    generateIngram(directory/'294280.TXT', rnd, pick('ING'), encodings[2])
+    return 3*rows
+
+def runStage(name, fcn, rows, repeat, Results):
+    # timing runs without tracemalloc, peak memory measured by a separate traced run
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fcn()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    fcn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    seconds = min(times)
+    Results[name] = {'seconds' : seconds, 'rows' : rows, 'rows_per_second' : rows/seconds if seconds > 0 else None, 'peak_mb' : peak/2**20}
+    print(f'{name:16} {seconds:8.3f} s {Results[name]["rows_per_second"] or 0:12.0f} rows/s peak {peak/2**20:8.1f} MB')
+    return result
+
+def compareWithBaseline(Results, baseline, tolerance):
+    regressions = []
+    for name,stage in Results.items():
+        if name not in baseline: continue
+        for metric in ('seconds','peak_mb'):
+            old,new = baseline[name][metric], stage[metric]
+            if old and new > old * (1+tolerance):
+                regressions.append(f'{name} {metric} {old:.3f} -> {new:.3f} (+{100*(new/old-1):.0f}%)')
+    return regressions
+
+def main(Args):
+    directory = Args.dir
+    if not Args.keep or not any(directory.glob('*')):
+        t0 = time.perf_counter()
+        feedRows = generateFeeds(directory, Args.rows, Args.overlap, not Args.utf8, Args.seed)
+        print(f'generated {feedRows} rows in {directory} time {time.perf_counter()-t0:.1f} s')
+    Args.output = directory/'results.csv'
+    Args.no_cache = True
+    Cfg,Suppliers = prepareInputs(Args, lambda txt: None)
+    feedRows = 0
+    for supp in Suppliers.values():
+        for fn in supp.parts:
+            with open(fn,'rb') as f:
+                feedRows += sum(1 for _ in f) - 1
+    quiet = lambda txt: None
+    Results = {}
+    Items,encoding = runStage('LoadItems', lambda: LoadItems(Suppliers, Cfg['encodings'], quiet, Cfg['parallel_loading'], Cfg['loading_workers']),
+                              feedRows, Args.repeat, Results)
+    offers = sum(len(items) for items in Items.values())
+    SelectedItems,Offers = runStage('selectItems', lambda: selectItems(Items, quiet, Cfg['top_k'], Cfg['availability_weight']), offers, Args.repeat, Results)
+    runStage('writeResult', lambda: writeResult(SelectedItems, directory/'results.csv', encoding), len(SelectedItems), Args.repeat, Results)
+    runStage('writeDuplicates', lambda: writeDuplicates(Offers, directory/'duplicates.csv', encoding), sum(len(o)-1 for o in Offers.values()), Args.repeat, Results)
+    runStage('writeNames', lambda: writeNames(Items, directory/'names.csv', encoding), offers, Args.repeat, Results)
+
+    report = {
+        'timestamp' : datetime.now().isoformat(timespec='seconds'),
+        'python'    : platform.python_version(),
+        'params'    : {'rows' : Args.rows, 'overlap' : Args.overlap, 'mixed_encodings' : not Args.utf8, 'engine' : Cfg['ingest_engine'], 'parallel' : Cfg['parallel_loading']},
+        'stages'    : Results,
+    }
+    with open(Args.out,'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'results saved to {Args.out}')
+    if Args.save_baseline:
+        with open(Args.baseline,'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'baseline saved to {Args.baseline}')
+    elif Args.baseline.exists():
+        with open(Args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['params'] != report['params']:
+            print(f'baseline parameters differ: {baseline["params"]}')
+        regressions = compareWithBaseline(Results, baseline['stages'], Args.tolerance)
+        for r in regressions:
+            print(f'REGRESSION {r}')
+        if regressions:
+            return 1
+        print('no regressions against baseline')
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark datafeed loading, selection and writers on synthetic datafeeds")
+    parser.add_argument("-dir",type=Path,default=Path('bench_data'),help="directory for generated datafeeds")
+    parser.add_argument("-cfg",type=Path,default=Path(__file__).parent/'config.json',help="config file path and name")
+    parser.add_argument("-rows",type=int,default=100000,help="rows per supplier datafeed")
+    parser.add_argument("-overlap",type=float,default=0.3,help="share of skus offered by all suppliers")
+    parser.add_argument("-utf8",action='store_true',help="write all datafeeds in utf-8 instead of mixed encodings")
+    parser.add_argument("-seed",type=int,default=1,help="random seed of the generator")
+    parser.add_argument("-keep",action='store_true',help="reuse datafeeds already present in -dir")
+    parser.add_argument("-repeat",type=int,default=3,help="timing runs per stage, the fastest one is reported")
+    parser.add_argument("-out",type=Path,default=Path('bench_results.json'),help="results file")
+    parser.add_argument("-baseline",type=Path,default=Path('bench_baseline.json'),help="baseline results to compare with")
+    parser.add_argument("-save_baseline",action='store_true',help="store results as the new baseline")
+    parser.add_argument("-tolerance",type=float,default=0.2,help="allowed slowdown or memory growth against baseline")
+    parser.add_argument("-engine",choices=['rows','columnar'],help="datafeed parsing engine")
+    parser.add_argument("-parallel","-p",action='store_true',help="load supplier datafeeds in parallel worker processes")
+    parser.add_argument("-workers",type=int,help="number of worker processes used by -parallel")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,280 @@
+import csv,re,locale
+from math import inf
+from datetime import datetime
+from itertools import repeat
+from operator import itemgetter
+try:
+    import numpy as np
+    strings = np.strings if hasattr(np, 'strings') else np.char
+except ImportError:
+    np = None
+from common import Item, sharedLayout, detectSeparator, readTitles, readAvailability, verboseLoadSummary, classifyShortRow, \
+                   isByteSplittable, decodesWhole
+
+# status of availability values
+AVAIL_OK, AVAIL_INVALID, AVAIL_ERROR = 0, 1, 2
+
+EDGE_SPACE = re.compile(r'^[^\S\n]|[^\S\n]$', re.M)
+
+def textColumn(col, enc, clean=True):
+    # str values of a column read either as line end separated bytes or as csv fields,
+    # cleaned the same as getAt without replacement
+    if isinstance(col, bytes):
+        text = col.decode(enc)
+        values = text.split('\n')[:-1]
+        if not clean or EDGE_SPACE.search(text) is None:
+            return values     # quotes are already dropped
+    else:
+        values = col
+        if not clean:
+            return values
+    return [v.replace('"','').strip() for v in values]
+
+def takeValues(values, take):
+    return np.array(values, dtype=object)[take].tolist()
+
+def toFloat(v):
+    # None for values replaced with null and values that are not numbers
+    if v is None:
+        return None
+    try:
+        return float(v)
+    except ValueError:
+        return None
+
+def toFloats(col, enc, replacement):
+    # float values of a column and a mask of valid ones, plain decimal numbers are converted by numpy,
+    # anything else - empty, padded, replaced, nan, digits outside of ascii - by getAt and float() once per distinct value
+    if isinstance(col, bytes):
+        fields = col.split(b'\n')[:-1]
+        raw = np.array(fields, dtype=bytes)
+    else:
+        fields = col
+        raw = strings.encode(np.asarray(col, dtype=str), 'ascii', 'replace')
+    unsigned = strings.lstrip(raw, b'+-')
+    plain = strings.isdigit(strings.replace(unsigned, b'.', b'', 1)) & (strings.str_len(raw) - strings.str_len(unsigned) <= 1)
+    if replacement:
+        plain &= ~np.isin(raw, [k.encode() for k in replacement if k.isascii()])
+    values = np.zeros(len(raw), dtype=float)
+    valid = plain.copy()
+    values[plain] = raw[plain].astype(float)
+    other = np.flatnonzero(~plain).tolist()
+    if other:
+        conv = {}
+        for i in other:
+            v = fields[i]
+            if v not in conv:
+                s = (v.decode(enc) if isinstance(v, bytes) else v).replace('"','').strip()
+                conv[v] = toFloat(replacement.get(s, s))
+        converted = [conv[fields[i]] for i in other]
+        values[other] = [0.0 if f is None else f for f in converted]
+        valid[other] = [f is not None for f in converted]
+    return values,valid
+
+def translateColumn(skus, supplier_def):
+    # translateSku of the joined column, the same as per value for ascii skus without line breaks
+    joined = '\n'.join(skus)
+    if not joined.isascii() or joined.count('\n') != len(skus)-1 or '\n' in supplier_def.sku_chars_to_remove:
+        return [supplier_def.translateSku(v) for v in skus]
+    return supplier_def.translateSku(joined).split('\n')
+
+def readAvailabilityColumns(availCols, availreplacement):
+    # availability columns have few distinct values, readAvailability runs once per distinct combination
+    parts = []
+    codes = None
+    for col in availCols:
+        u,inv = np.unique(np.asarray(col, dtype=str), return_inverse=True)
+        u = u.tolist()
+        parts.append(u)
+        inv = inv.reshape(-1)
+        codes = inv if codes is None else codes * len(u) + inv
+    ucodes,inverse = np.unique(codes, return_inverse=True)
+    status = []
+    availabilities = []
+    ranges = []
+    for c in ucodes.tolist():
+        vals = []
+        for u in reversed(parts):
+            c,i = divmod(c, len(u))
+            vals.append(u[i])
+        vals.reverse()
+        try:
+            availability,avr = readAvailability(vals, range(len(vals)), availreplacement)
+            status.append(AVAIL_OK)
+        except IndexError:
+            availability,avr = None,(0,0)
+            status.append(AVAIL_INVALID)
+        except ValueError:
+            availability,avr = None,(0,0)
+            status.append(AVAIL_ERROR)
+        availabilities.append(availability)
+        ranges.append(avr)
+    inverse = inverse.reshape(-1)
+    upper = np.array([r[1] for r in ranges], dtype=np.int64)
+    return np.array(status, dtype=np.int8)[inverse], upper[inverse], availabilities, ranges, inverse
+
+NL, QUOTE = ord('\n'), ord('"')
+
+def splitBytes(data, sep):
+    # field ends of a feed csv.reader splits on every separator, quotes enclose whole fields only and never a separator
+    # nor a line break, returns (bytes array, positions of separators and line ends, index of the line end of every line)
+    # or None when csv.reader is needed
+    if data.find(b'\x00') >= 0:
+        return None
+    if data.find(b'\r') >= 0:
+        if re.search(rb'\r(?!\n)', data) is not None:
+            return None
+        data = data.replace(b'\r\n', b'\n')
+    if not data.endswith(b'\n'):
+        data += b'\n'
+    buf = np.frombuffer(data, dtype=np.uint8)
+    sepByte = ord(sep)
+    delims = np.flatnonzero((buf == sepByte) | (buf == NL))
+    quotes = np.flatnonzero(buf == QUOTE)
+    if len(quotes):
+        if len(quotes) % 2:
+            return None
+        # the byte before the first one is the last line end
+        before,after = buf[quotes[0::2]-1],buf[quotes[1::2]+1]
+        if not (((before == sepByte) | (before == NL)).all() and ((after == sepByte) | (after == NL)).all()):
+            return None
+        if (np.searchsorted(quotes, delims) % 2).any():
+            return None
+    return buf, delims, np.flatnonzero(buf[delims] == NL)
+
+def columnBytes(buf, starts, ends):
+    # fields buf[start:end] each followed by a line end, quotes around fields dropped like csv.reader does
+    lens = ends - starts + 1
+    offsets = np.cumsum(lens) - lens
+    picked = buf[np.arange(int(lens.sum())) + np.repeat(starts - offsets, lens)]
+    picked[offsets+lens-1] = NL
+    return picked.tobytes().replace(b'"', b'')
+
+def readColumnsBytes(filename, enc, sep, needed, maxIdx, blockSize=1<<20):
+    # used columns of rows long enough split on raw bytes, returns (columns as line end separated bytes, short rows, rows)
+    # or None, the file is split in blocks of whole lines to keep positions of separators small
+    parts = [[] for _ in needed]
+    shortRows = []
+    rows = 0
+    with open(filename,'rb') as f:
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                break
+            split = splitBytes(block + f.readline(), sep)
+            if split is None:
+                return None
+            buf,delims,lineEnds = split
+            firsts = np.concatenate(([0], lineEnds[:-1]+1))
+            lineStarts = np.concatenate(([0], delims[lineEnds[:-1]]+1))
+            fields = lineEnds - firsts + 1
+            title = 1 if rows == 0 else 0
+            long = np.flatnonzero(fields > maxIdx)
+            long = long[long >= title]
+            for part,idx in zip(parts, needed):
+                ends = delims[firsts[long]+idx]
+                starts = delims[firsts[long]+idx-1]+1 if idx > 0 else lineStarts[long]
+                part.append(columnBytes(buf, starts, ends))
+            for l in np.flatnonzero(fields <= maxIdx).tolist():
+                if l >= title:
+                    line = buf[lineStarts[l]:delims[lineEnds[l]]].tobytes().decode(enc)
+                    shortRows.append(next(csv.reader([line], delimiter=sep), []))
+            rows += len(lineEnds)
+    return [b''.join(part) for part in parts], shortRows, rows-1
+
+def readColumnsCsv(reader, needed, maxIdx):
+    # same as readColumnsBytes with columns as lists of fields, for feeds csv.reader has to split
+    getter = itemgetter(*needed)
+    cells = []
+    shortRows = []
+    for row in reader:
+        if len(row) > maxIdx:
+            cells.append(getter(row))
+        else:
+            shortRows.append(row)
+    cols = [list(col) for col in zip(*cells)] if cells else [[] for _ in needed]
+    return cols, shortRows, reader.line_num - 1
+
+def loadItemsColumnar(supplier_def, encoding, verbose, stats=None):
+    replacement = supplier_def.replace
+    priceReplacement = replacement['price'] if 'price' in replacement else {}
+    availreplacement = replacement['availability'] if 'availability' in replacement else {}
+    weightReplacement = replacement['weight'] if 'weight' in replacement else {}
+    t0 = datetime.utcnow()
+
+    filename = supplier_def.data
+    enc = encoding or locale.getpreferredencoding(False)
+    with open(filename, encoding=encoding) as csvfile:
+        sep = detectSeparator(csvfile.readline())
+        csvfile.seek(0)
+        reader = csv.reader(csvfile, delimiter=sep)
+        titles = readTitles(next(reader), supplier_def.columns, verbose)
+        if titles is None:
+            return None
+        skuIdx,priceIdx,availabilityIdx,weightIdx,optionalColumns = titles
+        optIdx = [idx for idx in optionalColumns.values() if idx is not None]
+        needed = [skuIdx, priceIdx, weightIdx] + availabilityIdx + optIdx
+        maxIdx = max(needed)
+        read = None
+        if isByteSplittable(enc) and decodesWhole(filename, encoding):
+            read = readColumnsBytes(filename, enc, sep, needed, maxIdx)
+        if read is None:
+            read = readColumnsCsv(reader, needed, maxIdx)
+    cols,shortRows,rows = read
+
+    skipped = {'invalid' : 0, 'out_of_stock' : 0, 'sku' : 0, 'price' : 0}
+    for row in shortRows:
+        reason = classifyShortRow(row, titles, availreplacement, supplier_def.include_out_of_stock_items)
+        if reason is not None:
+            skipped[reason] += 1
+
+    Items = {}
+    if cols[0]:
+        nAvail = len(availabilityIdx)
+        availCols = [textColumn(c, enc, clean=False) for c in cols[3:3+nAvail]]
+        status,upper,availabilities,ranges,ainv = readAvailabilityColumns(availCols, availreplacement)
+        skipped['invalid'] += int(np.count_nonzero(status==AVAIL_INVALID))
+        errors = np.flatnonzero(status==AVAIL_ERROR).tolist()
+        if errors:
+            texts = [textColumn(c, enc, clean=False) for c in cols]
+            for i in errors:
+                print('ValueError ', [t[i] for t in texts])
+        keep = status==AVAIL_OK
+        if not supplier_def.include_out_of_stock_items:
+            outOfStock = keep & (upper <= 0)
+            skipped['out_of_stock'] += int(np.count_nonzero(outOfStock))
+            keep &= ~outOfStock
+
+        skus = textColumn(cols[0], enc)
+        emptySku = ~np.fromiter(map(bool, skus), dtype=bool, count=len(skus))
+        skipped['sku'] += int(np.count_nonzero(keep & emptySku))
+        keep &= ~emptySku
+
+        prices,validPrice = toFloats(cols[1], enc, priceReplacement)
+        if not supplier_def.include_0_priced_items:
+            validPrice &= prices != 0
+        skipped['price'] += int(np.count_nonzero(keep & ~validPrice))
+        keep &= validPrice
+        take = np.flatnonzero(keep)
+        prices = prices[take]
+
+        weights,validWeight = toFloats(cols[2], enc, weightReplacement)
+        # nan stands for missing weight in the batch rule, a literal nan weight is outside of every range like inf
+        weights = np.where(validWeight, np.where(np.isnan(weights), inf, weights), np.nan)[take]
+        totals = (prices + supplier_def.shippingBatch(prices, weights)).tolist()
+        prices = prices.tolist()
+        optValues = []
+        colIt = iter(cols[3+nAvail:])
+        for i in optionalColumns.values():
+            optValues.append(['']*len(take) if i is None else takeValues(textColumn(next(colIt), enc), take))
+        values = zip(*optValues) if optValues else repeat(())
+        ainv = ainv[take]
+        skus = takeValues(skus, take)
+        items = map(tuple.__new__, repeat(Item), zip(repeat(supplier_def.name), skus, prices, totals,
+                    takeValues([r[0] for r in ranges], ainv), takeValues([r[1] for r in ranges], ainv),
+                    takeValues(availabilities, ainv), repeat(sharedLayout(optionalColumns.keys())), values))
+        Items = dict(zip(translateColumn(skus, supplier_def), items))
+
+    verboseLoadSummary(verbose, supplier_def.data, sep, encoding, len(Items), t0,
+                       skipped['price'], skipped['sku'], skipped['out_of_stock'], skipped['invalid'], titles, rows, stats)
+    return Items
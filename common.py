@@ -1,13 +1,81 @@
-import sys,re,json,csv
+import os,io,sys,re,json,csv,copy,codecs,locale,mmap,threading,tracemalloc,multiprocessing
+from pathlib import Path
+from bisect import bisect_left
 from collections import namedtuple
+from queue import Queue, Empty
+from itertools import islice, chain, groupby
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from feed_cache import FeedCache
+from metrics import measure
+from fetcher import fetchTarget
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 fOutputFilename = 'output_filename'
 fDuplicatesFilename = 'duplicates_filename'
 fAllNamesFilename = 'all_skus_filename'
+fSnapshotFilename = 'snapshot_filename'
+fChangesFilename = 'changes_filename'
+fMetricsFilename = 'metrics_filename'
+
+class Item(namedtuple('Item', ['supplier','sku', 'price','tot_cost','avail_lo','avail_hi','orig_availability','layout','values'])):
+    # compact offer record, names of optional columns (layout) are a tuple shared by all offers of a supplier
+    __slots__ = ()
+    @property
+    def availability(self):
+        return (self.avail_lo, self.avail_hi)
+    @property
+    def optionalColumns(self):
+        return dict(zip(self.layout, self.values))
+
+_layouts = {}
+def sharedLayout(names):
+    names = tuple(names)
+    return _layouts.setdefault(names, names)
+
+# offer representation before Item was made compact, used by offerMemoryReport only
+LegacyItem = namedtuple('LegacyItem', ['supplier','sku', 'price','tot_cost','availability','orig_availability','optionalColumns'])
+
+def offerMemoryReport(Items, verbose, sample=20000):
+    offers = list(islice(chain.from_iterable(items.values() for items in Items.values()), sample))
+    if not offers:
+        return
+    def measure(build):
+        out = [None] * len(offers)
+        tracing = tracemalloc.is_tracing()
+        if not tracing: tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for i,o in enumerate(offers):
+            out[i] = build(o)
+        size = tracemalloc.get_traced_memory()[0] - before
+        if not tracing: tracemalloc.stop()
+        return size / len(offers)
+    legacy = measure(lambda o: LegacyItem(o.supplier, o.sku, o.price, o.tot_cost, (o.avail_lo,o.avail_hi), o.orig_availability, dict(zip(o.layout, o.values))))
+    compact = measure(lambda o: Item(o.supplier, o.sku, o.price, o.tot_cost, o.avail_lo, o.avail_hi, o.orig_availability, o.layout, tuple(list(o.values))))
+    verbose(f'offer record size (strings and numbers shared by both excluded), {len(offers)} offers sampled:')
+    verbose(f'\tbefore {legacy:.0f} bytes per offer, after {compact:.0f} bytes per offer')
 
 class Supplier:
-    pass
+    # closures are not picklable, rebuild them when sent to a worker process
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('shipping', None)
+        state.pop('shippingBatch', None)
+        state.pop('translateSku', None)
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.setShippingRules(self.shipping_rules)
+        self.translateSku = makeTranslateSku(self.sku_chars_to_remove, self.sku_ignore_case)
+    def setShippingRules(self, rules):
+        table = compileShippingCostRules(rules)
+        self.shipping_rules = rules
+        self.shipping = makeShippingCostRule(table)
+        self.shippingBatch = makeBatchShippingCostRule(table)
 
 def readConfig(Args, verbose):
     if Args.cfg is not None:
@@ -20,16 +88,12 @@ def readConfig(Args, verbose):
             verbose('config file corrupted, reverting to defaults')
     return None
 
-def makeShippingCostRule(Rules,parseRange):
-    def calcShippingCost(price,weight):
-        if free_above_price is not None and price > free_above_price:
-            return 0
-        if na_price is not None and weight is None:
-            return na_price
+ShippingCostTable = namedtuple('ShippingCostTable', ['free_above_price','na_price','points','pointCosts','gapCosts'])
+
+def makeShippingCostTable(Rules,parseRange):
+    def scan(weight):
         for r in Ranges:
             if weight >= r[0] and weight <=r[1]: return r[2] + per_product_price
-        if per_product_price is None:
-            print('invalid shippng cost rules',price, weight)
         return per_product_price
     Ranges = []
     free_above_price = None
@@ -51,10 +115,68 @@ def makeShippingCostRule(Rules,parseRange):
         if k=='per_product':
             per_product_price = float(v)
     Ranges = sorted(Ranges)
+    # cost is constant at every range boundary and between two neighbouring boundaries,
+    # evaluate the sorted ranges once for each of these instead of for every item
+    points = sorted({r[0] for r in Ranges} | {r[1] for r in Ranges})
+    pointCosts = [scan(p) for p in points]
+    gaps = [points[0]-1] if points else [0]
+    gaps += [(a+b)/2 for a,b in zip(points, points[1:])]
+    if points: gaps.append(points[-1]+1)
+    gapCosts = [scan(g) for g in gaps]
+    return ShippingCostTable(free_above_price, na_price, points, pointCosts, gapCosts)
+
+class ShippingRuleError(ValueError):
+    pass
+
+# raised by the scalar and the batch rule alike
+MISSING_WEIGHT = 'item without weight and no "NA" shipping rule'
+
+def makeShippingCostRule(Table):
+    free_above_price,na_price,points,pointCosts,gapCosts = Table
+    def calcShippingCost(price,weight):
+        if free_above_price is not None and price > free_above_price:
+            return 0
+        if weight is None:
+            if na_price is None:
+                raise ShippingRuleError(MISSING_WEIGHT)
+            return na_price
+        if weight != weight:    # nan is outside of every range
+            return gapCosts[-1]
+        i = bisect_left(points, weight)
+        if i < len(points) and points[i] == weight:
+            return pointCosts[i]
+        return gapCosts[i]
     return calcShippingCost
 
-def loadShippingCostRules(ShippingRules):
-    if ShippingRules is None:   return lambda x: 0
+def makeBatchShippingCostRule(Table):
+    # prices and weights are sequences of equal length, missing weight is None or nan
+    free_above_price,na_price,points,pointCosts,gapCosts = Table
+    def calcShippingCostBatch(prices,weights):
+        p = np.asarray(prices, dtype=float)
+        w = np.asarray(weights, dtype=float)
+        free = p > free_above_price if free_above_price is not None else np.zeros(len(p), dtype=bool)
+        missing = np.isnan(w)
+        if na_price is None and np.any(missing & ~free):
+            raise ShippingRuleError(MISSING_WEIGHT)
+        i = np.searchsorted(pts, np.where(missing, 0, w), side='left')
+        exact = (i < len(points)) & (pts[np.minimum(i, len(points)-1)] == w) if points else np.zeros(len(w), dtype=bool)
+        cost = np.where(exact, ptc[np.minimum(i, len(points)-1)] if points else 0, gpc[i])
+        if na_price is not None:
+            cost[missing] = na_price
+        cost[free] = 0
+        return cost
+    def calcShippingCostBatchNoNumpy(prices,weights):
+        return [calcShippingCost(price, None if weight is None or weight != weight else weight) for price,weight in zip(prices,weights)]
+    if np is None:
+        calcShippingCost = makeShippingCostRule(Table)
+        return calcShippingCostBatchNoNumpy
+    pts = np.array(points, dtype=float)
+    ptc = np.array(pointCosts, dtype=float)
+    gpc = np.array(gapCosts, dtype=float)
+    return calcShippingCostBatch
+
+def compileShippingCostRules(ShippingRules):
+    if ShippingRules is None:   ShippingRules = {'NA' : 0}
     def parseRange(string):
         m = x1.match(string)
         if m is not None:
@@ -67,7 +189,13 @@ def loadShippingCostRules(ShippingRules):
         return None,None
     x1 = re.compile('(\d+.*\d*)-(\d+.*\d*)kg')
     x2 = re.compile('>(\d+.*\d*)(kg|\$)')
-    return makeShippingCostRule(ShippingRules, parseRange)
+    return makeShippingCostTable(ShippingRules, parseRange)
+
+def loadShippingCostRules(ShippingRules):
+    return makeShippingCostRule(compileShippingCostRules(ShippingRules))
+
+def loadBatchShippingCostRules(ShippingRules):
+    return makeBatchShippingCostRule(compileShippingCostRules(ShippingRules))
 
 def makeTranslateSku(charsToRemove,ignoreCase):
     tt = str.maketrans( {c:None for c in charsToRemove} )
@@ -78,8 +206,20 @@ def makeTranslateSku(charsToRemove,ignoreCase):
         return skut
     return translateSku
 
-def prepareInputs(Args,verbose):
-    Cfg = readConfig(Args,verbose)
+def resolveDataFiles(directory, filename):
+    # a wildcard matches split or dated datafeeds, oldest first so the newest file is merged last
+    if '*' in filename:
+        return sorted(directory.glob(filename), key=lambda f: (f.stat().st_mtime_ns, f.name))
+    return [directory / filename]
+
+def resolveDataFile(directory, filename):
+    names = resolveDataFiles(directory, filename)
+    return names[-1] if names else None
+
+def prepareInputs(Args,verbose,Cfg=None):
+    # Cfg - already read config, e.g. a batch variant
+    if Cfg is None:
+        Cfg = readConfig(Args,verbose)
     if Args.output is not None:
         Cfg[fOutputFilename]=Args.output
     if fOutputFilename not in Cfg or Cfg[fOutputFilename] is None:
@@ -90,6 +230,23 @@ def prepareInputs(Args,verbose):
         Cfg[fDuplicatesFilename] = Args.duplicates 
     if hasattr(Args, "names") and Args.names is not None:
         Cfg[fAllNamesFilename] = Args.names
+    if hasattr(Args, "delta") and Args.delta is not None:
+        Cfg[fSnapshotFilename] = Args.delta
+    if fSnapshotFilename not in Cfg:
+        Cfg[fSnapshotFilename] = None
+    if hasattr(Args, "changes") and Args.changes is not None:
+        Cfg[fChangesFilename] = Args.changes
+    if fChangesFilename not in Cfg or Cfg[fChangesFilename] is None:
+        out = Path(Cfg[fOutputFilename])
+        Cfg[fChangesFilename] = out.with_name(out.stem + '_changes' + out.suffix)
+    if hasattr(Args, "metrics") and Args.metrics is not None:
+        Cfg[fMetricsFilename] = Args.metrics
+    if fMetricsFilename not in Cfg:
+        Cfg[fMetricsFilename] = None
+    if hasattr(Args, "format") and Args.format is not None:
+        Cfg['output_format'] = Args.format
+    if 'output_format' not in Cfg or Cfg['output_format'] is None:
+        Cfg['output_format'] = 'csv'
     if "include_0_priced_items" not in Cfg or Cfg["include_0_priced_items"] is None:
         Cfg["include_0_priced_items"] = False
     if 'replace' not in Cfg or Cfg['replace'] is None:
@@ -100,28 +257,100 @@ def prepareInputs(Args,verbose):
         Cfg['encodings'] = (None, "utf-8", "cp1252", "ISO-8859-1")
     if 'include_out_of_stock_items' not in Cfg or Cfg['include_out_of_stock_items'] is None:
         Cfg['include_out_of_stock_items'] = False
+    if hasattr(Args, "parallel") and Args.parallel:
+        Cfg['parallel_loading'] = True
+    if 'parallel_loading' not in Cfg or Cfg['parallel_loading'] is None:
+        Cfg['parallel_loading'] = False
+    if hasattr(Args, "workers") and Args.workers is not None:
+        Cfg['loading_workers'] = Args.workers
+    if 'loading_workers' not in Cfg:
+        Cfg['loading_workers'] = None
+    if hasattr(Args, "engine") and Args.engine is not None:
+        Cfg['ingest_engine'] = Args.engine
+    if 'ingest_engine' not in Cfg or Cfg['ingest_engine'] is None:
+        Cfg['ingest_engine'] = 'rows'
+    if hasattr(Args, "watch_interval") and Args.watch_interval is not None:
+        Cfg['watch_interval'] = Args.watch_interval
+    if 'watch_interval' not in Cfg or Cfg['watch_interval'] is None:
+        Cfg['watch_interval'] = 10
+    if hasattr(Args, "top_k") and Args.top_k is not None:
+        Cfg['top_k'] = Args.top_k
+    if 'top_k' not in Cfg or Cfg['top_k'] is None:
+        Cfg['top_k'] = 3
+    if 'availability_weight' not in Cfg or Cfg['availability_weight'] is None:
+        Cfg['availability_weight'] = 0
+    if 'merge_parts' not in Cfg or Cfg['merge_parts'] is None:
+        Cfg['merge_parts'] = 'newest'
+    if hasattr(Args, "fetch") and Args.fetch:
+        Cfg['fetch'] = True
+    if 'fetch' not in Cfg or Cfg['fetch'] is None:
+        Cfg['fetch'] = False
+    if 'fetch_state_filename' not in Cfg or Cfg['fetch_state_filename'] is None:
+        Cfg['fetch_state_filename'] = Path(Args.dir) / '.fetch_state.json'
+    if 'fetch_timeout' not in Cfg or Cfg['fetch_timeout'] is None:
+        Cfg['fetch_timeout'] = 60
+    if hasattr(Args, "store") and Args.store is not None:
+        Cfg['store_filename'] = Args.store
+    if 'store_filename' not in Cfg:
+        Cfg['store_filename'] = None
+    if hasattr(Args, "parse_workers") and Args.parse_workers is not None:
+        Cfg['parse_workers'] = Args.parse_workers
+    if 'parse_workers' not in Cfg or Cfg['parse_workers'] is None:
+        Cfg['parse_workers'] = 1
+    if 'parse_chunk_mb' not in Cfg or Cfg['parse_chunk_mb'] is None:
+        Cfg['parse_chunk_mb'] = 16
+    if hasattr(Args, "memory_limit") and Args.memory_limit is not None:
+        Cfg['memory_limit_mb'] = Args.memory_limit
+    if 'memory_limit_mb' not in Cfg:
+        Cfg['memory_limit_mb'] = None
+    if 'spill_dir' not in Cfg:
+        Cfg['spill_dir'] = None
+    if hasattr(Args, "stream") and Args.stream:
+        Cfg['streaming'] = True
+    if 'streaming' not in Cfg or Cfg['streaming'] is None:
+        Cfg['streaming'] = False
+    if 'cache_dir' not in Cfg:
+        Cfg['cache_dir'] = None
+    if 'cache_max_mb' not in Cfg or Cfg['cache_max_mb'] is None:
+        Cfg['cache_max_mb'] = 512
+    if 'search_index_filename' not in Cfg:
+        Cfg['search_index_filename'] = Path(Cfg['cache_dir']) / 'sku_search.idx' if Cfg['cache_dir'] is not None else Path(Args.dir) / '.sku_search.idx'
+    cache = FeedCache(Cfg['cache_dir'], Cfg['cache_max_mb']) if Cfg['cache_dir'] is not None else None
+    if cache is not None and hasattr(Args, "clear_cache") and Args.clear_cache:
+        cache.clear()
+        verbose(f'feed cache {cache.dir} cleared')
+    if hasattr(Args, "no_cache") and Args.no_cache:
+        cache = None
 
-    global_settings = ['include_0_priced_items', 'replace', 'sku_chars_to_remove','sku_ignore_case', 'include_out_of_stock_items']
+    global_settings = ['include_0_priced_items', 'replace', 'sku_chars_to_remove','sku_ignore_case', 'include_out_of_stock_items', 'ingest_engine', 'merge_parts',
+                       'parse_workers', 'parse_chunk_mb']
     Suppliers = {}
     for name,supp_def in Cfg['suppliers'].items():
         supp = Supplier()
         for gsn in global_settings:
             val = Cfg[gsn] if gsn not in supp_def else supp_def[gsn]
             setattr(supp,gsn,val)
-        supp.name = name
-        supp.shipping = loadShippingCostRules(supp_def['shipping_rules'] if 'shipping_rules' in supp_def else None)
+        supp.name = sys.intern(name)
+        supp.setShippingRules(supp_def['shipping_rules'] if 'shipping_rules' in supp_def else None)
         supp.translateSku = makeTranslateSku(supp.sku_chars_to_remove, supp.sku_ignore_case)
         filename = supp_def['data']
-        if '*' in filename:
-            names = list(Args.dir.glob(filename))
-            if len(names)==0:
-                verbose( f'filename {filename} not found')
-                continue
-            supp.data = names[0]
-            verbose(f'wildcard in {filename} resolved to {supp.data}')
+        supp.data_pattern = filename
+        supp.url = supp_def['url'] if Cfg['fetch'] and 'url' in supp_def else None
+        if supp.url is not None:
+            # the downloaded datafeed is the only file of the supplier, it is not there before the first download
+            supp.parts = [fetchTarget(Args.dir, filename, supp.url)]
         else:
-            supp.data = Args.dir / filename
+            supp.parts = resolveDataFiles(Args.dir, filename)
+        if not supp.parts:
+            verbose( f'filename {filename} not found')
+            # a server loads the datafeed once it is there
+            if getattr(Args, 'serve', None) is None:
+                continue
+        supp.data = supp.parts[-1] if supp.parts else None
+        if '*' in filename:
+            verbose(f'wildcard in {filename} resolved to {", ".join(str(p) for p in supp.parts)}')
         supp.columns = supp_def['columns']
+        supp.cache = cache
         Suppliers[name]=supp
     
     return Cfg,Suppliers
@@ -189,7 +418,8 @@ def combineRange(availability_range,r):
     a0 = availability_range[0]
     a1 = availability_range[1]
     if r[0] != 0:
-        a0 = min(availability_range[0], r[0])
+        # the starting (0,0) range does not count as a lower end
+        a0 = r[0] if a0 == 0 else min(a0, r[0])
     a1 = min( sys.maxsize, availability_range[1] + r[1])
     return (a0,a1)
 
@@ -212,90 +442,389 @@ def readAvailability(row, availabilityIdx, availreplacement):
             pass
     return availability_value if is_value_ok else availability_str ,availability_range
 
-def _loadItems(supplier_def, encoding, verbose):
-    Item = namedtuple('Item', ['supplier','sku', 'price','tot_cost','availability','orig_availability','optionalColumns'])
+# detected encodings by file and candidate encodings, with size and mtime of the detected file, oldest entries are dropped first
+_encodingCache = {}
+ENCODING_CACHE_SIZE = 256
 
-    shippingCostFcn = supplier_def.shipping
+def detectEncodings(filename, encodings, chunkSize=1<<20):
+    # single pass over raw bytes, every candidate encoding gets its own incremental decoder
+    # returns encodings able to decode the whole file, in the configured order
+    st = filename.stat()
+    key = (str(filename), tuple(encodings))
+    cached = _encodingCache.get(key)
+    if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+        return cached[2]
+    decoders = []
+    for encoding in encodings:
+        try:
+            decoders.append( (encoding, codecs.getincrementaldecoder(encoding or locale.getpreferredencoding(False))()) )
+        except LookupError:
+            pass
+    with open(filename,'rb') as f:
+        while decoders:
+            chunk = f.read(chunkSize)
+            alive = []
+            for encoding,decoder in decoders:
+                try:
+                    decoder.decode(chunk, final=not chunk)
+                    alive.append( (encoding,decoder) )
+                except UnicodeDecodeError:
+                    pass
+            decoders = alive
+            if not chunk:
+                break
+    detected = [encoding for encoding,_ in decoders]
+    # a changed file replaces its entry
+    _encodingCache.pop(key, None)
+    _encodingCache[key] = (st.st_size, st.st_mtime_ns, detected)
+    while len(_encodingCache) > ENCODING_CACHE_SIZE:
+        del _encodingCache[next(iter(_encodingCache))]
+    return detected
+
+def readTitles(row, columns, verbose):
+    skuIdx = getColumnIdx(row,columns['sku'])
+    if skuIdx is None:    
+        cn = columns['sku']
+        verbose(f'error loading sku title {cn}')
+    priceIdx = getColumnIdx(row,columns['price'])
+    if priceIdx is None:  verbose('error loading price title')
+    availabilityIdx = getColumnIndices(row,columns['availability'])
+    if availabilityIdx is None: verbose('error loading availability title')
+    weightIdx = getColumnIdx(row,columns['weight'])
+    if weightIdx is None: verbose('error loading weight title')
+    if skuIdx is None or priceIdx is None or availabilityIdx is None or weightIdx is None:
+        verbose(','.join(row))
+        return None
+    optionalColumns = {k : getColumnIdx(row,v) for k,v in columns.items() if k not in ('sku','price','availability','weight')}
+    return skuIdx,priceIdx,availabilityIdx,weightIdx,optionalColumns
+
+def verboseLoadSummary(verbose, filename, sep, encoding, itemsCnt, t0, invalidPrices, invalidSku, outOfStockItems, invalidLines, titles, rows, stats=None):
+    skuIdx,priceIdx,availabilityIdx,weightIdx,_ = titles
+    if stats is not None:
+        stats.update({'rows' : rows, 'items' : itemsCnt,
+                      'skipped' : {'price' : invalidPrices, 'sku' : invalidSku, 'out_of_stock' : outOfStockItems, 'invalid' : invalidLines}})
+    sepn = 'comma' if sep==',' else 'tab'
+    verbose(f'file {filename} separator "{sepn}" encoding {encoding}')
+    verbose(f'\tloaded {itemsCnt} items time {datetime.utcnow()-t0}')
+    verbose(f'\tskipped {invalidPrices} items without a price')
+    verbose(f'\tskipped {invalidSku} items with empty sku')
+    verbose(f'\tskipped {outOfStockItems} out of stock items')
+    verbose(f'\tskipped {invalidLines} invalid lines')
+    verbose(f'\ttitle indices: skuIdx "{skuIdx}", priceIdx "{priceIdx}" availabilityIdx "{availabilityIdx}" weightIdx "{weightIdx}"')
+
+def classifyShortRow(row, titles, availreplacement, include_out_of_stock_items):
+    # rows missing some of the used columns never produce an item, only the skip reason matters
+    skuIdx,priceIdx,availabilityIdx,weightIdx,optionalColumns = titles
+    try:
+        for idx in optionalColumns.values():
+            if idx is not None: row[idx]
+        availability,avr = readAvailability(row, availabilityIdx, availreplacement)
+        if avr[1] <=0 and not include_out_of_stock_items:
+            return 'out_of_stock'
+        if not row[skuIdx].replace('"','').strip():
+            return 'sku'
+        row[priceIdx],row[weightIdx]
+    except IndexError:
+        return 'invalid'
+    except ValueError:
+        print('ValueError ', row)
+    return None
+
+def makeReadAvailability(availabilityIdx, availreplacement):
+    # availability columns have few distinct values, readAvailability runs once per distinct value,
+    # None stands for a value rejected with ValueError, () for an invalid (empty) one
+    cache = {}
+    n = len(availabilityIdx)
+    def read(vals):
+        try:
+            return readAvailability(vals if n > 1 else (vals,), range(n), availreplacement)
+        except IndexError:
+            return ()
+        except ValueError:
+            return None
+    def readCached(vals):
+        r = cache.get(vals)
+        if r is None and vals not in cache:
+            r = cache[vals] = read(vals)
+        return r
+    return readCached
+
+def makeRowExtractor(supplier_def, titles, quoted=True):
+    # built once per datafeed from column indices and replace maps, used fields are fetched by itemgetter calls,
+    # quotes are removed only from feeds having any, replace maps are looked up only when configured
+    # returns an Item or a skip reason, raises IndexError for rows missing some of the used columns
+    skuIdx,priceIdx,availabilityIdx,weightIdx,optionalColumns = titles
     replacement = supplier_def.replace
     priceReplacement = replacement['price'] if 'price' in replacement else {}
-    availreplacement = replacement['availability'] if 'availability' in replacement else {}
     weightReplacement = replacement['weight'] if 'weight' in replacement else {}
-    columns = supplier_def.columns
-    firstLine=True
-    Items = {}
+    readAvail = makeReadAvailability(availabilityIdx, replacement['availability'] if 'availability' in replacement else {})
+    layout = sharedLayout(optionalColumns.keys())
+    optIdx = [i for i in optionalColumns.values() if i is not None]
+    fetchAvail = itemgetter(*availabilityIdx)
+    fetch = itemgetter(skuIdx, priceIdx, weightIdx, *optIdx)
+    optAll = len(optIdx) == len(optionalColumns)
+    pos = iter(range(3, 3+len(optIdx)))
+    optPos = [next(pos) if i is not None else None for i in optionalColumns.values()]     # columns missing in this datafeed are empty
+    translateSku = supplier_def.translateSku
+    shippingCostFcn = supplier_def.shipping
+    name = supplier_def.name
+    skipOutOfStock = not supplier_def.include_out_of_stock_items
+    skipZeroPrice = not supplier_def.include_0_priced_items
+    def extract(row):
+        f = fetch(row)
+        avail = readAvail(fetchAvail(row))
+        if not avail:
+            return 'invalid' if avail is not None else 'error'
+        availability,avr = avail
+        if avr[1] <= 0 and skipOutOfStock:
+            return 'out_of_stock'
+        if quoted:
+            vals = [v.replace('"','').strip() for v in f]
+        else:
+            vals = [v.strip() for v in f]
+        sku = vals[0]
+        if not sku:
+            return 'sku'
+        p = vals[1]
+        if priceReplacement:
+            p = priceReplacement.get(p, p)
+        if p is None:    # replaced with null
+            return 'price'
+        try:
+            price = float(p)
+        except ValueError:
+            return 'price'
+        if price == 0 and skipZeroPrice:
+            return 'price'
+        w = vals[2]
+        if weightReplacement:
+            w = weightReplacement.get(w, w)
+        try:
+            weight = float(w) if w is not None else None
+        except ValueError:
+            weight = None
+        shc = shippingCostFcn(price,weight) if shippingCostFcn is not None else 0
+        opt = tuple(vals[3:]) if optAll else tuple([vals[p] if p is not None else '' for p in optPos])
+        return translateSku(sku), Item(name, sku, price, price+shc, avr[0], avr[1], availability, layout, opt)
+    return extract
+
+def iterItems(supplier_def, rows, titles, counts, quoted=True):
+    # yields (normalized sku, item) of every valid row in file order, a repeated sku is yielded again,
+    # counts gets number of skipped rows by reason once rows are exhausted
+    extract = makeRowExtractor(supplier_def, titles, quoted)
+    availreplacement = supplier_def.replace['availability'] if 'availability' in supplier_def.replace else {}
+    skipped = {'price' : 0, 'sku' : 0, 'out_of_stock' : 0, 'invalid' : 0}
+    for row in rows:
+        try:
+            r = extract(row)
+        except IndexError:
+            r = classifyShortRow(row, titles, availreplacement, supplier_def.include_out_of_stock_items)
+            if r is None:
+                continue
+        if r.__class__ is tuple:
+            yield r
+        elif r == 'error':
+            print('ValueError ', row)
+        else:
+            skipped[r] += 1
+    counts.update(skipped)
+
+def parseItems(supplier_def, rows, titles, counts, quoted=True):
+    # rows without the title row, the last row of a repeated sku wins
+    return dict(iterItems(supplier_def, rows, titles, counts, quoted))
+
+def isByteSplittable(encoding):
+    # separators can be found on raw bytes for utf-8 and single byte encodings
+    name = codecs.lookup(encoding).name
+    return name == 'utf-8' or len(bytes(range(256)).decode(name, errors='replace')) == 256
+
+def decodesWhole(filename, encoding):
+    # reuses an earlier detection of the file when there is one
+    st = filename.stat()
+    for (fn,encodings),(size,mtime,detected) in _encodingCache.items():
+        if (fn,size,mtime) == (str(filename),st.st_size,st.st_mtime_ns) and encoding in encodings:
+            return encoding in detected
+    return encoding in detectEncodings(filename, [encoding])
+
+def canSplitTabBytes(mm, encoding):
+    # csv.reader results are reproduced only without quoted fields and with \n or \r\n line ends
+    eol = mm.find(b'\n')
+    if mm[:eol if eol >= 0 else len(mm)].count(b'\t') < 2:     # same rule as detectSeparator
+        return False
+    if mm.find(b'\x00') >= 0 or mm[:1] == b'"' or mm.find(b'\t"') >= 0 or mm.find(b'\n"') >= 0:
+        return False
+    return mm.find(b'\r') < 0 or re.search(rb'\r(?!\n)', mm) is None
+
+def hasQuotes(filename):
+    # conservative for multi byte encodings, a quote byte inside another character counts as a quote
+    if filename.stat().st_size == 0:
+        return False
+    with open(filename,'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm.find(b'"') >= 0
+
+def tabRows(readline, enc, titles, lines):
+    # rows split on raw bytes, columns after the last used one are never decoded, lines[0] counts read lines
+    skuIdx,priceIdx,availabilityIdx,weightIdx,optionalColumns = titles
+    maxsplit = max(i for i in [skuIdx, priceIdx, weightIdx] + availabilityIdx + list(optionalColumns.values()) if i is not None) + 1
+    for line in iter(readline, b''):
+        lines[0] += 1
+        line = line.rstrip(b'\r\n')
+        if not line:
+            yield []
+            continue
+        rest = line.split(b'\t', maxsplit)
+        if len(rest) > maxsplit:    # unused columns at the end are not decoded
+            line = line[:len(line)-len(rest[-1])-1]
+        yield line.decode(enc).split('\t')
+
+def parseChunks(supplier_def, size):
+    # number of byte ranges a feed is parsed in, one per worker with at least parse_chunk_mb each,
+    # a worker process loading a whole supplier does not start workers of its own
+    workers = supplier_def.parse_workers or 1
+    if workers < 2 or multiprocessing.parent_process() is not None:
+        return 1
+    return max(1, min(workers, int(size // (supplier_def.parse_chunk_mb * 2**20))))
+
+def chunkRanges(mm, start, chunks):
+    # byte ranges of about the same size, every one ends after a line end
+    size = len(mm)
+    step = max((size - start) // chunks, 1)
+    ranges = []
+    while start < size:
+        end = mm.find(b'\n', start + step - 1)
+        end = size if end < 0 else end + 1
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+def _parseTabChunk(supplier_def, encoding, titles, quoted, start, end):
+    with open(supplier_def.data,'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        chunk = io.BytesIO(mm[start:end])
+    lines,counts = [0],{}
+    Items = parseItems(supplier_def, tabRows(chunk.readline, encoding or locale.getpreferredencoding(False), titles, lines), titles, counts, quoted)
+    return Items,counts,lines[0]
+
+def parseTabChunks(supplier_def, encoding, titles, quoted, ranges, verbose):
+    # chunks are merged in file order, a sku repeated in a later chunk replaces the earlier offer as in a sequential parse
+    with ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+        futures = [pool.submit(_parseTabChunk, supplier_def, encoding, titles, quoted, start, end) for start,end in ranges]
+        Items,counts,lines = futures[0].result()
+        for future in futures[1:]:
+            itms,cnts,n = future.result()
+            Items.update(itms)
+            for reason,cnt in cnts.items():
+                counts[reason] += cnt
+            lines += n
+    verbose(f'file {supplier_def.data} parsed in {len(ranges)} chunks')
+    return Items,counts,lines
+
+def _loadItemsTabBytes(supplier_def, mm, encoding, verbose, stats=None, collect=None, parse=parseItems):
+    # memory mapped feed, a large one is split into byte ranges parsed by worker processes
     t0 = datetime.utcnow()
+    enc = encoding or locale.getpreferredencoding(False)
+    titleRow = mm.readline().rstrip(b'\r\n').decode(enc).split('\t')
+    titles = readTitles(titleRow, supplier_def.columns, verbose)
+    if titles is None:
+        return None
+    quoted = mm.find(b'"') >= 0
+    if collect is not None:
+        return collect(titles, tabRows(mm.readline, enc, titles, [0]), quoted, '\t')
+    chunks = parseChunks(supplier_def, len(mm)) if parse is parseItems else 1
+    if chunks > 1:
+        Items,counts,lines = parseTabChunks(supplier_def, encoding, titles, quoted, chunkRanges(mm, mm.tell(), chunks), verbose)
+        if stats is not None:
+            stats['chunks'] = chunks
+    else:
+        lines,counts = [0],{}
+        Items = parse(supplier_def, tabRows(mm.readline, enc, titles, lines), titles, counts, quoted)
+        lines = lines[0]
+    verboseLoadSummary(verbose, supplier_def.data, '\t', encoding, len(Items), t0,
+                       counts['price'], counts['sku'], counts['out_of_stock'], counts['invalid'], titles, lines, stats)
+    return Items
 
-    with open(supplier_def.data, encoding=encoding) as csvfile:
+def _loadItems(supplier_def, encoding, verbose, stats=None, collect=None, parse=parseItems):
+    # collect - takes (titles, rows, quoted, separator) and returns what the feed is loaded as instead of items
+    # parse - parseItems or a replacement with the same arguments, e.g. one handing offers on as they are parsed
+    filename = supplier_def.data
+    enc = encoding or locale.getpreferredencoding(False)
+    if filename.stat().st_size > 0 and isByteSplittable(enc) and decodesWhole(filename, encoding):
+        with open(filename,'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if canSplitTabBytes(mm, enc):
+                return _loadItemsTabBytes(supplier_def, mm, encoding, verbose, stats, collect, parse)
+    t0 = datetime.utcnow()
+    with open(filename, encoding=encoding) as csvfile:
         line = csvfile.readline()
         sep=detectSeparator(line)
-        invalidLines = 0
-        invalidPrices = 0
-        invalidSku = 0
-        outOfStockItems = 0
         csvfile.seek(0)
         reader = csv.reader(csvfile, delimiter=sep)
-        for row in reader:
-            if firstLine:
-                skuIdx = getColumnIdx(row,columns['sku'])
-                if skuIdx is None:    
-                    cn = columns['sku']
-                    verbose(f'error loading sku title {cn}')
-                priceIdx = getColumnIdx(row,columns['price'])
-                if priceIdx is None:  verbose('error loading price title')
-                availabilityIdx = getColumnIndices(row,columns['availability'])
-                if availabilityIdx is None: verbose('error loading availability title')
-                weightIdx = getColumnIdx(row,columns['weight'])
-                if weightIdx is None: verbose('error loading weight title')
-                if skuIdx is None or priceIdx is None or availabilityIdx is None or weightIdx is None:
-                    verbose(','.join(row))
-                    return None
-                optionalColumns = {k : getColumnIdx(row,v) for k,v in columns.items() if k not in ('sku','price','availability','weight')}
-                firstLine = False
-            else:
-                try:
-                    opt = { k:getAt(row, v) for k,v in optionalColumns.items() }
-                    availability,avr = readAvailability(row, availabilityIdx, availreplacement)
-                    if avr[1] <=0 and not supplier_def.include_out_of_stock_items: 
-                        outOfStockItems += 1
-                        continue
-                    sku = getAt(row, skuIdx)
-                    if not sku:
-                        invalidSku += 1
-                        continue
-                    price = covertToType(getAt(row, priceIdx, priceReplacement), float)
-
-                    weight = covertToType(getAt(row, weightIdx, weightReplacement), float) if weightIdx is not None else 0
-                    if price is None:
-                        invalidPrices += 1
-                    elif price==0 and not supplier_def.include_0_priced_items:
-                        invalidPrices += 1
-                    else:
-                        skut = supplier_def.translateSku(sku)
-                        shc = shippingCostFcn(price,weight) if shippingCostFcn is not None else 0
-                        item = Item(supplier_def.name, sku, price, price+shc, avr, availability, opt)
-                        Items[skut] = item
-                except IndexError:
-                    invalidLines += 1
-                except ValueError:
-                    print('ValueError ', row)
+        titles = readTitles(next(reader, []), supplier_def.columns, verbose)
+        if titles is None:
+            return None
+        if collect is not None:
+            return collect(titles, reader, hasQuotes(filename), sep)
+        counts = {}
+        Items = parse(supplier_def, reader, titles, counts, hasQuotes(filename))
     
-    sepn = 'comma' if sep==',' else 'tab'
-    verbose(f'file {supplier_def.data} separator "{sepn}" encoding {encoding}')
-    verbose(f'\tloaded {len(Items)} items time {datetime.utcnow()-t0}')
-    verbose(f'\tskipped {invalidPrices} items without a price')
-    verbose(f'\tskipped {invalidSku} items with empty sku')
-    verbose(f'\tskipped {outOfStockItems} out of stock items')
-    verbose(f'\tskipped {invalidLines} invalid lines')
-    verbose(f'\ttitle indices: skuIdx "{skuIdx}", priceIdx "{priceIdx}" availabilityIdx "{availabilityIdx}" weightIdx "{weightIdx}"')
+    verboseLoadSummary(verbose, filename, sep, encoding, len(Items), t0,
+                       counts['price'], counts['sku'], counts['out_of_stock'], counts['invalid'], titles, reader.line_num-1, stats)
     return Items
 
-def loadItems(supplier_def, encodings, verbose):
+def loadItems(supplier_def, encodings, verbose, stats=None, traceMemory=False, load=None):
+    # load - loader used in place of the one of the ingest engine, called as _loadItems
+    if stats is None:
+        return _loadItemsCached(supplier_def, encodings, verbose, None, load)
+    with measure(stats, traceMemory):
+        itms,encoding = _loadItemsCached(supplier_def, encodings, verbose, stats, load)
+    stats['encoding'] = encoding
+    return itms,encoding
+
+def _loadItemsCached(supplier_def, encodings, verbose, stats, load=None):
     if not supplier_def.data.exists():
         verbose( f'filename {supplier_def.data} not found')
         return None,None
-    for encoding in encodings:
+    cache = supplier_def.cache
+    if cache is not None:
+        t0 = datetime.utcnow()
+        key = cache.key(supplier_def, encodings)
+        cached = cache.load(key)
+        if cached is not None:
+            itms,encoding,summary,counts = cached
+            verbose(f'file {supplier_def.data} encoding {encoding} loaded {len(itms)} items from cache time {datetime.utcnow()-t0}, cached summary:')
+            for txt in summary:
+                verbose(txt)
+            if stats is not None:
+                stats.update(counts, cache='hit')
+            return itms,encoding
+        summary = []
+        def record(txt):
+            summary.append(txt)
+            verbose(txt)
+        counts = {}
+        itms,encoding = _loadItemsDetectEncoding(supplier_def, encodings, record, counts, load)
+        if itms is not None:
+            cache.store(key, (itms,encoding,summary,counts))
+        if stats is not None:
+            stats.update(counts, cache='miss')
+        return itms,encoding
+    return _loadItemsDetectEncoding(supplier_def, encodings, verbose, stats, load)
+
+def selectLoader(supplier_def, verbose):
+    if supplier_def.ingest_engine == 'columnar':
+        from columnar import loadItemsColumnar, np
+        if np is not None:
+            return loadItemsColumnar
+        verbose('numpy not available, columnar engine disabled')
+    return _loadItems
+
+def _loadItemsDetectEncoding(supplier_def, encodings, verbose, stats=None, load=None):
+    load = load or selectLoader(supplier_def, verbose)
+    t0 = datetime.utcnow()
+    detected = detectEncodings(supplier_def.data, encodings)
+    verbose(f'file {supplier_def.data} decodes as {detected} detection time {datetime.utcnow()-t0}')
+    # encodings rejected by the detection are kept as a fallback only
+    for encoding in detected + [e for e in encodings if e not in detected]:
         try:
-            itms = _loadItems(supplier_def, encoding, verbose)
+            itms = load(supplier_def, encoding, verbose, stats)
             if itms is not None:
                 return itms,encoding
         except UnicodeDecodeError:
@@ -306,18 +835,340 @@ def loadItems(supplier_def, encodings, verbose):
     verbose(f'Error reading file {supplier_def.data} - skipping')
     return None,None
 
-def LoadItems(Suppliers, encodings, verbose):
+class RawFeed:
+    # used columns of every row of a datafeed in file order, parsed into items by parseRawFeed with any supplier settings
+    def __init__(self, titles, rows, quoted, sep):
+        skuIdx,priceIdx,availabilityIdx,weightIdx,optionalColumns = titles
+        used = sorted({i for i in [skuIdx, priceIdx, weightIdx] + availabilityIdx + list(optionalColumns.values()) if i is not None})
+        # columns keep their order, a row missing some columns is missing the same ones after the projection
+        pos = {i : n for n,i in enumerate(used)}
+        self.fileTitles = titles
+        self.titles = (pos[skuIdx], pos[priceIdx], [pos[i] for i in availabilityIdx], pos[weightIdx],
+                       {k : pos[i] if i is not None else None for k,i in optionalColumns.items()})
+        self.quoted = quoted
+        self.sep = sep
+        fetch = itemgetter(*used)
+        self.rows = []
+        append = self.rows.append
+        for row in rows:
+            try:
+                append(fetch(row))
+            except IndexError:
+                append(tuple([row[i] for i in used if i < len(row)]))
+
+def readFeed(supplier_def, encodings, verbose, collect):
+    # rows of the datafeed decoded with the detected encoding are handed to collect, returns (what collect returned, encoding)
+    if not supplier_def.data.exists():
+        verbose( f'filename {supplier_def.data} not found')
+        return None,None
+    return _loadItemsDetectEncoding(supplier_def, encodings, verbose, load=lambda *args: _loadItems(*args, collect=collect))
+
+def readRawFeed(supplier_def, encodings, verbose):
+    # returns (RawFeed, encoding)
+    return readFeed(supplier_def, encodings, verbose, RawFeed)
+
+def parseRawFeed(supplier_def, raw, encoding, verbose):
+    t0 = datetime.utcnow()
+    counts = {}
+    Items = parseItems(supplier_def, raw.rows, raw.titles, counts, raw.quoted)
+    verboseLoadSummary(verbose, supplier_def.data, raw.sep, encoding, len(Items), t0,
+                       counts['price'], counts['sku'], counts['out_of_stock'], counts['invalid'], raw.fileTitles, len(raw.rows))
+    return Items
+
+def _loadItemsWorker(supplier_def, encodings, withStats, traceMemory):
+    messages = []
+    stats = {} if withStats else None
+    itms,encoding = loadItems(supplier_def, encodings, messages.append, stats, traceMemory)
+    return itms,encoding,messages,stats
+
+def supplierParts(supplier_def):
+    # every file matched by a wildcard is loaded as a datafeed of its own and cached separately
+    parts = getattr(supplier_def, 'parts', None)
+    if parts is None or len(parts) < 2:
+        return [supplier_def]
+    Parts = []
+    for fn in parts:
+        part = copy.copy(supplier_def)
+        part.data = fn
+        part.parts = [fn]
+        Parts.append(part)
+    return Parts
+
+def loadJobs(Suppliers):
+    Jobs = []
+    for name,supp in Suppliers.items():
+        parts = supplierParts(supp)
+        Jobs.extend((name, part, len(parts) > 1) for part in parts)
+    return Jobs
+
+def readyJobs(Jobs, ready, verbose):
+    # jobs of a supplier start once ready names it, e.g. after its datafeed is downloaded,
+    # suppliers never named are loaded last, a datafeed that failed its first download is skipped
+    if ready is None:
+        yield from Jobs
+        return
+    pending = {}
+    for job in Jobs:
+        pending.setdefault(job[0], []).append(job)
+    for name in ready:
+        for job in pending.pop(name, []):
+            if job[1].data.exists():
+                yield job
+            else:
+                verbose(f'filename {job[1].data} not found')
+    for jobs in pending.values():
+        yield from jobs
+
+def jobStats(metrics, supplier_name, supplier_def, isPart):
+    stats = metrics.supplier(supplier_name)
+    return stats.setdefault('parts', {}).setdefault(supplier_def.data.name, {}) if isPart else stats
+
+def loadItemsSequential(Jobs, encodings, verbose, metrics=None):
+    for supplier_name,supplier_def,isPart in Jobs:
+        stats = jobStats(metrics, supplier_name, supplier_def, isPart) if metrics is not None else None
+        itms,encoding = loadItems(supplier_def, encodings, verbose, stats, metrics is not None and metrics.traceMemory)
+        yield supplier_name,itms,encoding
+
+def loadItemsParallel(Jobs, encodings, verbose, workers=None, metrics=None):
+    traceMemory = metrics is not None and metrics.traceMemory
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(name, supp, isPart, pool.submit(_loadItemsWorker, supp, encodings, metrics is not None, traceMemory)) for name,supp,isPart in Jobs]
+        # replay worker summaries in supplier order, so the output matches the sequential mode
+        for supplier_name,supplier_def,isPart,future in futures:
+            itms,encoding,messages,stats = future.result()
+            for m in messages:
+                verbose(m)
+            if metrics is not None:
+                jobStats(metrics, supplier_name, supplier_def, isPart).update(stats)
+            yield supplier_name,itms,encoding
+
+class OutputEncoding:
+    # encoding of output files, the encoding of the first loaded datafeed, utf-8 once another supplier brings its own,
+    # files of one supplier sharing an encoding do not collide
+    def __init__(self, verbose):
+        self.verbose = verbose
+        self.value = None
+        self.suppliers = {}
+
+    def add(self, supplier_name, encoding):
+        if encoding is not None and encoding != self.suppliers.get(supplier_name):
+            self.suppliers[supplier_name] = encoding
+            if self.value is None:
+                self.value = encoding
+            else:
+                self.verbose(f'colliding encodings : {self.value} and {encoding}, switching to utf-8')
+                self.value = 'utf-8'
+
+def mergeParts(supplier_name, parts, rule, verbose):
+    # parts are ordered oldest file first, rule 'newest' lets the newest file replace an offer of the same sku,
+    # 'cheapest' keeps the cheaper offer in stock
+    t0 = datetime.utcnow()
+    merged = parts[0]
+    dupCnt = 0
+    for items in parts[1:]:
+        if rule == 'cheapest':
+            for sku,item in items.items():
+                old = merged.get(sku)
+                if old is None:
+                    merged[sku] = item
+                else:
+                    dupCnt += 1
+                    if item.tot_cost < old.tot_cost and item.avail_hi > 0:
+                        merged[sku] = item
+        else:
+            dupCnt += len(merged.keys() & items.keys())
+            merged.update(items)
+    verbose(f'{supplier_name} : merged {len(parts)} files keeping {rule} offers, {dupCnt} skus in more than one file, total items {len(merged)} time {datetime.utcnow()-t0}')
+    return merged
+
+def LoadItems(Suppliers, encodings, verbose, parallel=False, workers=None, metrics=None, ready=None, output_encoding=None):
+    # ready - supplier names in the order their datafeeds become available, loading follows it
+    # output_encoding - OutputEncoding the encodings of loaded datafeeds are added to, its suppliers keep them per supplier
     Items={}
-    output_encoding = None
-    for supplier_name, supplier_def in Suppliers.items():
-        itms,encoding = loadItems(supplier_def, encodings, verbose)
+    Jobs = loadJobs(Suppliers)
+    if parallel and len(Jobs) > 1:
+        loaded = loadItemsParallel(readyJobs(Jobs, ready, verbose), encodings, verbose, workers, metrics)
+    else:
+        loaded = loadItemsSequential(readyJobs(Jobs, ready, verbose), encodings, verbose, metrics)
+    Parts = {}
+    if output_encoding is None:
+        output_encoding = OutputEncoding(verbose)
+    for supplier_name,itms,encoding in loaded:
         if itms is not None:
-            Items[supplier_name]=itms
-            if encoding is not None:
-                if output_encoding is None:
-                    output_encoding = encoding
+            Parts.setdefault(supplier_name, []).append(itms)
+            output_encoding.add(supplier_name, encoding)
+    for supplier_name in Suppliers:
+        if supplier_name not in Parts:
+            continue
+        parts = Parts[supplier_name]
+        Items[supplier_name] = parts[0] if len(parts) == 1 else mergeParts(supplier_name, parts, Suppliers[supplier_name].merge_parts, verbose)
+    return Items,output_encoding.value
+
+# offers in a message of the streaming loader, messages the loader may run ahead of the selection
+STREAM_BATCH = 4096
+STREAM_QUEUE = 16
+# seconds between checks that the loader is still running while no message comes
+STREAM_POLL = 1.0
+
+class StreamClosed(BaseException):
+    # raised in the loader thread once the reading side is gone, not caught by the fallbacks of the loaders
+    pass
+
+def makeStreamingParse(emit):
+    # parseItems handing offers to emit as rows are parsed: emit('offers', [(sku, item), ..]) with skus new to the datafeed in batches,
+    # emit('replaced', {sku : item}) with the last offer of skus repeated in the datafeed at the end,
+    # emit('void', None) drops what a parse failing half way, e.g. with a wrong encoding, handed on
+    def parse(supplier_def, rows, titles, counts, quoted=True):
+        Items = {}
+        repeated = set()
+        batch = []
+        emitted = False
+        try:
+            for key,item in iterItems(supplier_def, rows, titles, counts, quoted):
+                if key in Items:
+                    repeated.add(key)
                 else:
-                    verbose(f'colliding encodings : {output_encoding} and {encoding}, switching to utf-8')
-                    output_encoding = 'utf-8'
-    return Items,output_encoding
+                    batch.append((key,item))
+                    if len(batch) == STREAM_BATCH:
+                        emit('offers', batch)
+                        emitted = True
+                        batch = []
+                Items[key] = item
+        except Exception:
+            if emitted:
+                emit('void', None)
+            raise
+        if batch:
+            emit('offers', batch)
+        if repeated:
+            emit('replaced', {key : Items[key] for key in repeated})
+        return Items
+    return parse
+
+def _streamJobs(Jobs, encodings, queue, withStats, traceMemory, closed=None):
+    # loading side of loadItemsStreaming, messages: ('log', text), (kind, job, payload) of makeStreamingParse,
+    # ('done', job, loaded, items, encoding, stats), items of 'done' are sent only when they were not streamed,
+    # e.g. from the cache or the columnar engine
+    def put(msg):
+        if closed is not None and closed.is_set():
+            raise StreamClosed()
+        queue.put(msg)
+    try:
+        for n,(_,supplier_def,_) in enumerate(Jobs):
+            streamed = False
+            def emit(kind, payload):
+                nonlocal streamed
+                streamed = kind != 'void'
+                put((kind, n, payload))
+            load = None if supplier_def.ingest_engine == 'columnar' else lambda *args: _loadItems(*args, parse=makeStreamingParse(emit))
+            stats = {} if withStats else None
+            itms,encoding = loadItems(supplier_def, encodings, lambda txt: put(('log', txt)), stats, traceMemory, load)
+            put(('done', n, itms is not None, None if streamed else itms, encoding, stats))
+        put(('end',))
+    except StreamClosed:
+        pass
+    except BaseException as e:
+        queue.put(('error', e))
+
+def loadItemsStreaming(Jobs, encodings, verbose, metrics=None, cpus=None, target=_streamJobs):
+    # yields 'offers' and 'done' messages of _streamJobs while jobs are loaded in a background process when there is more than one cpu,
+    # in a thread otherwise, the bounded queue stops the loader STREAM_QUEUE messages ahead of the caller
+    # cpus - defaults to cpu count, target - module level function loading the jobs with the arguments of _streamJobs
+    traceMemory = metrics is not None and metrics.traceMemory
+    if (cpus or os.cpu_count() or 1) > 1:
+        queue = multiprocessing.Queue(STREAM_QUEUE)
+        closed = None
+        loader = multiprocessing.Process(target=target, args=(Jobs, encodings, queue, metrics is not None, traceMemory), daemon=True)
+    else:
+        queue = Queue(STREAM_QUEUE)
+        closed = threading.Event()
+        loader = threading.Thread(target=target, args=(Jobs, encodings, queue, metrics is not None, traceMemory, closed), daemon=True)
+    loader.start()
+    try:
+        exited = False
+        while True:
+            try:
+                msg = queue.get(timeout=STREAM_POLL)
+            except Empty:
+                # a loader killed e.g. for memory never sends 'end', messages it sent right before exiting are waited for once more
+                if exited:
+                    raise RuntimeError(f'datafeed loader exited without finishing, exit code {getattr(loader, "exitcode", None)}')
+                exited = not loader.is_alive()
+                continue
+            if msg[0] == 'end':
+                break
+            elif msg[0] == 'log':
+                verbose(msg[1])
+            elif msg[0] == 'error':
+                raise msg[1]
+            else:
+                yield msg
+    finally:
+        if closed is None:
+            loader.terminate()
+        else:
+            closed.set()
+            while loader.is_alive():     # unblocks a loader waiting on the full queue
+                while not queue.empty():
+                    queue.get()
+                loader.join(0.1)
+        loader.join()
 
+def iterSupplierOffers(Suppliers, encodings, verbose, output_encoding, metrics=None):
+    # yields (supplier name, offers, items, changed) while datafeeds are loaded in the background, suppliers in order
+    # offers - (sku, item) pairs of skus not offered by the supplier before, None once all files of the supplier are loaded
+    # items - items of the supplier as LoadItems loads them, None until the supplier is loaded or when none of its files loaded
+    # changed - skus the supplier offered first with another item, None when offers handed on were dropped by a failing parse
+    # output_encoding - OutputEncoding getting encodings of the loaded files
+    Jobs = loadJobs(Suppliers)
+    messages = loadItemsStreaming(Jobs, encodings, verbose, metrics)
+    try:
+        for supplier_name,jobs in groupby(Jobs, key=itemgetter(0)):
+            parts = []
+            changed = set()
+            def fresh(offers):
+                # offers of skus not in earlier files of the supplier, the others change the offer of their sku
+                if not parts:
+                    return offers
+                new = []
+                for key,item in offers:
+                    if any(key in p for p in parts):
+                        if changed is not None:
+                            changed.add(key)
+                    else:
+                        new.append((key,item))
+                return new
+            for _,supplier_def,isPart in jobs:
+                itms = {}
+                for msg in messages:
+                    kind,_,payload = msg[:3]
+                    if kind == 'done':
+                        break
+                    if kind == 'void':
+                        changed = None
+                        itms = {}
+                    elif kind == 'replaced':
+                        itms.update(payload)
+                        if changed is not None:
+                            changed.update(payload)
+                    else:
+                        itms.update(payload)
+                        yield supplier_name,fresh(payload),None,changed
+                _,_,loaded,whole,encoding,stats = msg
+                if metrics is not None:
+                    jobStats(metrics, supplier_name, supplier_def, isPart).update(stats)
+                if not loaded:
+                    continue
+                if whole is not None:
+                    itms = whole
+                    yield supplier_name,fresh(list(whole.items())),None,changed
+                parts.append(itms)
+                output_encoding.add(supplier_name, encoding)
+            if not parts:
+                yield supplier_name,None,None,changed
+            elif len(parts) == 1:
+                yield supplier_name,None,parts[0],changed
+            else:
+                yield supplier_name,None,mergeParts(supplier_name, parts, Suppliers[supplier_name].merge_parts, verbose),changed
+    finally:
+        messages.close()
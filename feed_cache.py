@@ -0,0 +1,91 @@
+import os,json,pickle,zlib,hashlib
+from pathlib import Path
+
+# bump when the layout of cached items changes
+CACHE_VERSION = 4
+
+def fileFingerprint(filename, chunkSize=1<<20):
+    st = filename.stat()
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename,'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            h.update(chunk)
+    return {'size' : st.st_size, 'mtime' : st.st_mtime_ns, 'hash' : h.hexdigest()}
+
+def parseSettings(supplier_def):
+    # every supplier setting used by the parser
+    return {
+        'supplier'  : supplier_def.name,
+        'columns'   : supplier_def.columns,
+        'replace'   : supplier_def.replace,
+        'shipping_rules' : supplier_def.shipping_rules,
+        'sku_chars_to_remove' : supplier_def.sku_chars_to_remove,
+        'sku_ignore_case' : supplier_def.sku_ignore_case,
+        'include_0_priced_items' : supplier_def.include_0_priced_items,
+        'include_out_of_stock_items' : supplier_def.include_out_of_stock_items,
+        'ingest_engine' : supplier_def.ingest_engine,
+    }
+
+def feedKey(supplier_def, encodings):
+    # identifies parsed items of a datafeed: file content and every setting used by the parser
+    desc = dict(parseSettings(supplier_def), version=CACHE_VERSION, file=fileFingerprint(supplier_def.data), encodings=list(encodings))
+    return hashlib.sha256(json.dumps(desc, sort_keys=True, default=str).encode()).hexdigest()
+
+class FeedCache:
+    def __init__(self, directory, maxMB=512):
+        self.dir = Path(directory)
+        self.maxBytes = int(maxMB * 1024 * 1024) if maxMB is not None else None
+
+    def key(self, supplier_def, encodings):
+        return feedKey(supplier_def, encodings)
+
+    def path(self, key):
+        return self.dir / (key + '.bin')
+
+    def load(self, key):
+        fn = self.path(key)
+        try:
+            with open(fn,'rb') as f:
+                data = pickle.loads(zlib.decompress(f.read()))
+            os.utime(fn)    # mark as recently used
+            return data
+        except FileNotFoundError:
+            return None
+        except Exception:   # corrupted or written by an incompatible version
+            fn.unlink(missing_ok=True)
+            return None
+
+    def store(self, key, data):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        fn = self.path(key)
+        tmp = fn.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp,'wb') as f:
+            f.write(zlib.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL), 1))
+        os.replace(tmp, fn)
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for fn in self.dir.glob('*.bin'):
+            try:
+                st = fn.stat()
+                entries.append( (st.st_mtime, st.st_size, fn) )
+            except FileNotFoundError:
+                pass
+        return entries
+
+    def evict(self):
+        if self.maxBytes is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        # least recently used entries go first, the newest one is always kept
+        for mtime,size,fn in entries[:-1]:
+            if total <= self.maxBytes:
+                break
+            fn.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        for _,_,fn in self.entries():
+            fn.unlink(missing_ok=True)
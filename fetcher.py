@@ -0,0 +1,172 @@
+import os,ssl,json,time,queue,asyncio,hashlib,threading
+from pathlib import Path
+from urllib.parse import urlsplit, urljoin
+
+CHUNK = 1<<20
+MAX_REDIRECTS = 5
+# fetch results
+CHANGED, UNCHANGED, FAILED = 'changed', 'unchanged', 'failed'
+
+class FetchError(Exception):
+    pass
+
+def fetchTarget(directory, filename, url):
+    # downloaded datafeed is saved as data, a data pattern with a wildcard takes the file name from the url
+    return directory / (Path(urlsplit(url).path).name if '*' in filename else filename)
+
+def loadState(stateFn):
+    try:
+        with open(stateFn) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def saveState(stateFn, state):
+    stateFn = Path(stateFn)
+    tmp = stateFn.with_name(f'{stateFn.name}.{os.getpid()}.tmp')
+    with open(tmp,'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, stateFn)
+
+async def readHeaders(reader):
+    status = (await reader.readline()).decode('latin-1').split(None, 2)
+    if len(status) < 2 or not status[0].startswith('HTTP/'):
+        raise FetchError(f'invalid response {" ".join(status)}')
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        name,_,value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return int(status[1]), headers
+
+async def readBody(reader, headers):
+    # yields body chunks of a chunked, sized or connection delimited response
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while size := int((await reader.readline()).split(b';')[0], 16):
+            while size > 0:
+                chunk = await reader.read(min(size, CHUNK))
+                if not chunk:
+                    raise FetchError('connection closed inside a chunk')
+                size -= len(chunk)
+                yield chunk
+            await reader.readline()
+    elif 'content-length' in headers:
+        size = int(headers['content-length'])
+        while size > 0:
+            chunk = await reader.read(min(size, CHUNK))
+            if not chunk:
+                raise FetchError(f'connection closed, {size} bytes missing')
+            size -= len(chunk)
+            yield chunk
+    else:
+        while chunk := await reader.read(CHUNK):
+            yield chunk
+
+async def fetchFeed(url, path, known, timeout=60):
+    # conditional GET streamed to a temporary file renamed over path, returns (result, state of the downloaded file)
+    # known is the state saved by the previous download, used only while the file it describes is still there
+    path = Path(path)
+    conditional = ''
+    if known and path.exists():
+        if known.get('etag'):
+            conditional += f'If-None-Match: {known["etag"]}\r\n'
+        if known.get('last_modified'):
+            conditional += f'If-Modified-Since: {known["last_modified"]}\r\n'
+    for _ in range(MAX_REDIRECTS):
+        u = urlsplit(url)
+        https = u.scheme == 'https'
+        reader,writer = await asyncio.wait_for(asyncio.open_connection(u.hostname, u.port or (443 if https else 80),
+                                                                       ssl=ssl.create_default_context() if https else None), timeout)
+        try:
+            target = (u.path or '/') + (f'?{u.query}' if u.query else '')
+            writer.write((f'GET {target} HTTP/1.1\r\nHost: {u.netloc}\r\nUser-Agent: product-selector\r\n'
+                          f'Accept-Encoding: identity\r\nConnection: close\r\n{conditional}\r\n').encode('latin-1'))
+            await writer.drain()
+            status,headers = await asyncio.wait_for(readHeaders(reader), timeout)
+            if status == 304:
+                return UNCHANGED, known
+            if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                url = urljoin(url, headers['location'])
+                continue
+            if status != 200:
+                raise FetchError(f'{url} returned {status}')
+            tmp = path.with_name(f'{path.name}.{os.getpid()}.part')
+            h = hashlib.sha256()
+            size = 0
+            try:
+                with open(tmp,'wb') as f:
+                    body = readBody(reader, headers)
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(body.__anext__(), timeout)
+                        except StopAsyncIteration:
+                            break
+                        h.update(chunk)
+                        size += len(chunk)
+                        f.write(chunk)
+                state = {'url' : url, 'etag' : headers.get('etag'), 'last_modified' : headers.get('last-modified'),
+                         'sha256' : h.hexdigest(), 'size' : size}
+                # a server ignoring conditional requests may send the same content again
+                if known and known.get('sha256') == state['sha256'] and path.exists():
+                    return UNCHANGED, state
+                os.replace(tmp, path)
+            finally:
+                if tmp.exists():
+                    tmp.unlink()
+            return CHANGED, state
+        finally:
+            writer.close()
+    raise FetchError(f'too many redirects fetching {url}')
+
+class FeedFetcher:
+    # downloads all datafeeds concurrently in a background thread with its own event loop,
+    # suppliers are reported by ready() as soon as their datafeed is on disk, so parsing overlaps downloading
+    def __init__(self, Sources, stateFn, verbose, timeout=60):
+        self.Sources = Sources     # {supplier name : (url, path)}
+        self.stateFn = stateFn
+        self.verbose = verbose
+        self.timeout = timeout
+        self.results = {}
+        self.done = queue.Queue()
+        self.thread = None
+
+    async def fetchOne(self, name, state):
+        url,path = self.Sources[name]
+        t0 = time.perf_counter()
+        try:
+            result,known = await fetchFeed(url, path, state.get(str(path)), self.timeout)
+            if known is not None:
+                state[str(path)] = known
+            size = known.get('size') if known else None
+            self.verbose(f'fetch {name} {url} : {result} time {time.perf_counter()-t0:.2f} s')
+        except (OSError, asyncio.TimeoutError, FetchError, ValueError) as e:
+            result,size = FAILED,None
+            self.verbose(f'fetch {name} {url} failed : {e!r}, keeping {path if Path(path).exists() else "no"} datafeed')
+        self.results[name] = {'result' : result, 'seconds' : time.perf_counter()-t0, 'bytes' : size}
+        self.done.put(name)
+
+    async def fetchAll(self):
+        state = loadState(self.stateFn)
+        await asyncio.gather(*(self.fetchOne(name, state) for name in self.Sources))
+        saveState(self.stateFn, state)
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncio.run, args=(self.fetchAll(),), daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        # fetches in the calling thread
+        asyncio.run(self.fetchAll())
+        return self.results
+
+    def ready(self, names):
+        # names of suppliers in the order their datafeeds become available, suppliers without url first
+        for name in names:
+            if name not in self.Sources:
+                yield name
+        for _ in self.Sources:
+            yield self.done.get()
+        self.thread.join()
+
+    def changed(self):
+        return [name for name,r in self.results.items() if r['result'] == CHANGED]
@@ -1,59 +1,124 @@
-import sys,argparse,re,csv
+import os,argparse,csv,json,unittest
+from datetime import date
 from pathlib import Path
-from common import Supplier, prepareInputs,makeVerbose,LoadItems,makeTranslateSku
-
-def loadInStockProducts(filename,encodings):
-    for encoding in encodings:
-        try:
-            with open(filename, encoding=encoding) as csvfile:
-                reader = csv.reader(csvfile)
-                Products = [row[0] for row in reader if len(row)]
-                return Products
-        except UnicodeDecodeError:
-            pass
-    return []
-
-def findDiscontinued(InStock, SupplierItems, translateSku):
-    Discontinued = set()
-    for sku in InStock:
-        found = False
+from common import prepareInputs,makeVerbose,LoadItems,makeTranslateSku,detectEncodings,fMetricsFilename
+from metrics import Metrics
+
+def iterInStockProducts(filenames,encodings):
+    for filename in filenames:
+        detected = detectEncodings(filename, encodings)
+        encoding,errors = (detected[0],'strict') if detected else (encodings[-1],'replace')
+        with open(filename, encoding=encoding, errors=errors) as csvfile:
+            for row in csv.reader(csvfile):
+                if len(row):
+                    yield filename,row[0]
+
+def buildSkuIndex(SupplierItems):
+    # normalized sku -> name of the last supplier carrying it
+    Index = {}
+    for supp_name,items in SupplierItems.items():
+        Index.update(dict.fromkeys(items.keys(), supp_name))
+    return Index
+
+def loadHistory(historyFn):
+    if historyFn is None or not historyFn.exists():
+        return {}
+    with open(historyFn) as f:
+        return json.load(f)
+
+def saveHistory(historyFn, History, Index):
+    today = date.today().isoformat()
+    for sku,supp_name in Index.items():
+        History[sku] = (supp_name, today)
+    tmp = Path(str(historyFn) + '.tmp')
+    with open(tmp,'w') as f:
+        json.dump(History, f)
+    os.replace(tmp, historyFn)
+
+def findDiscontinued(InStock, Index, translateSku, History=None):
+    # yields (sku, stock file, last supplier, last seen) for every in stock sku no supplier carries now
+    History = History if History is not None else {}
+    seen = set()
+    for filename,sku in InStock:
         tsku = translateSku(sku)
-        for supp_name,items in SupplierItems.items():
-            for name,item in items.items():
-                if name==tsku:
-                    found = True
-                    #print(f'sku {sku} found in {supp_name}')
-                    break
-            if found:
-                break
-        if not found:
-            Discontinued.add(sku)
-    return Discontinued
+        if tsku in Index or tsku in seen:
+            continue
+        seen.add(tsku)
+        supp_name,last_seen = History.get(tsku, ('',''))
+        yield sku,filename,supp_name,last_seen
 
 def main(Args):
     verbose = makeVerbose(Args)
-    Cfg,Suppliers = prepareInputs(Args,verbose)
-    SupplierItems,_ = LoadItems(Suppliers, Cfg['encodings'], verbose)
-    InStock = loadInStockProducts(Args.stock_file, Cfg['encodings'])
-    print(f'Loaded {len(InStock)} InStock products')
+    metrics = Metrics('find_discontinued', Args.metrics_memory, Args.profile)
+    with metrics.stage('prepareInputs'):
+        Cfg,Suppliers = prepareInputs(Args,verbose)
+    with metrics.stage('LoadItems') as stage:
+        SupplierItems,_ = LoadItems(Suppliers, Cfg['encodings'], verbose, Cfg['parallel_loading'], Cfg['loading_workers'], metrics)
+        stage['rows'] = sum(s.get('rows',0) for s in metrics.suppliers.values())
+    with metrics.stage('buildSkuIndex', sum(len(items) for items in SupplierItems.values())):
+        Index = buildSkuIndex(SupplierItems)
+    historyFn = Args.history if Args.history is not None else Cfg.get('discontinued_history')
+    historyFn = Path(historyFn) if historyFn is not None else None
+    History = loadHistory(historyFn)
     translateSku = makeTranslateSku(Cfg['sku_chars_to_remove'], Cfg['sku_ignore_case'])
-    Discontinued = findDiscontinued(InStock, SupplierItems, translateSku)
-    print(f'found {len(Discontinued)} discontinued items')
-    with open(Args.output, 'w') as fout:
-        for sku in Discontinued:
-            fout.write(sku + '\n')
-    
+    InStock = iterInStockProducts(Args.stock_file, Cfg['encodings'])
+    cnt = 0
+    with metrics.stage('findDiscontinued') as stage:
+        with open(Args.output, 'w', newline='' if Args.details else None) as fout:
+            if Args.details:
+                writer = csv.writer(fout)
+                writer.writerow(['sku','stock_file','last_supplier','last_seen'])
+                for row in findDiscontinued(InStock, Index, translateSku, History):
+                    writer.writerow(row)
+                    cnt += 1
+            else:
+                # one sku per line
+                for row in findDiscontinued(InStock, Index, translateSku, History):
+                    fout.write(row[0] + '\n')
+                    cnt += 1
+        stage['rows'] = cnt
+    print(f'found {cnt} discontinued items')
+    if historyFn is not None:
+        with metrics.stage('saveHistory', len(Index)):
+            saveHistory(historyFn, History, Index)
+    metricsFn = Cfg[fMetricsFilename]
+    if metricsFn is None and Args.profile is not None:
+        metricsFn = Args.output.with_name(Args.output.stem + '_metrics.json')
+    if metricsFn is not None:
+        metrics.save(metricsFn)
+        verbose(f'metrics saved to {metricsFn}')
+
+class TestFindDiscontinued(unittest.TestCase):
+    def test_index(self):
+        translateSku = makeTranslateSku(' -', True)
+        Index = buildSkuIndex({'A' : {'primeb450mk' : None, 'archert4e' : None}, 'B' : {'archert4e' : None}})
+        self.assertEqual(Index['archert4e'], 'B')
+        InStock = [('s1','PRIME B450M-K'), ('s1','Old One'), ('s2','OLD-ONE'), ('s2','New')]
+        History = {'oldone' : ['A','2020-01-01']}
+        self.assertEqual(list(findDiscontinued(InStock, Index, translateSku, History)),
+                         [('Old One','s1','A','2020-01-01'), ('New','s2','','')])
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("dir",type=Path,help="directory containing input (datafeed) files")
-    parser.add_argument("stock_file",type=Path,help="directory containing input (datafeed) files")
+    parser.add_argument("stock_file",type=Path,nargs='+',help="one or more files with in stock products, sku in the first column")
     parser.add_argument("-output","-o", type=Path,help="output file path and name")
     parser.add_argument("-cfg",type=Path,help="config file path and name")
+    parser.add_argument("-details",action='store_true',help="write a csv file with sku, stock file, last supplier and last seen date instead of one sku per line")
+    parser.add_argument("-history",type=Path,help="file remembering the last supplier of every sku, overwrites discontinued_history from config")
     parser.add_argument("-verbose","-v",action='store_true',help="print debug informations")
     parser.add_argument("-test","-t",action='store_true',help="run unit testing")
+    parser.add_argument("-metrics",type=Path,help="metrics file path and name, overwrites metrics_filename from config")
+    parser.add_argument("-metrics_memory",action='store_true',help="trace peak memory of every stage and supplier, slows loading down")
+    parser.add_argument("-profile",type=str,help="run cProfile over the given stage, e.g. LoadItems, profile is saved next to the metrics file")
+    parser.add_argument("-parallel","-p",action='store_true',help="load supplier datafeeds in parallel worker processes")
+    parser.add_argument("-workers",type=int,help="number of worker processes used by -parallel, defaults to cpu count")
+    parser.add_argument("-engine",choices=['rows','columnar'],help="datafeed parsing engine, columnar requires numpy")
+    parser.add_argument("-no_cache",action='store_true',help="do not read nor write the parsed datafeed cache")
+    parser.add_argument("-clear_cache",action='store_true',help="remove all entries from the parsed datafeed cache")
     Args = parser.parse_args()
 
     if Args.test:
         unittest.main(argv=['program_selectory.py'])
     else:
-        main(Args)
\ No newline at end of file
+        main(Args)
@@ -0,0 +1,87 @@
+import sys,time,json,tracemalloc,cProfile
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+try:
+    import resource
+except ImportError:     # not available on windows
+    resource = None
+
+# [start, peak] of enclosing measurements, a nested measurement resets the tracemalloc peak
+_peaks = []
+
+def maxRssMB():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+@contextmanager
+def measure(record, traceMemory=False):
+    # fills record with wall and cpu time, peak memory allocated by python is traced on request only
+    started = traceMemory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        current,peak = tracemalloc.get_traced_memory()
+        if _peaks:
+            _peaks[-1][1] = max(_peaks[-1][1], peak)
+        tracemalloc.reset_peak()
+        _peaks.append([current, current])
+    t0,c0 = time.perf_counter(),time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_s'] = time.perf_counter() - t0
+        record['cpu_s'] = time.process_time() - c0
+        if tracing:
+            base,innerPeak = _peaks.pop()
+            peak = max(tracemalloc.get_traced_memory()[1], innerPeak)
+            record['peak_mb'] = (peak - base) / 2**20
+            if _peaks:
+                _peaks[-1][1] = max(_peaks[-1][1], peak)
+        record['max_rss_mb'] = maxRssMB()
+        if started:
+            tracemalloc.stop()
+
+class Metrics:
+    def __init__(self, program, traceMemory=False, profile=None):
+        self.program = program
+        self.traceMemory = traceMemory
+        self.profileStage = profile
+        self.profiles = {}
+        self.stages = {}
+        self.suppliers = {}
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        record = self.stages.setdefault(name, {})
+        if rows is not None:
+            record['rows'] = rows
+        with measure(record, self.traceMemory):
+            if name == self.profileStage:
+                prof = self.profiles[name] = cProfile.Profile()
+                with prof:
+                    yield record
+            else:
+                yield record
+
+    def supplier(self, name):
+        return self.suppliers.setdefault(name, {})
+
+    def profileFilename(self, metricsFn, stage):
+        metricsFn = Path(metricsFn)
+        return metricsFn.with_name(f'{metricsFn.stem}_{stage}.prof')
+
+    def save(self, metricsFn):
+        report = {
+            'program'   : self.program,
+            'timestamp' : datetime.now().isoformat(timespec='seconds'),
+            'stages'    : self.stages,
+            'suppliers' : self.suppliers,
+        }
+        with open(metricsFn,'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        for stage,prof in self.profiles.items():
+            prof.dump_stats(self.profileFilename(metricsFn, stage))
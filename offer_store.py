@@ -0,0 +1,173 @@
+import json,sqlite3,argparse,itertools
+from datetime import datetime
+from pathlib import Path
+from output import TableWriter,BATCH_ROWS,OUTPUT_FORMATS
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    availability_weight REAL NOT NULL,
+    suppliers TEXT NOT NULL,
+    columns TEXT NOT NULL,
+    first_offer INTEGER NOT NULL,
+    offers INTEGER NOT NULL,
+    selected INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS offers (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    seq INTEGER NOT NULL,
+    supplier TEXT NOT NULL,
+    sku_key TEXT NOT NULL,
+    sku TEXT NOT NULL,
+    price REAL,
+    tot_cost REAL,
+    avail_lo INTEGER,
+    avail_hi INTEGER,
+    availability,
+    extra TEXT,
+    selected INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS offers_sku ON offers(sku_key);
+CREATE INDEX IF NOT EXISTS offers_supplier ON offers(supplier);
+'''
+# offers of a run occupy a contiguous rowid range, selected offers first in the order of the result file,
+# so a run is read by a rowid range scan and the result file is its first `selected` rows
+# extra holds values of optional columns joined with \x1f, names of the columns per supplier are kept in runs.columns
+SEP = '\x1f'
+
+# offers of one run ranked per sku the same way as selection.selectItems ranks them:
+# in stock first, then price+shipping lowered by availability_weight per item surely in stock, then supplier order
+RANKED = '''
+SELECT *, ROW_NUMBER() OVER (PARTITION BY sku_key ORDER BY avail_hi <= 0, tot_cost - :weight * avail_lo, seq) AS rank
+FROM offers WHERE rowid BETWEEN :first AND :last
+'''
+
+class OfferStore:
+    def __init__(self, fn):
+        self.fn = Path(fn)
+        self.db = sqlite3.connect(self.fn)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA cache_size=-65536')
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def addRun(self, Items, SelectedItems, availabilityWeight=0, timestamp=None):
+        # bulk loads offers of all suppliers in one transaction, returns the run id
+        timestamp = timestamp or datetime.now().isoformat(timespec='seconds')
+        seq = {name : i for i,name in enumerate(Items.keys())}
+        columns = {}
+        for name,items in Items.items():
+            for item in items.values():
+                columns[name] = item.layout
+                break
+        with self.db:
+            # the write lock is taken before the first free rowid is read, a run added by another process waits for this one
+            self.db.execute('BEGIN IMMEDIATE')
+            first = self.db.execute('SELECT COALESCE(MAX(rowid), 0) + 1 FROM offers').fetchone()[0]
+            run = self.db.execute('INSERT INTO runs VALUES (NULL,?,?,?,?,?,?,?)', (timestamp, availabilityWeight, json.dumps(list(Items.keys())),
+                                  json.dumps(columns), first, sum(len(items) for items in Items.values()), len(SelectedItems))).lastrowid
+            insert = 'INSERT INTO offers (rowid,run,seq,supplier,sku_key,sku,price,tot_cost,avail_lo,avail_hi,availability,extra,selected) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)'
+            rowid = itertools.count(first)
+            self.db.executemany(insert, ((next(rowid), run, seq.get(i.supplier, -1), i.supplier, key, i.sku, i.price, i.tot_cost, i.avail_lo, i.avail_hi,
+                                          i.orig_availability, SEP.join(i.values), 1) for key,i in SelectedItems.items()))
+            for name,items in Items.items():
+                # every supplier has one offer per sku, the selected one is already stored
+                self.db.executemany(insert, ((next(rowid), run, seq[name], name, key, i.sku, i.price, i.tot_cost, i.avail_lo, i.avail_hi,
+                                              i.orig_availability, SEP.join(i.values), 0)
+                                             for key,i in items.items() if SelectedItems[key].supplier != name))
+        return run
+
+    def run(self, run=None):
+        if run is None:
+            return self.db.execute('SELECT * FROM runs ORDER BY id DESC LIMIT 1').fetchone()
+        return self.db.execute('SELECT * FROM runs WHERE id = ?', (run,)).fetchone()
+
+    def runs(self):
+        return self.db.execute('SELECT id, timestamp, availability_weight, suppliers, offers, selected FROM runs ORDER BY id').fetchall()
+
+    def span(self, run):
+        return {'first' : run['first_offer'], 'last' : run['first_offer'] + run['offers'] - 1}
+
+    def best(self, run, topK=1, availabilityWeight=None):
+        # top K offers of every sku, best first, skus in sku_key order
+        weight = run['availability_weight'] if availabilityWeight is None else availabilityWeight
+        return self.db.execute(f'SELECT * FROM ({RANKED}) WHERE rank <= :k ORDER BY sku_key, rank', dict(self.span(run), weight=weight, k=topK))
+
+    def history(self, skuKey):
+        # every offer of a sku over all runs
+        return self.db.execute('SELECT runs.timestamp, offers.* FROM offers JOIN runs ON runs.id = offers.run '
+                               'WHERE sku_key = ? ORDER BY offers.rowid', (skuKey,)).fetchall()
+
+    def above(self, run, price):
+        return self.db.execute('SELECT * FROM offers WHERE rowid BETWEEN :first AND :last AND price > :price ORDER BY price DESC',
+                               dict(self.span(run), price=price)).fetchall()
+
+    def wins(self, run):
+        # number of skus won by every supplier
+        return self.db.execute('SELECT supplier, COUNT(*) AS skus FROM offers WHERE rowid BETWEEN :first AND :first + :selected - 1 '
+                               'GROUP BY supplier ORDER BY skus DESC', {'first' : run['first_offer'], 'selected' : run['selected']}).fetchall()
+
+    def export(self, run, fn, encoding=None, format='csv'):
+        # selected offers streamed to a result file in the same layout as writeResult
+        cursor = self.db.cursor()
+        cursor.row_factory = None
+        cursor.execute('SELECT sku, supplier, price, tot_cost, availability, extra FROM offers WHERE rowid BETWEEN ? AND ?',
+                       (run['first_offer'], run['first_offer'] + run['selected'] - 1))
+        batch = cursor.fetchmany(BATCH_ROWS)
+        columns = [('sku','sku'),('supplier','str'),('price','num'),('price+shipping','num'),('availability','str')]
+        layout = json.loads(run['columns']).get(batch[0][1], []) if batch else []
+        columns += [(n,'str') for n in layout]
+        row = (lambda r: r[:5] + tuple(r[5].split(SEP))) if layout else (lambda r: r[:5])
+        with TableWriter(fn, columns, encoding, format) as outf:
+            while batch:
+                outf.write(batch, row)
+                batch = cursor.fetchmany(BATCH_ROWS)
+
+def printRows(rows):
+    for r in rows:
+        print('\t'.join(str(r[k]) for k in r.keys()))
+
+if __name__ == '__main__':
+    from common import makeTranslateSku,readConfig
+    parser = argparse.ArgumentParser(description="queries the offer store written by product_selector -store")
+    parser.add_argument("store",type=Path,help="offer store file")
+    parser.add_argument("-cfg",type=Path,help="config file, sku settings are used to normalize queried skus")
+    parser.add_argument("-run",type=int,help="run id, defaults to the last run")
+    parser.add_argument("-runs",action='store_true',help="list runs")
+    parser.add_argument("-history",type=str,help="offers of the sku over all runs")
+    parser.add_argument("-above",type=float,help="offers priced above the given price")
+    parser.add_argument("-wins",action='store_true',help="number of skus won by every supplier")
+    parser.add_argument("-best",type=int,help="best K offers of every sku")
+    parser.add_argument("-export",type=Path,help="write selected offers of the run to a result file")
+    parser.add_argument("-format",choices=OUTPUT_FORMATS,default='csv',help="format of the exported file")
+    Args = parser.parse_args()
+    Cfg = readConfig(Args, lambda txt: None) or {}
+    translateSku = makeTranslateSku(Cfg.get('sku_chars_to_remove') or '', Cfg.get('sku_ignore_case', True) is not False)
+    with OfferStore(Args.store) as store:
+        run = store.run(Args.run)
+        if Args.runs:
+            printRows(store.runs())
+        if Args.history is not None:
+            printRows(store.history(translateSku(Args.history)))
+        if run is None:
+            print(f'no runs in {Args.store}')
+        else:
+            if Args.above is not None:
+                printRows(store.above(run, Args.above))
+            if Args.wins:
+                printRows(store.wins(run))
+            if Args.best is not None:
+                printRows(store.best(run, Args.best))
+            if Args.export is not None:
+                store.export(run, Args.export, None, Args.format)
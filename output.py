@@ -0,0 +1,171 @@
+import os,io,re,sys,gzip,json,queue,struct,threading
+from array import array
+from itertools import islice
+from pathlib import Path
+
+OUTPUT_FORMATS = ('csv','gzip','binary')
+# column kinds: 'sku' always quoted, 'str' quoted when needed, 'num' written as is
+BINARY_MAGIC = b'PSCOL1\n'
+BATCH_ROWS = 4096
+# formatted batches a background writer may fall behind
+WRITE_QUEUE = 8
+
+_needsQuoting = re.compile('[,"\r\n]').search
+
+# field formatters, each one decides whether its value needs quoting
+def quoteAlways(v):
+    return '"' + str(v).replace('"','""') + '"'
+
+def quoteMinimal(v):
+    v = str(v)
+    return '"' + v.replace('"','""') + '"' if _needsQuoting(v) else v
+
+def csvLine(formats, row):
+    return ','.join([f(v) for f,v in zip(formats,row)]) + '\n'
+
+def csvText(formats, rows):
+    # csv lines of rows formatted column by column, a column is searched once for values needing quotes
+    # and formatted value by value only when it has some, rows of another width are formatted line by line
+    if any(len(r) != len(formats) for r in rows):
+        return ''.join([csvLine(formats, r) for r in rows])
+    cols = []
+    for f,col in zip(formats, zip(*rows)):
+        col = list(map(str, col))
+        if f is quoteAlways:
+            col = [f'"{v}"' for v in col] if '"' not in ''.join(col) else list(map(quoteAlways, col))
+        elif f is quoteMinimal and _needsQuoting(''.join(col)):
+            col = list(map(quoteMinimal, col))
+        cols.append(col)
+    return ''.join([','.join(line) + '\n' for line in zip(*cols)])
+
+def batches(records, size=BATCH_ROWS):
+    records = iter(records)
+    while batch := list(islice(records, size)):
+        yield batch
+
+def littleEndian(arr):
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+def readBinary(fn):
+    # returns {column name : list of values}
+    with open(fn,'rb') as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError(f'{fn} is not a binary columnar file')
+        header = json.loads(f.read(struct.unpack('<Q', f.read(8))[0]))
+        n = header['rows']
+        Columns = {}
+        for col in header['columns']:
+            if col['type'] == 'num':
+                arr = array('d')
+                arr.frombytes(f.read(8*n))
+                Columns[col['name']] = littleEndian(arr).tolist()
+            else:
+                offsets = array('Q')
+                offsets.frombytes(f.read(8*(n+1)))
+                offsets = littleEndian(offsets)
+                data = f.read(offsets[-1])
+                Columns[col['name']] = [data[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(n)]
+        return Columns
+
+class TableWriter:
+    # writes a table to a temporary file renamed into place on success, readers never see a partial file
+    # columns : list of (name, kind), kind 'sku' is always quoted, 'str' quoted when needed, 'num' written as is
+    # background - csv text is encoded, compressed and written by a thread of its own while the caller formats the next batch
+    def __init__(self, fn, columns, encoding=None, format='csv', background=False):
+        if format not in OUTPUT_FORMATS:
+            raise ValueError(f'unknown output format {format}')
+        self.fn = Path(fn)
+        self.columns = columns
+        self.encoding = encoding
+        self.format = format
+        self.csv = format != 'binary'
+        self.formats = [quoteAlways if kind=='sku' else (str if kind=='num' else quoteMinimal) for _,kind in columns]
+        self.values = [[] for _ in columns]
+        self.background = background and self.csv
+        self.thread = None
+        self.error = None
+
+    def __enter__(self):
+        self.tmp = self.fn.with_name(f'{self.fn.name}.{os.getpid()}.tmp')
+        if self.format == 'csv':
+            self.outf = open(self.tmp,'w',encoding=self.encoding,buffering=1<<20)
+        elif self.format == 'gzip':
+            # name stored in the gzip header is the final one, not the temporary one
+            self.raw = open(self.tmp,'wb')
+            self.outf = io.TextIOWrapper(gzip.GzipFile(self.fn.name, 'wb', 6, self.raw), encoding=self.encoding)
+        else:
+            self.outf = open(self.tmp,'wb',buffering=1<<20)
+        if self.csv:
+            self.outf.write(','.join(name for name,_ in self.columns) + '\n')
+        if self.background:
+            self.pending = queue.Queue(WRITE_QUEUE)
+            self.thread = threading.Thread(target=self.flushing, daemon=True)
+            self.thread.start()
+        return self
+
+    def flushing(self):
+        # a failed write is raised by __exit__, later batches are taken off the queue and dropped
+        while (text := self.pending.get()) is not None:
+            if self.error is None:
+                try:
+                    self.outf.write(text)
+                except BaseException as e:
+                    self.error = e
+
+    def write(self, batch, row):
+        # row makes a tuple of column values from a record
+        if not self.csv:
+            for r in batch:
+                for col,v in zip(self.values,row(r)):
+                    col.append(v)
+            return
+        text = csvText(self.formats, list(map(row, batch)))
+        if self.thread is not None:
+            self.pending.put(text)
+        else:
+            self.outf.write(text)
+
+    def writeBinary(self):
+        # header line with json column descriptions, then every column as a contiguous block
+        # num columns are float64, str columns are uint64 offsets followed by utf-8 data
+        header = {'columns' : [{'name' : name, 'type' : 'num' if kind=='num' else 'str'} for name,kind in self.columns],
+                  'rows' : len(self.values[0]) if self.values else 0}
+        hdr = json.dumps(header).encode()
+        self.outf.write(BINARY_MAGIC + struct.pack('<Q', len(hdr)) + hdr)
+        for (_,kind),col in zip(self.columns,self.values):
+            if kind == 'num':
+                self.outf.write(littleEndian(array('d', col)).tobytes())
+            else:
+                data = [str(v).encode('utf-8') for v in col]
+                offsets = array('Q', [0])
+                pos = 0
+                for d in data:
+                    pos += len(d)
+                    offsets.append(pos)
+                self.outf.write(littleEndian(offsets).tobytes())
+                self.outf.write(b''.join(data))
+
+    def __exit__(self, exc_type, exc, tb):
+        # the temporary file is closed whatever fails, renamed into place only when everything is written, removed otherwise
+        try:
+            try:
+                if self.thread is not None:
+                    self.pending.put(None)
+                    self.thread.join()
+                    if self.error is not None and exc_type is None:
+                        raise self.error
+                if exc_type is None and not self.csv:
+                    self.writeBinary()
+            finally:
+                try:
+                    self.outf.close()
+                finally:
+                    if self.format == 'gzip':
+                        self.raw.close()
+            if exc_type is None:
+                os.replace(self.tmp, self.fn)
+        finally:
+            if self.tmp.exists():
+                self.tmp.unlink()
@@ -1,8 +1,14 @@
-import sys,argparse,re,unittest
+import sys,os,argparse,re,unittest,tempfile,json,pickle,csv,gzip,heapq
 from pathlib import Path
-from collections import namedtuple
 from datetime import datetime
 from common import *
+import common,columnar
+from metrics import Metrics
+from output import TableWriter,batches,readBinary,OUTPUT_FORMATS
+from selection import *
+from sku_search import getIndex
+from offer_store import OfferStore
+from fetcher import FeedFetcher
 
 
 def createSplitter(line):
@@ -59,84 +65,178 @@ def compareAvailability(a, b):
     elif rb[1] < ra[1]: return 1
     else: return 0
 
-def selectItems(Items, verbose):
-    SelectedItems = {}
-    Duplicates = []
-    verbose('adding items')
-    itemsCnt = 0
-    for f,items in Items.items():
-        dupCnt=0
-        t0 = datetime.utcnow()
-        for name,item in items.items():
-            selName,selItem = findMatching(SelectedItems, name)
-            if selName is not None:
-                Duplicates.append( (item,selItem) )
-                dupCnt += 1
-                if item.tot_cost < selItem.tot_cost and item.availability[1]>0:# compareAvailability(item.availability, selItem.availability)>=0:
-                    SelectedItems[name] = item   
-            else:
-                SelectedItems[name]=item
-        dt = datetime.utcnow() - t0
-        totItems = len(SelectedItems)
-        verbose(f'\tfile {f } : {dupCnt} duplicates, added {totItems-itemsCnt} items, total items {totItems} time {dt}')
-        itemsCnt = totItems
-    return SelectedItems, Duplicates
-
-def writeResult(SelectedItems,outputFn, encoding=None):
-    with open(outputFn,'w',encoding=encoding) as outf:
-        row = 'sku,supplier,price,price+shipping,availability'
-        for i in SelectedItems.values():
-            for n in i.optionalColumns.keys():
-                row += ','+n
-            break
-        outf.write(row+'\n')
-        for item in SelectedItems.values():
-            row = f'"{item.sku}",{item.supplier},{item.price},{item.tot_cost},{item.orig_availability}'
-            for v in item.optionalColumns.values():
-                row += ',' + v
-            outf.write(row + '\n')
-
-def writeDuplicates(Duplicates, duplicatesFn, encoding=None):
-    if duplicatesFn is not None:
-        with open(duplicatesFn,'w',encoding=encoding) as outf:
-            outf.write('sku 1,supplier 1,sku 2,supplier 2,price 1,total cost 1,price 2,total cost 2,availability 1,availability 2\n')
-            for i1,i2 in Duplicates:
-                outf.write( f'"{i1.sku}",{i1.supplier},"{i2.sku}",{i2.supplier},{i1.price},{i1.tot_cost},{i2.price},{i2.tot_cost},{i1.orig_availability},{i2.orig_availability}\n' )
+def loadSnapshot(snapshotFn, verbose):
+    try:
+        with open(snapshotFn,'rb') as f:
+            Snapshot = pickle.load(f)
+        verbose(f'snapshot {snapshotFn} loaded')
+        return Snapshot
+    except FileNotFoundError:
+        verbose(f'snapshot {snapshotFn} not found, selecting all items')
+    except Exception as e:
+        verbose(f'snapshot {snapshotFn} unreadable ({e}), selecting all items')
+    return None
+
+def saveSnapshot(snapshotFn, Items, SelectedItems):
+    tmp = Path(str(snapshotFn) + '.tmp')
+    with open(tmp,'wb') as f:
+        pickle.dump( {'items' : Items, 'selected' : SelectedItems}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, snapshotFn)
 
-def writeNames(Items, allnamesFn,encoding=None):   
-    if allnamesFn is not None:
-        with open(allnamesFn,'w',encoding=encoding) as outf:
-            outf.write('sku,supplier\n')
-            for itms in Items.values():
-                for i in itms.values():
-                    outf.write(f'"{i.sku}",{i.supplier}\n')
 
+# options of a single full run, batch and memory limited runs have no use for them
+FULL_RUN_ARGS = ('search','store','delta','fetch')
 
+def incompatibleArgs(Args, mode):
+    used = [f'-{a}' for a in FULL_RUN_ARGS if getattr(Args, a, None)]
+    if used:
+        # reported as a usage error
+        print(f'product_selector.py: error: {", ".join(used)} cannot be used with {mode}', file=sys.stderr)
+    return bool(used)
 
 def main(Args):
     verbose = makeVerbose(Args)
-    Cfg,Suppliers = prepareInputs(Args,verbose)
+    if Args.batch is not None:
+        if incompatibleArgs(Args, '-batch'):
+            sys.exit(2)
+        from batch import runBatch
+        runBatch(Args, Args.batch, verbose)
+        return
+    metrics = Metrics('product_selector', Args.metrics_memory, Args.profile)
+    with metrics.stage('prepareInputs'):
+        Cfg,Suppliers = prepareInputs(Args,verbose)
+    if Args.serve is not None:
+        from server import serve
+        serve(Args.serve, Cfg, Suppliers, Args.dir, verbose)
+        return
+    if Args.search is not None:
+        searchSku(Args.search, Cfg, Suppliers, Args.search_limit, verbose)
+        return
 
     outputFn = Path(Cfg[fOutputFilename])
+    if Cfg['memory_limit_mb'] is not None:
+        if incompatibleArgs(Args, 'memory limited mode'):
+            sys.exit(2)
+        from spill import selectSpilled
+        with metrics.stage('selectSpilled'):
+            selectSpilled(Cfg, Suppliers, verbose)
+        saveMetrics(metrics, Cfg, Args, outputFn, verbose)
+        return
     duplicatesFn = Cfg[fDuplicatesFilename]
     allnamesFn = Cfg[fAllNamesFilename]
     encodings = Cfg['encodings']
-    Items,output_encoding = LoadItems(Suppliers, encodings, verbose)
+    outputFormat = Cfg['output_format']
+    snapshotFn = Cfg[fSnapshotFilename]
+    fetcher = None
+    Sources = {name : (supp.url, supp.data) for name,supp in Suppliers.items() if supp.url is not None}
+    streaming = Cfg['streaming'] and snapshotFn is None and not Sources
+    if Cfg['streaming'] and not streaming:
+        verbose('streaming is not used with delta mode nor downloads, loading all datafeeds first')
+    if Sources:
+        # datafeeds are parsed while the others are still downloading
+        fetcher = FeedFetcher(Sources, Cfg['fetch_state_filename'], verbose, Cfg['fetch_timeout']).start()
+    if streaming:
+        # offers are selected as the background loader parses them
+        with metrics.stage('selectStreaming') as stage:
+            output_encoding = OutputEncoding(verbose)
+            Items,SelectedItems,Offers = selectOffers(iterSupplierOffers(Suppliers, encodings, verbose, output_encoding, metrics), Suppliers.keys(),
+                                                      verbose, Cfg['top_k'], Cfg['availability_weight'])
+            output_encoding = output_encoding.value
+            stage['rows'] = sum(s.get('rows',0) for s in metrics.suppliers.values())
+    else:
+        with metrics.stage('LoadItems') as stage:
+            Items,output_encoding = LoadItems(Suppliers, encodings, verbose, Cfg['parallel_loading'], Cfg['loading_workers'], metrics,
+                                              fetcher.ready(Suppliers.keys()) if fetcher is not None else None)
+            stage['rows'] = sum(s.get('rows',0) for s in metrics.suppliers.values())
+    if fetcher is not None:
+        for name,result in fetcher.results.items():
+            metrics.supplier(name)['fetch'] = result
+        verbose(f'changed datafeeds : {", ".join(fetcher.changed()) or "none"}')
+    offers = sum(len(items) for items in Items.values())
     
-    SelectedItems,Duplicates = selectItems(Items, verbose)
+    if snapshotFn is not None:
+        with metrics.stage('selectItemsDelta', offers):
+            Snapshot = loadSnapshot(snapshotFn, verbose)
+            SelectedItems,Offers,Changes = selectItemsDelta(Items, Snapshot, verbose, Cfg['top_k'], Cfg['availability_weight'])
+        if Offers is None:
+            if duplicatesFn is not None:
+                verbose('duplicates file is written only when all items are selected, skipping')
+            Offers = {}
+    elif not streaming:
+        with metrics.stage('selectItems', offers):
+            SelectedItems,Offers = selectItems(Items, verbose, Cfg['top_k'], Cfg['availability_weight'])
     verbose(f'using {output_encoding} as output encoding')
-    writeResult(SelectedItems,outputFn, output_encoding)
-    writeDuplicates(Duplicates, duplicatesFn, output_encoding)
-    writeNames(Items, allnamesFn, output_encoding)
+    with metrics.stage('writeResult', len(SelectedItems)):
+        writeResult(SelectedItems,outputFn, output_encoding, outputFormat, streaming)
+    if duplicatesFn is not None:
+        with metrics.stage('writeDuplicates', sum(len(o)-1 for o in Offers.values())):
+            writeDuplicates(Offers, duplicatesFn, output_encoding, outputFormat, streaming)
+    if allnamesFn is not None:
+        with metrics.stage('writeNames', offers):
+            writeNames(Items, allnamesFn, output_encoding, outputFormat, streaming)
+    if Args.memory_report:
+        offerMemoryReport(Items, print)
+    if snapshotFn is not None:
+        with metrics.stage('writeChanges', len(Changes)):
+            writeChanges(Changes, Cfg[fChangesFilename], output_encoding, outputFormat)
+        with metrics.stage('saveSnapshot', offers):
+            saveSnapshot(snapshotFn, Items, SelectedItems)
+    storeFn = Cfg['store_filename']
+    if storeFn is not None:
+        with metrics.stage('storeOffers', offers):
+            with OfferStore(storeFn) as store:
+                run = store.addRun(Items, SelectedItems, Cfg['availability_weight'])
+        verbose(f'offers saved to {storeFn} as run {run}')
+    saveMetrics(metrics, Cfg, Args, outputFn, verbose)
 
-    if Args.search is not None:
-        sit = Args.search.lower()
+def saveMetrics(metrics, Cfg, Args, outputFn, verbose):
+    metricsFn = Cfg[fMetricsFilename]
+    if metricsFn is None and Args.profile is not None:
+        metricsFn = outputFn.with_name(outputFn.stem + '_metrics.json')
+    if metricsFn is not None:
+        metrics.save(metricsFn)
+        verbose(f'metrics saved to {metricsFn}')
+
+def searchSku(query, Cfg, Suppliers, limit, verbose):
+    # datafeeds are loaded, nothing is selected nor written, only offers of found skus are ranked
+    Items,_ = LoadItems(Suppliers, Cfg['encodings'], verbose, Cfg['parallel_loading'], Cfg['loading_workers'])
+    rankOffer = makeRankOffer(Items.keys(), Cfg['availability_weight'])
+    index = getIndex(Cfg['search_index_filename'], Suppliers, Items, Cfg['encodings'], verbose)
+    t0 = datetime.utcnow()
+    q = makeTranslateSku(Cfg['sku_chars_to_remove'], Cfg['sku_ignore_case'])(query)
+    results = index.search(q, limit)
+    verbose(f'search for {q} time {datetime.utcnow()-t0}')
+    if not results:
+        print(f'item {query} not found')
+    for kind,dist,sku in results:
+        print(f'{sku} ({kind}{f" {dist} typos" if dist else ""})')
+        selItem = selectOffer((vals[sku] for vals in Items.values() if sku in vals), rankOffer)
         for sn,vals in Items.items():
-            if sit in vals:
-                print( f'item {Args.search} in {sn}')
-        if sit in SelectedItems:
-            print( f'item {Args.search} in selected items')
+            if sku in vals:
+                item = vals[sku]
+                selected = ' selected' if selItem is item else ''
+                print(f'\t{sn} "{item.sku}" price {item.price} price+shipping {item.tot_cost} availability {item.orig_availability}{selected}')
+
 
+def writeTestConfig(d, suppliers, **settings):
+    # config.json of the repo saved to the test directory d with only the given suppliers, suppliers are {name : {setting : value}}
+    # merged with the supplier's own settings, other settings replace top level ones, the feed cache is off unless set
+    cfg = json.loads((Path(__file__).parent/'config.json').read_text())
+    cfg['suppliers'] = {name : dict(cfg['suppliers'][name], **overrides) for name,overrides in suppliers.items()}
+    cfg['cache_dir'] = None
+    cfg.update(settings)
+    (d/'config.json').write_text(json.dumps(cfg))
+    return cfg
+
+def prepareTestInputs(d, suppliers, feeds={}, args={}, **settings):
+    # feeds are {file name : text} saved as utf-8, args are command line arguments, returns Cfg,Suppliers of the test directory
+    for fn,text in feeds.items():
+        (d/fn).write_text(text, encoding='utf-8')
+    writeTestConfig(d, suppliers, **settings)
+    return prepareInputs(argparse.Namespace(**{'dir' : d, 'cfg' : d/'config.json', 'output' : None, **args}), lambda txt: None)
+
+# Leader and Synnex reading the datafeeds of TestColumnarEngine
+LEADER_SYNNEX = {'Leader' : {}, 'Synnex' : {'data' : 'synnex.txt'}}
 
 class TestShippingRules(unittest.TestCase):
     def test_1(self):
@@ -175,17 +275,747 @@ class TestShippingRules(unittest.TestCase):
         self.assertEqual(calc_shc(300,  15),    15)
         self.assertEqual(calc_shc(300.1,15),    0)
 
+    def test_overlapping_ranges(self):
+        calc_shc = loadShippingCostRules({ "2-4kg" : 9, "0-10kg" : 5, "per_product" : 1 })
+        self.assertEqual(calc_shc(1,    3),     6)
+        self.assertEqual(calc_shc(1,    10),    6)
+        self.assertEqual(calc_shc(1,    10.5),  1)
+
+    def test_batch(self):
+        for rules in ({ ">5kg" : 25, "3-5kg" : 17.5, "0-3kg" : 12, "NA" : 15, "free" : ">1000$" },
+                      { "per_product" : 15, "free" : ">300$", "NA" : 10 },
+                      { "2-4kg" : 9, "0-10kg" : 5, "per_product" : 1, "NA" : 3 }):
+            calc_shc = loadShippingCostRules(rules)
+            calc_batch = loadBatchShippingCostRules(rules)
+            prices  = [1,    1, 1, 3, 3.01, 5, 5.01, 15, 999, 1000, 1000.1, 1000.1, 300, 300.1, 300.1]
+            weights = [None, 0, 3, 3, 3.01, 5, 5.01, 15, 0,   15,   0,      None,   15,  15,    None]
+            self.assertEqual(list(calc_batch(prices, weights)), [calc_shc(p,w) for p,w in zip(prices,weights)])
+
+    def test_missing_weight_without_na_rule(self):
+        rules = { "0-3kg" : 12, "free" : ">100$" }
+        calc_shc = loadShippingCostRules(rules)
+        calc_batch = loadBatchShippingCostRules(rules)
+        self.assertEqual(calc_shc(101, None), 0)
+        self.assertEqual(list(calc_batch([101, 1], [None, 2])), [0, 12])
+        for calc in (lambda: calc_shc(1, None), lambda: calc_batch([1, 101], [None, None])):
+            with self.assertRaises(ShippingRuleError) as e:
+                calc()
+            self.assertEqual(str(e.exception), MISSING_WEIGHT)
+
+class TestEncodingDetection(unittest.TestCase):
+    def test_order_fallback_and_reuse(self):
+        with tempfile.TemporaryDirectory() as d:
+            fn = Path(d)/'feed.csv'
+            encodings = ['utf-8', 'ISO-8859-1', 'cp1252']
+            fn.write_bytes('"sku","price"\n"Straße","1"\n'.encode('cp1252'))
+            # candidates decoding the file are returned in the configured order
+            self.assertEqual(detectEncodings(fn, encodings), ['ISO-8859-1', 'cp1252'])
+            self.assertEqual(detectEncodings(fn, ['cp1252', 'utf-8', 'ISO-8859-1']), ['cp1252', 'ISO-8859-1'])
+            # same size and mtime, the earlier detection is reused, a changed file is detected again and replaces it
+            st = fn.stat()
+            fn.write_bytes('"sku","price"\n"Strasse","1"\n'.encode('cp1252')[:st.st_size])
+            os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns))
+            self.assertEqual(detectEncodings(fn, encodings), ['ISO-8859-1', 'cp1252'])
+            os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            self.assertEqual(detectEncodings(fn, encodings), encodings)
+            self.assertEqual(sum(key[0] == str(fn) for key in common._encodingCache), 2)
+            # encodings rejected by the detection are tried after the detected ones fail
+            fn.write_bytes('"sku","price"\n"Straße","1"\n'.encode('cp1252'))
+            tried = []
+            def load(supplier_def, encoding, verbose, stats):
+                tried.append(encoding)
+                if encoding != 'utf-8':
+                    raise UnicodeDecodeError(encoding, b'', 0, 1, 'test')
+                return {}
+            self.assertEqual(common._loadItemsDetectEncoding(argparse.Namespace(data=fn), encodings, lambda txt: None, None, load), ({}, 'utf-8'))
+            self.assertEqual(tried, ['ISO-8859-1', 'cp1252', 'utf-8'])
+            common.ENCODING_CACHE_SIZE,size = 1,common.ENCODING_CACHE_SIZE
+            try:
+                detectEncodings(fn, ['cp1252'])
+                self.assertEqual(list(common._encodingCache), [(str(fn), ('cp1252',))])
+            finally:
+                common.ENCODING_CACHE_SIZE = size
+
+class TestFeedCache(unittest.TestCase):
+    def load(self, d, encodings=None, **settings):
+        Cfg,Suppliers = prepareTestInputs(d, {'Leader' : settings}, cache_dir=str(d/'cache'))
+        log = []
+        Items,_ = LoadItems(Suppliers, encodings or Cfg['encodings'], log.append)
+        return Items['Leader'],log,any('from cache' in txt for txt in log)
+
+    def test_hits_and_invalidation(self):
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            fn = d/'LNR45_1.csv'
+            fn.write_text(TestColumnarEngine.Leader, encoding='utf-8')
+            items,log,hit = self.load(d)
+            self.assertFalse(hit)
+            cached,cachedLog,hit = self.load(d)
+            self.assertTrue(hit)
+            self.assertEqual(list(cached.items()), list(items.items()))
+            # the replayed summary is the summary of the parse
+            summary = lambda log: [txt for txt in log if 'time' not in txt and 'decodes as' not in txt]
+            self.assertEqual(summary(cachedLog), summary(log))
+            # parse settings and encodings are part of the key
+            _,_,hit = self.load(d, shipping_rules={'NA' : 99})
+            self.assertFalse(hit)
+            _,_,hit = self.load(d, ['utf-8', 'cp1252'])
+            self.assertFalse(hit)
+            _,_,hit = self.load(d)
+            self.assertTrue(hit)
+            # other content of the same size and mtime
+            st = fn.stat()
+            fn.write_text(TestColumnarEngine.Leader.replace('"19.5"', '"19.7"'), encoding='utf-8')
+            os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns))
+            changed,_,hit = self.load(d)
+            self.assertFalse(hit)
+            self.assertEqual(changed['archert4e'].price, 19.7)
+
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache = FeedCache(Path(d), maxMB=None)
+            for i,key in enumerate(['a', 'b', 'c']):
+                cache.store(key, bytes(range(256)) * 40)
+                os.utime(cache.path(key), (1e9+i, 1e9+i))
+            size = cache.path('a').stat().st_size
+            self.assertIsNotNone(cache.load('a'))      # a is used again, b is the least recently used
+            cache.maxBytes = 3 * size
+            cache.store('d', bytes(range(256)) * 40)
+            self.assertEqual(sorted(fn.stem for fn in Path(d).glob('*.bin')), ['a', 'c', 'd'])
+
+class TestColumnarEngine(unittest.TestCase):
+    Leader = ('"MANUFACTURER SKU","DBP","AT","weight","BAR CODE"\n'
+              '"PRIME B450M-K","100.5","5","1.5","111"\n'
+              '" Archer T4E ","20","B","","222"\n'
+              '"ARCHER-T4E","19.5",">10","7","333"\n'
+              '"","10","1","1","444"\n'
+              '"ZERO","0","1","1","555"\n'
+              '"NOPRICE","n/a","<5","2","666"\n'
+              '"SHORT","1"\n'
+              '"EMPTYAVAIL","1","","1","777"\n'
+              '"Straße","1200","3","4","888"\n'
+              '\n'
+              '"PRIME B450M-K","99","CALL","3","999"\n')
+    Synnex = ('SUPPLIER_PART_NUMBER\tRESELLER_BUY_EX\tAVAILABILITY_M\tAVAILABILITY_S\tweight\tUPC\n'
+              'PRIME-B450M-K\t90\t1\t>5\t\t1\n'
+              'X1\t10\t0\t0\t1\t2\n'
+              'X2\t10\t3-\tB\t1\t3\n'
+              'X3\t301\t2\t3\t9\t4\n'
+              'X4\t5\t2\n')
+
+    def load(self, engine, replace=None):
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            suppliers = {'Leader' : {} if replace is None else {'replace' : replace},
+                         'Synnex' : {'data' : 'synnex.txt', 'include_out_of_stock_items' : False}}
+            Cfg,Suppliers = prepareTestInputs(d, suppliers, {'LNR45_1.csv' : self.Leader, 'synnex.txt' : self.Synnex}, ingest_engine=engine)
+            summary = []
+            Items,encoding = LoadItems(Suppliers, Cfg['encodings'], summary.append)
+            return Items, [s.replace(str(d),'') for s in summary if 'time' not in s]
+
+    def test_null_replacements(self):
+        # a price replaced with null is an invalid price, a weight replaced with null is a missing weight
+        replace = {'price' : {'n/a' : None, '19.5' : None}, 'weight' : {'7' : None}}
+        rows,rowsSummary = self.load('rows', replace)
+        columnar,columnarSummary = self.load('columnar', replace)
+        self.assertEqual(rows, columnar)
+        self.assertEqual(rowsSummary, columnarSummary)
+        self.assertEqual(rows['Leader']['archert4e'].price, 20)
+
+    def synnexSupplier(self):
+        supp = Supplier()
+        supp.name,supp.replace,supp.sku_chars_to_remove,supp.sku_ignore_case = 'Synnex',{},' -',True
+        supp.include_0_priced_items,supp.include_out_of_stock_items = False,False
+        supp.columns = {'sku' : 'SUPPLIER_PART_NUMBER', 'price' : 'RESELLER_BUY_EX', 'availability' : 'AVAILABILITY_M+AVAILABILITY_S',
+                        'weight' : 'weight', 'ean' : 'UPC'}
+        supp.parse_workers,supp.parse_chunk_mb = 1,16
+        supp.setShippingRules({'0-5kg' : 10, 'NA' : 15})
+        supp.translateSku = makeTranslateSku(supp.sku_chars_to_remove, supp.sku_ignore_case)
+        return supp
+
+    def test_tab_bytes_same_as_csv(self):
+        supp = self.synnexSupplier()
+        loaded = []
+        with tempfile.TemporaryDirectory() as d:
+            # a quoted field sends the second feed to csv.reader
+            for i,feed in enumerate([self.Synnex, self.Synnex.replace('X3\t', '"X3"\t')]):
+                supp.data = Path(d)/'synnex.txt'
+                supp.data.write_bytes(feed.replace('\n','\r\n').encode('utf-8'))
+                with open(supp.data,'rb') as f, common.mmap.mmap(f.fileno(), 0, access=common.mmap.ACCESS_READ) as mm:
+                    self.assertEqual(canSplitTabBytes(mm, 'utf-8'), i==0)
+                summary = []
+                loaded.append( (common._loadItems(supp, 'utf-8', summary.append), [s.replace(d,'') for s in summary if 'time' not in s]) )
+        self.assertEqual(loaded[0], loaded[1])
+        self.assertEqual(sorted(loaded[0][0].keys()), ['primeb450mk','x3'])
+
+    def test_chunks_same_as_whole(self):
+        supp = self.synnexSupplier()
+        loaded = []
+        with tempfile.TemporaryDirectory() as d:
+            supp.data = Path(d)/'synnex.txt'
+            # the repeated sku in the last chunk replaces the earlier offer
+            supp.data.write_bytes((self.Synnex + self.Synnex.split('\n',1)[1] + 'X3\t250\t1\t1\t1\t5\n').encode('utf-8'))
+            for workers in (1,3):
+                supp.parse_workers,supp.parse_chunk_mb = workers,1e-5
+                stats = {}
+                loaded.append( (common._loadItems(supp, 'utf-8', lambda txt: None, stats), stats) )
+        (whole,wholeStats),(chunked,chunkedStats) = loaded
+        self.assertEqual(chunkedStats.pop('chunks'), 3)
+        self.assertEqual(chunkedStats, wholeStats)
+        self.assertEqual(list(chunked.items()), list(whole.items()))
+        self.assertEqual(chunked['x3'].price, 250)
+
+    @unittest.skipIf(columnar.np is None, 'numpy not available')
+    def test_same_as_rows(self):
+        rowItems,rowSummary = self.load('rows')
+        colItems,colSummary = self.load('columnar')
+        self.assertEqual(rowSummary, colSummary)
+        self.assertEqual(rowItems, colItems)
+        for supplier in rowItems:
+            self.assertEqual(list(rowItems[supplier].keys()), list(colItems[supplier].keys()))
+        self.assertEqual(colItems['Leader']['primeb450mk'].price, 99)
+        self.assertEqual(colItems['Synnex']['primeb450mk'].orig_availability, '1+>5')
+
+    @unittest.skipIf(columnar.np is None, 'numpy not available')
+    def test_bytes_same_as_csv_reader(self):
+        needed,maxIdx = [0,1,3,2],3
+        with tempfile.TemporaryDirectory() as d:
+            feed = Path(d)/'LNR45_1.csv'
+            feed.write_text(self.Leader, encoding='utf-8')
+            with open(feed, encoding='utf-8') as f:
+                reader = csv.reader(f)
+                next(reader)
+                expected = columnar.readColumnsCsv(reader, needed, maxIdx)
+            # blocks of a few lines each
+            cols,shortRows,rows = columnar.readColumnsBytes(feed, 'utf-8', ',', needed, maxIdx, blockSize=16)
+            self.assertEqual(([columnar.textColumn(c, 'utf-8', clean=False) for c in cols],shortRows,rows), expected)
+            self.assertEqual(columnar.textColumn(cols[0], 'utf-8')[1], 'Archer T4E')
+            # a separator inside quotes needs csv.reader
+            feed.write_text(self.Leader.replace('"20"', '"20,0"'), encoding='utf-8')
+            self.assertIsNone(columnar.readColumnsBytes(feed, 'utf-8', ',', needed, maxIdx))
+
+class TestOutputFormats(unittest.TestCase):
+    def test_formats(self):
+        items = {'a' : Item('A', 'sku,1', 10.5, 12.0, 5, 5, 5, ('ean','name'), ('1', 'say "hi"')),
+                 'b' : Item('B', 'sku2', 3.0, 3.0, 1, 9, '1+<9', ('ean','name'), ('2', 'plain'))}
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            writeResult(items, d/'out.csv')
+            writeResult(items, d/'out.csv.gz', format='gzip')
+            writeResult(items, d/'out.bin', format='binary')
+            text = (d/'out.csv').read_text()
+            self.assertEqual(gzip.decompress((d/'out.csv.gz').read_bytes()).decode(), text)
+            self.assertEqual(text.splitlines()[2], '"sku2",B,3.0,3.0,1+<9,2,plain')
+            rows = list(csv.reader(text.splitlines()))
+            columns = readBinary(d/'out.bin')
+            self.assertEqual(sorted(os.listdir(d)), ['out.bin','out.csv','out.csv.gz'])
+        self.assertEqual(rows[1], ['sku,1','A','10.5','12.0','5','1','say "hi"'])
+        self.assertEqual(list(columns.keys()), rows[0])
+        self.assertEqual(columns['sku'], ['sku,1','sku2'])
+        self.assertEqual(columns['price+shipping'], [12.0, 3.0])
+        self.assertEqual(columns['name'], ['say "hi"','plain'])
+
+    def test_quoting_checked_per_field(self):
+        # the comma inside 'Cable, 2m' is quoted, the item with a missing value is formatted on its own
+        items = {'a' : Item('A', 'sku1', 1.0, 1.0, 1, 1, '1', ('ean','name'), ('1', 'Cable, 2m')),
+                 'b' : Item('B', 'sku2', 2.0, 2.0, 1, 1, '1', ('ean',), ('2',))}
+        with tempfile.TemporaryDirectory() as d:
+            writeResult(items, Path(d)/'out.csv')
+            text = (Path(d)/'out.csv').read_text()
+        self.assertEqual(text.splitlines()[1:], ['"sku1",A,1.0,1.0,1,1,"Cable, 2m"', '"sku2",B,2.0,2.0,1,2'])
+
+    def test_failed_write_removes_file(self):
+        # a value the binary format cannot take, the temporary file is closed and removed before the error is raised
+        with tempfile.TemporaryDirectory() as d:
+            with self.assertRaises(TypeError):
+                with TableWriter(Path(d)/'out.bin', [('price','num')], format='binary') as outf:
+                    outf.write(['x'], lambda r: (r,))
+            self.assertTrue(outf.outf.closed)
+            self.assertEqual(os.listdir(d), [])
+
+class TestSkuSearch(unittest.TestCase):
+    def test_search(self):
+        import sku_search
+        Items = {'A' : dict.fromkeys(['primeb450mk','primeb450mplus','archert4e','rtx3060']), 'B' : dict.fromkeys(['primeb450mk','xprimeb450'])}
+        index = sku_search.SkuIndex(Items)
+        self.assertEqual(index.search('primeb450'), [('prefix',0,'primeb450mk'), ('prefix',0,'primeb450mplus'), ('substring',0,'xprimeb450')])
+        self.assertEqual(index.search('primeb450mk')[0], ('exact',0,'primeb450mk'))
+        self.assertEqual(index.search('archer4e'), [('fuzzy',1,'archert4e')])
+        self.assertEqual(index.search('rtx3600', maxTypos=2), [('fuzzy',2,'rtx3060')])
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            feed = d/'feed.csv'
+            feed.write_text('sku\nprimeb450mk\n')
+            sku_search.saveIndex(d/'idx', 'k1', [dict(sku_search.fileFingerprint(feed), file=str(feed))], index)
+            self.assertEqual(sku_search.loadIndex(d/'idx', 'k2', [feed]), (None,None))
+            loaded,fingerprints = sku_search.loadIndex(d/'idx', 'k1', [feed])
+            self.assertEqual(loaded.search('b450m'), index.search('b450m'))
+            self.assertIsNone(fingerprints)
+            # a touched datafeed is hashed again and its new mtime stored, a changed one makes the index stale
+            os.utime(feed, ns=(10**18, 10**18))
+            loaded,fingerprints = sku_search.loadIndex(d/'idx', 'k1', [feed])
+            self.assertIsNotNone(loaded)
+            self.assertEqual(fingerprints[0]['mtime'], 10**18)
+            feed.write_text('sku\nrtx3060\n')
+            self.assertEqual(sku_search.loadIndex(d/'idx', 'k1', [feed]), (None,None))
+
+class TestServer(unittest.TestCase):
+    def test_lookup_and_reload(self):
+        import server,threading,urllib.request
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            Cfg,Suppliers = prepareTestInputs(d, {'Leader' : {}}, {'LNR45_1.csv' : TestColumnarEngine.Leader})
+            catalog = server.Catalog(Cfg, Suppliers, d, lambda txt: None)
+            httpd = server.makeServer('127.0.0.1:0', catalog, lambda txt: None)
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            get = lambda path: json.loads(urllib.request.urlopen(f'http://127.0.0.1:{httpd.server_port}{path}').read())
+            try:
+                self.assertEqual(get('/sku/PRIME%20B450M-K')['selected']['price'], 99)
+                (d/'LNR45_1.csv').write_text(TestColumnarEngine.Leader.replace('"99"','"89.5"'), encoding='utf-8')
+                self.assertEqual(catalog.refresh(), ['Leader'])
+                self.assertEqual(get('/best?sku=prime-b450m-k&sku=none'), {'prime-b450m-k' : get('/sku/primeb450mk')['offers'][0], 'none' : None})
+                self.assertEqual(get('/sku/primeb450mk')['selected']['price'], 89.5)
+                self.assertEqual(catalog.refresh(), [])
+                # the output encoding follows a datafeed saved in another encoding
+                encoding = catalog.state[3]
+                (d/'LNR45_1.csv').write_text(TestColumnarEngine.Leader.replace('ZERO','ZÉRO'), encoding='cp1252')
+                self.assertEqual(catalog.refresh(), ['Leader'])
+                self.assertEqual(catalog.state[3], 'cp1252')
+                self.assertNotEqual(encoding, 'cp1252')
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+
+    def test_datafeed_missing_at_start(self):
+        import server
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            Cfg,Suppliers = prepareTestInputs(d, LEADER_SYNNEX, {'LNR45_1.csv' : TestColumnarEngine.Leader}, {'serve' : '127.0.0.1:0'})
+            catalog = server.Catalog(Cfg, Suppliers, d, lambda txt: None)
+            self.assertEqual(list(catalog.state[0].keys()), ['Leader'])
+            self.assertEqual(catalog.refresh(), [])
+            (d/'synnex.txt').write_text(TestColumnarEngine.Synnex, encoding='utf-8')
+            self.assertEqual(catalog.refresh(), ['Synnex'])
+            _,selItem,offers = catalog.offers(catalog.state, 'X3')
+        self.assertEqual(selItem.supplier, 'Synnex')
+        self.assertEqual(catalog.status(catalog.state)['suppliers']['Synnex']['items'], 4)
+
+class TestDataParts(unittest.TestCase):
+    Newer = ('"MANUFACTURER SKU","DBP","AT","weight","BAR CODE"\n'
+             '"PRIME B450M-K","120","5","1.5","111"\n'
+             '"NEW-SKU","15","2","1","222"\n')
+
+    def load(self, d, mergeParts):
+        Cfg,Suppliers = prepareTestInputs(d, {'Leader' : {}}, merge_parts=mergeParts)
+        return LoadItems(Suppliers, Cfg['encodings'], lambda txt: None)[0]['Leader']
+
+    def test_merge_rules(self):
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            # the older file sorts last by name, file age decides
+            (d/'LNR45_2.csv').write_text(TestColumnarEngine.Leader, encoding='utf-8')
+            (d/'LNR45_1.csv').write_text(self.Newer, encoding='utf-8')
+            os.utime(d/'LNR45_2.csv', (1e9, 1e9))
+            newest = self.load(d, 'newest')
+            cheapest = self.load(d, 'cheapest')
+            (d/'LNR45_1.csv').unlink()
+            older = self.load(d, None)
+        self.assertEqual(newest['primeb450mk'].price, 120)
+        self.assertEqual(newest['newsku'].price, 15)
+        self.assertEqual(cheapest['primeb450mk'].price, older['primeb450mk'].price)
+        self.assertEqual(newest.keys(), cheapest.keys())
+        self.assertEqual(newest.keys(), older.keys() | {'newsku'})
+
+class TestParallelLoading(unittest.TestCase):
+    def test_same_as_sequential(self):
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            (d/'synnex.txt').write_text(TestColumnarEngine.Synnex, encoding='cp1252')
+            Cfg,Suppliers = prepareTestInputs(d, LEADER_SYNNEX, {'LNR45_2.csv' : TestColumnarEngine.Leader, 'LNR45_1.csv' : TestDataParts.Newer})
+            os.utime(d/'LNR45_2.csv', (1e9, 1e9))
+            sequential,parallel = [],[]
+            Items,encoding = LoadItems(Suppliers, Cfg['encodings'], sequential.append)
+            PItems,pencoding = LoadItems(Suppliers, Cfg['encodings'], parallel.append, parallel=True, workers=2)
+        self.assertEqual(pencoding, encoding)
+        self.assertEqual({n : list(i.items()) for n,i in PItems.items()}, {n : list(i.items()) for n,i in Items.items()})
+        summary = lambda log: [re.sub(' time .*', '', txt) for txt in log]
+        self.assertEqual(summary(parallel), summary(sequential))
+
+class TestMetrics(unittest.TestCase):
+    def test_supplier_stats(self):
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            Cfg,Suppliers = prepareTestInputs(d, {'Leader' : {}}, {'LNR45_1.csv' : TestColumnarEngine.Leader})
+            metrics = Metrics('test', traceMemory=True)
+            with metrics.stage('LoadItems') as stage:
+                Items,_ = LoadItems(Suppliers, Cfg['encodings'], lambda txt: None, metrics=metrics)
+            metrics.save(d/'metrics.json')
+            report = json.loads((d/'metrics.json').read_text())
+        leader = report['suppliers']['Leader']
+        self.assertEqual(leader['rows'], 11)
+        self.assertEqual(leader['items'], len(Items['Leader']))
+        self.assertEqual(leader['skipped'], {'price' : 2, 'sku' : 1, 'out_of_stock' : 0, 'invalid' : 3})
+        self.assertGreaterEqual(report['stages']['LoadItems']['peak_mb'], leader['peak_mb'])
+
+class TestTopOffers(unittest.TestCase):
+    def item(self, supplier, cost, avail=5):
+        return Item(supplier, 'x', cost, cost, avail, avail, avail, (), ())
+
+    def test_bounded_ranking(self):
+        Items = {s : {'x' : self.item(s, cost, avail)} for s,cost,avail in [('A',10,0), ('B',12,1), ('C',11,20), ('D',11,3), ('E',15,2)]}
+        Items['A']['y'] = self.item('A', 1)
+        SelectedItems,Offers = selectItems(Items, lambda txt: None, 3)
+        self.assertEqual([i.supplier for i in Offers['x']], ['C','D','B'])
+        self.assertEqual(SelectedItems['x'].supplier, 'C')
+        self.assertNotIn('y', Offers)
+        _,Offers = selectItems(Items, lambda txt: None, 2, availabilityWeight=0.1)
+        self.assertEqual([i.supplier for i in Offers['x']], ['C','D'])
+        _,Offers = selectItems(Items, lambda txt: None, 5, availabilityWeight=0.1)
+        self.assertEqual([i.supplier for i in Offers['x']], ['C','D','B','E','A'])
+        self.assertEqual(readAvailability(['>10','0','3'], [0,1,2], {})[1], (3, sys.maxsize))
+
+class TestOfferStore(unittest.TestCase):
+    def test_runs(self):
+        Items,_ = TestColumnarEngine().load('rows')
+        SelectedItems,Offers = selectItems(Items, lambda txt: None, 2, 0.5)
+        with tempfile.TemporaryDirectory() as d, OfferStore(Path(d)/'offers.db') as store:
+            store.addRun(Items, SelectedItems, 0.5)
+            run = store.run(store.addRun(Items, SelectedItems, 0.5))
+            best = {}
+            for r in store.best(run, 2):
+                best.setdefault(r['sku_key'], []).append((r['supplier'], r['price']))
+            self.assertEqual(best, {k : [(i.supplier, i.price) for i in Offers.get(k, [i])] for k,i in SelectedItems.items()})
+            store.export(run, Path(d)/'exported.csv')
+            writeResult(SelectedItems, Path(d)/'results.csv')
+            self.assertEqual((Path(d)/'exported.csv').read_text(), (Path(d)/'results.csv').read_text())
+            self.assertEqual([(r['run'], r['supplier']) for r in store.history('primeb450mk')], [(1,'Synnex'),(1,'Leader'),(2,'Synnex'),(2,'Leader')])
+            self.assertEqual({r['supplier'] : r['skus'] for r in store.wins(run)},
+                             {s : sum(i.supplier == s for i in SelectedItems.values()) for s in Items})
+
+    def test_concurrent_runs(self):
+        import sqlite3
+        Items,_ = TestColumnarEngine().load('rows')
+        SelectedItems,_ = selectItems(Items, lambda txt: None)
+        test = self
+        class Interleaved:
+            # another store adds a run right after the first free rowid is read
+            def __init__(self, db):
+                self.db = db
+            def __getattr__(self, name):
+                return getattr(self.db, name)
+            def __enter__(self):
+                return self.db.__enter__()
+            def __exit__(self, *args):
+                return self.db.__exit__(*args)
+            def execute(self, sql, *args):
+                cursor = self.db.execute(sql, *args)
+                if 'MAX(rowid)' in sql:
+                    with test.assertRaisesRegex(sqlite3.OperationalError, 'locked'):
+                        other.addRun(Items, SelectedItems)
+                return cursor
+        with tempfile.TemporaryDirectory() as d, OfferStore(Path(d)/'offers.db') as store, OfferStore(Path(d)/'offers.db') as other:
+            other.db.execute('PRAGMA busy_timeout = 0')
+            store.db = Interleaved(store.db)
+            run = store.run(store.addRun(Items, SelectedItems))
+            self.assertEqual(other.run()['id'], run['id'])
+            self.assertEqual(store.run(other.addRun(Items, SelectedItems))['first_offer'], run['first_offer'] + run['offers'])
+
+class TestFetcher(unittest.TestCase):
+    def test_conditional_fetch(self):
+        import fetcher,functools,threading,time
+        from http.server import ThreadingHTTPServer,SimpleHTTPRequestHandler
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            (d/'remote').mkdir()
+            (d/'remote'/'feed.csv').write_text(TestColumnarEngine.Leader, encoding='utf-8')
+            handler = type('Handler', (SimpleHTTPRequestHandler,), {'log_message' : lambda self,*args: None})
+            httpd = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler, directory=d/'remote'))
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            try:
+                # the datafeed of Synnex is missing on the server
+                Cfg,Suppliers = prepareTestInputs(d, {'Leader' : {'url' : f'http://127.0.0.1:{httpd.server_port}/feed.csv'},
+                                               'Synnex' : {'data' : 'missing.csv', 'url' : f'http://127.0.0.1:{httpd.server_port}/missing.csv'}},
+                                           args={'fetch' : True})
+                fetch = lambda: fetcher.FeedFetcher({n : (s.url, s.data) for n,s in Suppliers.items()}, Cfg['fetch_state_filename'], lambda txt: None)
+                feeds = fetch().start()
+                Items,_ = LoadItems(Suppliers, Cfg['encodings'], lambda txt: None, ready=feeds.ready(Suppliers.keys()))
+                self.assertEqual(Items['Leader']['primeb450mk'].price, 99)
+                self.assertNotIn('Synnex', Items)
+                self.assertEqual({n : r['result'] for n,r in feeds.results.items()}, {'Leader' : fetcher.CHANGED, 'Synnex' : fetcher.FAILED})
+                self.assertEqual(fetch().run()['Leader']['result'], fetcher.UNCHANGED)
+                (d/'remote'/'feed.csv').write_text(TestColumnarEngine.Leader.replace('"99"','"89.5"'), encoding='utf-8')
+                os.utime(d/'remote'/'feed.csv', (time.time()+10, time.time()+10))
+                self.assertEqual(fetch().run()['Leader']['result'], fetcher.CHANGED)
+                # wildcard data pattern, the datafeed is saved under the name from the url
+                self.assertEqual((d/'feed.csv').read_bytes(), (d/'remote'/'feed.csv').read_bytes())
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+
+    def test_responses(self):
+        import fetcher,threading,asyncio
+        from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+        body = TestColumnarEngine.Leader.encode('utf-8')
+        current = {'etag' : '"v1"', 'modified' : 'Mon, 01 Jan 2024 00:00:00 GMT'}
+        requests = []
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def log_message(self, *args):
+                pass
+            def redirect(self, location):
+                self.send_response(302)
+                self.send_header('Location', location)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            def do_GET(self):
+                requests.append((self.path, self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')))
+                if self.path == '/chunked':
+                    self.send_response(200)
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    for part in (body[:7], body[7:]):
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(part), part))
+                    self.wfile.write(b'0\r\n\r\n')
+                elif self.path == '/moved':
+                    self.redirect('/chunked')
+                elif self.path == '/loop':
+                    self.redirect('/loop')
+                elif self.path == '/dropped':
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body[:10])
+                    self.close_connection = True
+                else:
+                    # an entity tag takes precedence over the modification time
+                    etag = self.headers.get('If-None-Match')
+                    if etag == current['etag'] if etag else self.headers.get('If-Modified-Since') == current['modified']:
+                        self.send_response(304)
+                        self.end_headers()
+                        return
+                    self.send_response(200)
+                    if current['etag']:
+                        self.send_header('ETag', current['etag'])
+                    self.send_header('Last-Modified', current['modified'])
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                path = Path(d)/'feed.csv'
+                fetch = lambda name,known=None: asyncio.run(fetcher.fetchFeed(f'http://127.0.0.1:{httpd.server_port}/{name}', path, known, timeout=10))
+                result,known = fetch('chunked')
+                self.assertEqual((result, path.read_bytes(), known['size']), (fetcher.CHANGED, body, len(body)))
+                path.unlink()
+                result,known = fetch('moved')
+                self.assertEqual((result, path.read_bytes()), (fetcher.CHANGED, body))
+                self.assertTrue(known['url'].endswith('/chunked'))
+                del requests[:]
+                with self.assertRaisesRegex(fetcher.FetchError, 'too many redirects'):
+                    fetch('loop')
+                self.assertEqual(len(requests), fetcher.MAX_REDIRECTS)
+                # the datafeed from the previous download is kept
+                path.write_bytes(b'old')
+                with self.assertRaisesRegex(fetcher.FetchError, 'bytes missing'):
+                    fetch('dropped')
+                self.assertEqual(path.read_bytes(), b'old')
+                self.assertEqual(os.listdir(d), ['feed.csv'])
+
+                path.unlink()
+                result,known = fetch('cond')
+                self.assertEqual((result, known['etag'], known['last_modified']), (fetcher.CHANGED, current['etag'], current['modified']))
+                del requests[:]
+                self.assertEqual(fetch('cond', known), (fetcher.UNCHANGED, known))
+                self.assertEqual(requests, [('/cond', current['etag'], current['modified'])])
+                # a new entity tag within the same second of the modification time
+                current['etag'] = '"v2"'
+                result,known = fetch('cond', known)
+                self.assertEqual((result, known['etag']), (fetcher.UNCHANGED, '"v2"'))   # same content
+                # without an entity tag only the modification time is sent
+                current['etag'] = None
+                result,known = fetch('cond', known)
+                self.assertEqual((result, known['etag']), (fetcher.UNCHANGED, None))
+                del requests[:]
+                self.assertEqual(fetch('cond', known), (fetcher.UNCHANGED, known))
+                self.assertEqual(requests, [('/cond', None, current['modified'])])
+                # known state of a deleted datafeed is not used
+                path.unlink()
+                del requests[:]
+                self.assertEqual(fetch('cond', known)[0], fetcher.CHANGED)
+                self.assertEqual(requests, [('/cond', None, None)])
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+class TestBatch(unittest.TestCase):
+    def test_variants_same_as_runs(self):
+        import batch
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            (d/'LNR45_1.csv').write_text(TestColumnarEngine.Leader, encoding='utf-8')
+            (d/'synnex.txt').write_text(TestColumnarEngine.Synnex, encoding='utf-8')
+            # a missing datafeed is left out as in a single run
+            cfg = writeTestConfig(d, dict(LEADER_SYNNEX, Ingram={'data' : 'missing.txt'}))
+            Variants = {'base' : {}, 'stock' : {'include_out_of_stock_items' : True, 'suppliers' : {'Synnex' : {'include_out_of_stock_items' : True}}},
+                        'ship' : {'suppliers' : {'Leader' : {'shipping_rules' : {'0-5kg' : 1, 'NA' : 2}}}, 'sku_chars_to_remove' : ''}}
+            (d/'variants.json').write_text(json.dumps(Variants))
+            Args = argparse.Namespace(dir=d, cfg=d/'config.json', output=d/'results.csv', duplicates=None, names=None)
+            log = []
+            batch.runBatch(Args, d/'variants.json', log.append)
+            self.assertIn(f'filename {d/"missing.txt"} not found', log)
+            for name,overrides in Variants.items():
+                Cfg,Suppliers = prepareInputs(argparse.Namespace(dir=d, cfg=None, output=d/'run.csv'), lambda txt: None, batch.variantConfig(cfg, overrides))
+                Items,encoding = LoadItems(Suppliers, Cfg['encodings'], lambda txt: None)
+                writeResult(selectItems(Items, lambda txt: None)[0], d/'run.csv', encoding)
+                self.assertEqual((d/f'results_{name}.csv').read_text(), (d/'run.csv').read_text(), name)
+            self.assertNotEqual((d/'results_base.csv').read_text(), (d/'results_ship.csv').read_text())
+
+    def test_full_run_args_rejected(self):
+        import io,contextlib
+        Args = argparse.Namespace(verbose=False, summary=None, batch=Path('variants.json'), store=Path('offers.db'), fetch=True)
+        with self.assertRaises(SystemExit) as exited, contextlib.redirect_stderr(io.StringIO()) as err:
+            main(Args)
+        self.assertEqual(exited.exception.code, 2)
+        self.assertIn('-store, -fetch cannot be used with -batch', err.getvalue())
+
+class TestSpill(unittest.TestCase):
+    def test_same_as_in_memory(self):
+        import spill
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            (d/'LNR45_2.csv').write_text(TestColumnarEngine.Leader, encoding='utf-8')
+            (d/'LNR45_1.csv').write_text(TestDataParts.Newer, encoding='utf-8')
+            os.utime(d/'LNR45_2.csv', (1e9, 1e9))
+            (d/'synnex.txt').write_text(TestColumnarEngine.Synnex, encoding='utf-8')
+            (d/'spill').mkdir()
+            # a missing datafeed is left out as in the default mode, binary is written as csv, which keeps memory bounded,
+            # a tiny limit spills a few offers per run and merges runs two at a time
+            Args = {'output' : d/'spilled.csv', 'duplicates' : d/'spilled_dup.csv'}
+            Cfg,Suppliers = prepareTestInputs(d, dict(LEADER_SYNNEX, Ingram={'data' : 'missing.txt'}), args=Args, merge_parts='cheapest',
+                                              output_format='binary', memory_limit_mb=1e-4, top_k=2, spill_dir=str(d/'spill'))
+            log = []
+            spill.selectSpilled(Cfg, Suppliers, log.append)
+            self.assertIn(f'filename {d/"missing.txt"} not found', log)
+            Items,encoding = LoadItems(Suppliers, Cfg['encodings'], lambda txt: None)
+            SelectedItems,Offers = selectItems(Items, lambda txt: None, Cfg['top_k'])
+            writeResult(SelectedItems, d/'results.csv', encoding)
+            writeDuplicates(Offers, d/'duplicates.csv', encoding)
+            lines = lambda fn: sorted((d/fn).read_text().splitlines())
+            self.assertEqual(lines('spilled.csv'), lines('results.csv'))
+            self.assertEqual(lines('spilled_dup.csv'), lines('duplicates.csv'))
+            self.assertEqual(len(lines('duplicates.csv')), 2)
+            self.assertEqual(list((d/'spill').iterdir()), [])
+
+    def test_full_run_args_rejected(self):
+        import io,contextlib
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            (d/'LNR45_1.csv').write_text(TestColumnarEngine.Leader, encoding='utf-8')
+            writeTestConfig(d, {'Leader' : {}}, memory_limit_mb=1)
+            Args = argparse.Namespace(dir=d, cfg=d/'config.json', output=d/'results.csv', verbose=False, summary=None, batch=None, serve=None, search=None,
+                                      store=d/'offers.db', metrics_memory=False, profile=None)
+            with self.assertRaises(SystemExit) as exited, contextlib.redirect_stderr(io.StringIO()) as err:
+                main(Args)
+            self.assertEqual(exited.exception.code, 2)
+            self.assertIn('-store cannot be used with memory limited mode', err.getvalue())
+            self.assertFalse((d/'results.csv').exists())
+
+def exitingLoader(*args):
+    # loader of TestStreaming.test_loader_exit, module level to start in a spawned process too
+    if common.multiprocessing.parent_process() is not None:
+        os._exit(3)
+
+class TestStreaming(unittest.TestCase):
+    def test_same_as_staged(self):
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            (d/'LNR45_2.csv').write_text(TestColumnarEngine.Leader, encoding='utf-8')
+            (d/'LNR45_1.csv').write_text(TestDataParts.Newer, encoding='utf-8')
+            os.utime(d/'LNR45_2.csv', (1e9, 1e9))
+            (d/'synnex.txt').write_text(TestColumnarEngine.Synnex, encoding='utf-8')
+            Cfg,Suppliers = prepareTestInputs(d, LEADER_SYNNEX, merge_parts='cheapest', top_k=2)
+            staged,streamed = [],[]
+            Items,encoding = LoadItems(Suppliers, Cfg['encodings'], staged.append)
+            SelectedItems,Offers = selectItems(Items, staged.append, Cfg['top_k'])
+            # tiny batches, repeated skus are folded in before the supplier replaces them
+            batch,common.STREAM_BATCH = common.STREAM_BATCH,2
+            try:
+                output_encoding = OutputEncoding(streamed.append)
+                SItems,SSelectedItems,SOffers = selectOffers(iterSupplierOffers(Suppliers, Cfg['encodings'], streamed.append, output_encoding),
+                                                             Suppliers.keys(), streamed.append, Cfg['top_k'])
+            finally:
+                common.STREAM_BATCH = batch
+            self.assertEqual(output_encoding.value, encoding)
+            self.assertEqual({n : list(i.items()) for n,i in SItems.items()}, {n : list(i.items()) for n,i in Items.items()})
+            self.assertEqual(list(SSelectedItems.items()), list(SelectedItems.items()))
+            self.assertEqual(list(SOffers.items()), list(Offers.items()))
+            summary = lambda log: sorted(re.sub(' time .*', '', txt) for txt in log)
+            self.assertEqual(summary(streamed), summary(staged))
+            writeResult(SSelectedItems, d/'streamed.csv', encoding, 'csv', True)
+            writeResult(SelectedItems, d/'results.csv', encoding)
+            self.assertEqual((d/'streamed.csv').read_bytes(), (d/'results.csv').read_bytes())
+
+    def test_loader_exit(self):
+        # the loader process exits as if killed, the thread one returns, neither sends 'end'
+        poll,common.STREAM_POLL = common.STREAM_POLL,0.05
+        try:
+            for cpus,error in ((2,'exit code 3'), (1,'exit code None')):
+                with self.assertRaisesRegex(RuntimeError, error):
+                    list(common.loadItemsStreaming([], [], lambda txt: None, cpus=cpus, target=exitingLoader))
+        finally:
+            common.STREAM_POLL = poll
+
+class TestDeltaSelection(unittest.TestCase):
+    def item(self, supplier, sku, cost, avail=5):
+        return Item(supplier, sku, cost, cost, avail, avail, avail, (), ())
+
+    def test_same_as_full_selection(self):
+        Prev = {'A' : {'x' : self.item('A','x',10), 'y' : self.item('A','y',5), 'z' : self.item('A','z',1), 'v' : self.item('A','v',3)},
+                'B' : {'x' : self.item('B','x',12), 'y' : self.item('B','y',4)}}
+        Items = {'A' : {'x' : self.item('A','x',13), 'y' : self.item('A','y',5), 'w' : self.item('A','w',2), 'v' : self.item('A','v',3,9)},
+                 'B' : {'x' : self.item('B','x',12), 'y' : self.item('B','y',4, 0)}}
+        PrevSelected,_ = selectItems(Prev, lambda txt: None)
+        SelectedItems,Duplicates,Changes = selectItemsDelta(Items, {'items' : Prev, 'selected' : PrevSelected}, lambda txt: None)
+        FullSelected,_ = selectItems(Items, lambda txt: None)
+        self.assertEqual(SelectedItems, FullSelected)
+        self.assertEqual(sorted((c,i.sku,i.supplier) for c,i in Changes),
+                         [('added','w','A'), ('removed','z','A'), ('repriced','x','B'), ('repriced','y','A'), ('updated','v','A')])
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("dir",type=Path,help="directory containing input (datafeed) files")
     parser.add_argument("-output","-o", type=Path,help="output file path and name")
     parser.add_argument("-duplicates","-d",type=Path,help="duplicates file path and name")
+    parser.add_argument("-fetch",action='store_true',help="download datafeeds of suppliers with url in config before loading, overwrites fetch from config")
+    parser.add_argument("-store",type=Path,help="sqlite file keeping offers of every run, overwrites store_filename from config")
+    parser.add_argument("-top_k",type=int,help="best offers kept per sku, overwrites top_k from config")
     parser.add_argument("-names","-n",type=Path,help="all names file path and name")
+    parser.add_argument("-format",choices=OUTPUT_FORMATS,help="format of output files, overwrites output_format from config")
     parser.add_argument("-summary","-s",type=Path,help="summary file path and name")
     parser.add_argument("-cfg",type=Path,help="config file path and name")
     parser.add_argument("-verbose","-v",action='store_true',help="print debug informations")
     parser.add_argument("-test","-t",action='store_true',help="run unit testing")
-    parser.add_argument("-search",type=str,help="search item in the final results")
+    parser.add_argument("-search",type=str,help="search item in all datafeeds without writing output files, matches prefixes, substrings and skus with typos")
+    parser.add_argument("-search_limit",type=int,default=20,help="max number of skus found by -search")
+    parser.add_argument("-delta",type=Path,help="snapshot file, select again only items changed since the run that saved it")
+    parser.add_argument("-changes",type=Path,help="changes file path and name, used with -delta")
+    parser.add_argument("-metrics",type=Path,help="metrics file path and name, overwrites metrics_filename from config")
+    parser.add_argument("-metrics_memory",action='store_true',help="trace peak memory of every stage and supplier, slows loading down")
+    parser.add_argument("-profile",type=str,help="run cProfile over the given stage, e.g. LoadItems, profile is saved next to the metrics file")
+    parser.add_argument("-memory_report",action='store_true',help="print memory used per offer")
+    parser.add_argument("-batch",type=Path,help="json file with config variants by name, datafeeds are read once and every variant writes its own output files")
+    parser.add_argument("-memory_limit",type=float,help="MB of offers held in memory, offers are spilled to sorted files and merged, results are written in sku order, overwrites memory_limit_mb from config")
+    parser.add_argument("-stream",action='store_true',help="select offers while datafeeds are still parsed and write output files in the background, overwrites streaming from config")
+    parser.add_argument("-serve",type=str,help="keep the catalog in memory and answer queries over http, address is host:port or unix:/path/to/socket")
+    parser.add_argument("-watch_interval",type=float,help="seconds between checks for changed datafeeds in -serve mode, overwrites watch_interval from config")
+    parser.add_argument("-parallel","-p",action='store_true',help="load supplier datafeeds in parallel worker processes")
+    parser.add_argument("-workers",type=int,help="number of worker processes used by -parallel, defaults to cpu count")
+    parser.add_argument("-parse_workers",type=int,help="worker processes parsing one large tab separated datafeed, defaults to 1 (no splitting)")
+    parser.add_argument("-engine",choices=['rows','columnar'],help="datafeed parsing engine, columnar requires numpy")
+    parser.add_argument("-no_cache",action='store_true',help="do not read nor write the parsed datafeed cache")
+    parser.add_argument("-clear_cache",action='store_true',help="remove all entries from the parsed datafeed cache")
     Args = parser.parse_args()
 
     if Args.test:
@@ -0,0 +1,225 @@
+import heapq
+from datetime import datetime
+from output import TableWriter,batches
+
+def makeRankOffer(suppliers, availabilityWeight=0):
+    # higher rank is a better offer: in stock first, then price+shipping lowered by availability_weight
+    # for every item surely in stock, ties go to the supplier listed first, the item itself ends the rank
+    seq = {name : -i for i,name in enumerate(suppliers)}
+    def rankOffer(item):
+        return (item.avail_hi > 0, availabilityWeight * item.avail_lo - item.tot_cost, seq[item.supplier], item)
+    return rankOffer
+
+def selectItems(Items, verbose, topK=3, availabilityWeight=0):
+    # returns selected items and {sku : up to topK best offers, best first} of skus offered by more than one supplier,
+    # offers are kept in bounded heaps with the worst kept offer on top, so memory grows with skus, not with duplicates
+    rankOffer = makeRankOffer(Items.keys(), availabilityWeight)
+    topK = max(topK, 1)
+    SelectedItems = {}
+    Offers = {}
+    verbose('adding items')
+    itemsCnt = 0
+    for f,items in Items.items():
+        dupCnt=0
+        t0 = datetime.utcnow()
+        for name,item in items.items():
+            selItem = SelectedItems.get(name)
+            if selItem is None:
+                SelectedItems[name]=item
+                continue
+            dupCnt += 1
+            heap = Offers.get(name)
+            if heap is None:
+                heap = Offers[name] = [rankOffer(selItem)]
+            if len(heap) < topK:
+                heap.append(rankOffer(item))    # heap order matters only once the heap is full
+                if len(heap) == topK:
+                    heapq.heapify(heap)
+            else:
+                heapq.heappushpop(heap, rankOffer(item))
+        dt = datetime.utcnow() - t0
+        totItems = len(SelectedItems)
+        verbose(f'\tfile {f } : {dupCnt} duplicates, added {totItems-itemsCnt} items, total items {totItems} time {dt}')
+        itemsCnt = totItems
+    for name,heap in Offers.items():
+        heap.sort(reverse=True)
+        heap[:] = [rank[-1] for rank in heap]
+        SelectedItems[name] = heap[0]
+    return SelectedItems, Offers
+
+def selectOffers(SupplierOffers, suppliers, verbose, topK=3, availabilityWeight=0):
+    # selectItems consuming iterSupplierOffers while datafeeds are still loading, returns Items, selected items and offers,
+    # an offer folded in before the supplier replaced it, e.g. by a repeated sku, is ranked again with the final offers of its sku
+    rankOffer = makeRankOffer(suppliers, availabilityWeight)
+    topK = max(topK, 1)
+    Items = {}
+    SelectedItems = {}
+    Offers = {}
+    reselect = False
+    verbose('adding items')
+    itemsCnt = dupCnt = 0
+    t0 = None
+    for f,offers,items,changed in SupplierOffers:
+        if t0 is None:
+            t0 = datetime.utcnow()
+        if offers is not None:
+            if reselect:
+                continue
+            for name,item in offers:
+                selItem = SelectedItems.get(name)
+                if selItem is None:
+                    SelectedItems[name]=item
+                    continue
+                dupCnt += 1
+                heap = Offers.get(name)
+                if heap is None:
+                    heap = Offers[name] = [rankOffer(selItem)]
+                if len(heap) < topK:
+                    heap.append(rankOffer(item))
+                    if len(heap) == topK:
+                        heapq.heapify(heap)
+                else:
+                    heapq.heappushpop(heap, rankOffer(item))
+            continue
+        if items is not None:
+            Items[f] = items
+        reselect = reselect or changed is None
+        if not reselect:
+            for name in changed:
+                offers = [itms[name] for itms in Items.values() if name in itms]
+                SelectedItems[name] = offers[0]
+                if len(offers) == 1:
+                    Offers.pop(name, None)
+                    continue
+                heap = [rankOffer(item) for item in offers]
+                if len(heap) > topK:
+                    heap = heapq.nlargest(topK, heap)
+                if len(heap) == topK:
+                    heapq.heapify(heap)
+                Offers[name] = heap
+            if items is not None:
+                totItems = len(SelectedItems)
+                verbose(f'\tfile {f } : {dupCnt} duplicates, added {totItems-itemsCnt} items, total items {totItems} time {datetime.utcnow() - t0}')
+                itemsCnt = totItems
+        dupCnt = 0
+        t0 = None
+    if reselect:
+        verbose('offers of a datafeed failing half way were selected, selecting all items again')
+        return (Items,) + selectItems(Items, verbose, topK, availabilityWeight)
+    for name,heap in Offers.items():
+        heap.sort(reverse=True)
+        heap[:] = [rank[-1] for rank in heap]
+        SelectedItems[name] = heap[0]
+    return Items, SelectedItems, Offers
+
+def rankedOffers(Offers):
+    # pairs of (offer, selected offer) for the duplicates report
+    for offers in Offers.values():
+        for item in offers[1:]:
+            yield item,offers[0]
+
+def selectOffer(offers, rankOffer):
+    # same rule as selectItems
+    return max(offers, key=rankOffer, default=None)
+
+def diffSelected(PrevSelected, SelectedItems, names):
+    Changes = []
+    for name in names:
+        prev = PrevSelected.get(name)
+        item = SelectedItems.get(name)
+        if prev is None and item is not None:
+            Changes.append( ('added', item) )
+        elif prev is not None and item is None:
+            Changes.append( ('removed', prev) )
+        elif prev != item:
+            change = 'repriced' if (prev.price,prev.tot_cost) != (item.price,item.tot_cost) else 'updated'
+            Changes.append( (change, item) )
+    return Changes
+
+def selectItemsDelta(Items, Snapshot, verbose, topK=3, availabilityWeight=0):
+    if Snapshot is None:
+        SelectedItems,Offers = selectItems(Items, verbose, topK, availabilityWeight)
+        return SelectedItems, Offers, diffSelected({}, SelectedItems, SelectedItems.keys())
+    PrevItems = Snapshot['items']
+    PrevSelected = Snapshot['selected']
+    verbose('comparing items with snapshot')
+    t0 = datetime.utcnow()
+    changed = {}    # ordered set
+    for f in list(Items.keys()) + [f for f in PrevItems.keys() if f not in Items]:
+        items = Items.get(f, {})
+        prevItems = PrevItems.get(f, {})
+        if items is prevItems:     # supplier not reloaded, only in a long running process
+            continue
+        added = modified = 0
+        for name,item in items.items():
+            prev = prevItems.get(name)
+            if prev is None:
+                added += 1
+                changed[name] = None
+            elif prev != item:
+                modified += 1
+                changed[name] = None
+        removed = [name for name in prevItems.keys() if name not in items]
+        changed.update(dict.fromkeys(removed))
+        verbose(f'\tfile {f} : {added} added, {len(removed)} removed, {modified} changed items')
+    SelectedItems = dict(PrevSelected)
+    rankOffer = makeRankOffer(Items.keys(), availabilityWeight)
+    for name in changed:
+        selItem = selectOffer((items[name] for items in Items.values() if name in items), rankOffer)
+        if selItem is None:
+            SelectedItems.pop(name, None)
+        else:
+            SelectedItems[name] = selItem
+    Changes = diffSelected(PrevSelected, SelectedItems, changed)
+    verbose(f'\tre-selected {len(changed)} skus, {len(Changes)} changes, total items {len(SelectedItems)} time {datetime.utcnow()-t0}')
+    # duplicates are found by the full selection only
+    return SelectedItems, None, Changes
+
+def writeChanges(Changes, changesFn, encoding=None, format='csv'):
+    columns = [('change','str'),('sku','sku'),('supplier','str'),('price','num'),('price+shipping','num'),('availability','str')]
+    row = lambda c: (c[0],c[1].sku,c[1].supplier,c[1].price,c[1].tot_cost,c[1].orig_availability)
+    with TableWriter(changesFn, columns, encoding, format) as outf:
+        for batch in batches(Changes):
+            outf.write(batch, row)
+
+def resultColumns(layout):
+    return [('sku','sku'),('supplier','str'),('price','num'),('price+shipping','num'),('availability','str')] + [(n,'str') for n in layout]
+
+def writeResultBatch(outf, batch):
+    outf.write(batch, lambda i: (i.sku,i.supplier,i.price,i.tot_cost,i.orig_availability) + i.values)
+
+def writeResult(SelectedItems,outputFn, encoding=None, format='csv', background=False):
+    layout = ()
+    for i in SelectedItems.values():
+        layout = i.layout
+        break
+    with TableWriter(outputFn, resultColumns(layout), encoding, format, background) as outf:
+        for batch in batches(SelectedItems.values()):
+            writeResultBatch(outf, batch)
+
+DUPLICATES_COLUMNS = [('sku 1','sku'),('supplier 1','str'),('sku 2','sku'),('supplier 2','str'),('price 1','num'),('total cost 1','num'),
+                      ('price 2','num'),('total cost 2','num'),('availability 1','str'),('availability 2','str')]
+
+def writeDuplicatesBatch(outf, batch):
+    # batch of (offer, selected offer) pairs
+    row = lambda d: (d[0].sku,d[0].supplier,d[1].sku,d[1].supplier,d[0].price,d[0].tot_cost,d[1].price,d[1].tot_cost,
+                     d[0].orig_availability,d[1].orig_availability)
+    outf.write(batch, row)
+
+def writeDuplicates(Offers, duplicatesFn, encoding=None, format='csv', background=False):
+    if duplicatesFn is not None:
+        with TableWriter(duplicatesFn, DUPLICATES_COLUMNS, encoding, format, background) as outf:
+            for batch in batches(rankedOffers(Offers)):
+                writeDuplicatesBatch(outf, batch)
+
+NAMES_COLUMNS = [('sku','sku'),('supplier','str')]
+
+def writeNamesBatch(outf, batch):
+    outf.write(batch, lambda i: (i.sku,i.supplier))
+
+def writeNames(Items, allnamesFn,encoding=None, format='csv', background=False):   
+    if allnamesFn is not None:
+        with TableWriter(allnamesFn, NAMES_COLUMNS, encoding, format, background) as outf:
+            for itms in Items.values():
+                for batch in batches(itms.values()):
+                    writeNamesBatch(outf, batch)
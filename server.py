@@ -0,0 +1,231 @@
+import os,json,socket,socketserver,tempfile,threading,time
+from datetime import datetime
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+from common import LoadItems, OutputEncoding, resolveDataFiles, makeTranslateSku
+from selection import selectItems, selectItemsDelta, makeRankOffer, writeResult
+from output import OUTPUT_FORMATS
+from fetcher import FeedFetcher
+
+def itemToJson(item):
+    offer = {'supplier' : item.supplier, 'sku' : item.sku, 'price' : item.price, 'price+shipping' : item.tot_cost,
+             'availability' : item.orig_availability}
+    offer.update(item.optionalColumns)
+    return offer
+
+def fileState(filename):
+    try:
+        st = filename.stat()
+        return st.st_mtime_ns, st.st_size
+    except (OSError, TypeError):
+        return None
+
+def filesState(filenames):
+    return [(fn, fileState(fn)) for fn in filenames]
+
+class Catalog:
+    # per supplier items, selected items and the output encoding kept in memory, a reload replaces the whole state at once,
+    # so request threads always see a consistent catalog without locking
+    def __init__(self, Cfg, Suppliers, directory, verbose):
+        self.Suppliers = Suppliers
+        self.encodings = Cfg['encodings']
+        self.dir = directory
+        self.verbose = verbose
+        self.translateSku = makeTranslateSku(Cfg['sku_chars_to_remove'], Cfg['sku_ignore_case'])
+        self.topK = Cfg['top_k']
+        self.availabilityWeight = Cfg['availability_weight']
+        self.reloadLock = threading.Lock()
+        Sources = {name : (supp.url, supp.data) for name,supp in Suppliers.items() if supp.url is not None}
+        self.fetcher = (lambda: FeedFetcher(Sources, Cfg['fetch_state_filename'], verbose, Cfg['fetch_timeout']).run()) if Sources else None
+        self.fetch()
+        # a datafeed that failed its first download or is not there yet is left out until it is there
+        Present = {name : supp for name,supp in Suppliers.items() if supp.data is not None}
+        encoding = OutputEncoding(verbose)
+        Items,_ = LoadItems(Present, self.encodings, verbose, Cfg['parallel_loading'], Cfg['loading_workers'],
+                            ready=Suppliers.keys() if self.fetcher is not None else None, output_encoding=encoding)
+        self.supplierEncodings = encoding.suppliers
+        SelectedItems,_ = selectItems(Items, verbose, self.topK, self.availabilityWeight)
+        self.files = {name : filesState(supp.parts) for name,supp in Suppliers.items()}
+        self.state = (Items, SelectedItems, datetime.now(), encoding.value)
+
+    def outputEncoding(self, Items):
+        # same rule as a full load over the encodings of the suppliers still loaded
+        encoding = OutputEncoding(lambda txt: None)
+        for name in Items:
+            encoding.add(name, self.supplierEncodings.get(name))
+        return encoding.value
+
+    def refresh(self):
+        # reloads datafeeds changed on disk, selects again only skus of changed datafeeds
+        with self.reloadLock:
+            Items,SelectedItems,_,_ = self.state
+            NewItems = {}
+            reloaded = []
+            for name,supp in self.Suppliers.items():
+                parts = resolveDataFiles(self.dir, supp.data_pattern) if supp.url is None else supp.parts
+                state = filesState(parts)
+                if state == self.files[name]:
+                    if name in Items:
+                        NewItems[name] = Items[name]
+                    continue
+                supp.parts = parts
+                supp.data = parts[-1] if parts else None
+                self.files[name] = state
+                reloaded.append(name)
+                self.supplierEncodings.pop(name, None)
+                if any(st is not None for _,st in state):
+                    encoding = OutputEncoding(self.verbose)
+                    NewItems.update(LoadItems({name : supp}, self.encodings, self.verbose, output_encoding=encoding)[0])
+                    self.supplierEncodings[name] = encoding.value
+            if not reloaded:
+                return reloaded
+            SelectedItems,_,Changes = selectItemsDelta(NewItems, {'items' : Items, 'selected' : SelectedItems}, self.verbose,
+                                                  self.topK, self.availabilityWeight)
+            self.state = (NewItems, SelectedItems, datetime.now(), self.outputEncoding(NewItems))
+            self.verbose(f'reloaded {", ".join(reloaded)}, {len(Changes)} changes in selected items')
+            return reloaded
+
+    def fetch(self):
+        # downloaded datafeeds are picked up by refresh as any other changed file
+        if self.fetcher is not None:
+            self.fetcher()
+
+    def watch(self, interval, stop):
+        while not stop.wait(interval):
+            try:
+                self.fetch()
+                self.refresh()
+            except Exception as e:
+                self.verbose(f'reload failed : {e}')
+
+    # state - self.state read once by a request, a reload in between does not mix two catalogs in one answer
+    def offers(self, state, sku):
+        Items,SelectedItems,_,_ = state
+        tsku = self.translateSku(sku)
+        return tsku, SelectedItems.get(tsku), [items[tsku] for items in Items.values() if tsku in items]
+
+    def ranked(self, state, offers):
+        # top_k offers best first, fallbacks when the selected supplier sells out
+        rankOffer = makeRankOffer(state[0].keys(), self.availabilityWeight)
+        return sorted(offers, key=rankOffer, reverse=True)[:self.topK]
+
+    def status(self, state):
+        Items,SelectedItems,loaded,_ = state
+        return {'loaded' : loaded.isoformat(timespec='seconds'), 'selected' : len(SelectedItems),
+                'suppliers' : {name : {'file' : str(self.Suppliers[name].data), 'files' : [str(fn) for fn in self.Suppliers[name].parts],
+                                      'items' : len(items)} for name,items in Items.items()}}
+
+class CatalogRequestHandler(BaseHTTPRequestHandler):
+    # GET /sku/<sku>, GET /best?sku=..&sku=.., GET /export?format=csv, GET /status, POST /reload
+    catalog = None
+
+    def sendJson(self, obj, code=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        state = self.catalog.state
+        if url.path.startswith('/sku/'):
+            sku = unquote(url.path[len('/sku/'):])
+            tsku,selItem,offers = self.catalog.offers(state, sku)
+            if not offers:
+                return self.sendJson({'sku' : sku, 'error' : 'not found'}, 404)
+            self.sendJson({'sku' : sku, 'key' : tsku, 'selected' : itemToJson(selItem) if selItem else None,
+                           'offers' : [itemToJson(i) for i in offers], 'ranked' : [itemToJson(i) for i in self.catalog.ranked(state, offers)]})
+        elif url.path == '/best':
+            best = {}
+            for sku in query.get('sku', []):
+                _,selItem,_ = self.catalog.offers(state, sku)
+                best[sku] = itemToJson(selItem) if selItem else None
+            self.sendJson(best)
+        elif url.path == '/export':
+            self.export(state, query.get('format', ['csv'])[0])
+        elif url.path == '/status':
+            self.sendJson(self.catalog.status(state))
+        else:
+            self.sendJson({'error' : 'unknown request'}, 404)
+
+    def do_POST(self):
+        if urlparse(self.path).path == '/reload':
+            self.sendJson({'reloaded' : self.catalog.refresh()})
+        else:
+            self.sendJson({'error' : 'unknown request'}, 404)
+
+    def export(self, state, format):
+        if format not in OUTPUT_FORMATS:
+            return self.sendJson({'error' : f'unknown format {format}'}, 400)
+        _,SelectedItems,_,encoding = state
+        with tempfile.TemporaryDirectory() as d:
+            fn = Path(d)/'results'
+            writeResult(SelectedItems, fn, encoding, format)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv' if format=='csv' else 'application/octet-stream')
+            self.send_header('Content-Length', str(fn.stat().st_size))
+            self.end_headers()
+            with open(fn,'rb') as f:
+                while chunk := f.read(1<<20):
+                    self.wfile.write(chunk)
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        self.server.verbose(format % args)
+
+def unixPath(address):
+    # path of a unix:/path/to/socket address, None for host:port
+    if not address.startswith('unix:'):
+        return None
+    if not hasattr(socket, 'AF_UNIX'):
+        raise ValueError(f'unix socket addresses are not supported on this platform : {address}')
+    return address[len('unix:'):]
+
+def makeUnixServer(path, handler):
+    # the class is made only for a unix: address, socket.AF_UNIX is missing on some platforms
+    class UnixHTTPServer(ThreadingHTTPServer):
+        address_family = socket.AF_UNIX
+
+        def server_bind(self):
+            if os.path.exists(self.server_address):
+                os.unlink(self.server_address)
+            socketserver.TCPServer.server_bind(self)
+            self.server_name,self.server_port = 'localhost',0
+    return UnixHTTPServer(path, handler)
+
+def makeServer(address, catalog, verbose):
+    # address is host:port or unix:/path/to/socket
+    handler = type('Handler', (CatalogRequestHandler,), {'catalog' : catalog})
+    if (path := unixPath(address)) is not None:
+        server = makeUnixServer(path, handler)
+    else:
+        host,_,port = address.rpartition(':')
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+    server.daemon_threads = True
+    server.verbose = verbose
+    return server
+
+def serve(address, Cfg, Suppliers, directory, verbose):
+    # an address the platform cannot serve is rejected before the catalog is loaded
+    unixPath(address)
+    t0 = time.perf_counter()
+    catalog = Catalog(Cfg, Suppliers, directory, verbose)
+    Items,SelectedItems,_,_ = catalog.state
+    print(f'catalog loaded, {len(SelectedItems)} selected items time {time.perf_counter()-t0:.1f} s, serving on {address}')
+    stop = threading.Event()
+    watcher = threading.Thread(target=catalog.watch, args=(Cfg['watch_interval'], stop), daemon=True)
+    watcher.start()
+    server = makeServer(address, catalog, verbose)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
@@ -0,0 +1,173 @@
+import os,json,pickle,hashlib
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from itertools import islice
+from pathlib import Path
+from feed_cache import parseSettings, fileFingerprint
+from common import supplierParts
+
+INDEX_VERSION = 2
+# match kinds in rank order
+EXACT, PREFIX, SUBSTRING, FUZZY = 'exact', 'prefix', 'substring', 'fuzzy'
+
+def trigrams(s):
+    return {s[i:i+3] for i in range(len(s)-2)}
+
+def makeEditDistance(q):
+    # bit parallel levenshtein distance to q (Myers, Hyyro), anything above limit is reported as limit+1
+    m = len(q)
+    mask = (1 << m) - 1
+    last = 1 << (m - 1) if m else 0
+    peq = {}
+    for i,c in enumerate(q):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    def editDistance(b, limit):
+        if abs(m - len(b)) > limit:
+            return limit+1
+        if m == 0:
+            return len(b)
+        pv,mv,score = mask,0,m
+        for c in b:
+            eq = peq.get(c, 0)
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = (mv | ~(xh | pv)) & mask
+            mh = pv & xh
+            if ph & last:
+                score += 1
+            elif mh & last:
+                score -= 1
+            ph = ((ph << 1) | 1) & mask
+            mh = (mh << 1) & mask
+            pv = (mh | ~(xv | ph)) & mask
+            mv = ph & xv
+        return score if score <= limit else limit+1
+    return editDistance
+
+def indexKey(Suppliers, Items, encodings):
+    # settings of the indexed suppliers, their datafeeds are compared by indexFiles
+    desc = [INDEX_VERSION, list(encodings)] + [parseSettings(Suppliers[name]) for name in Items]
+    return hashlib.sha256(json.dumps(desc, sort_keys=True, default=str).encode()).hexdigest()
+
+def indexFiles(Suppliers, Items):
+    return [part.data for name in Items for part in supplierParts(Suppliers[name])]
+
+def sameFiles(stored, files):
+    # a datafeed with the stored size and mtime is taken as unchanged, any other is hashed,
+    # returns fingerprints of the datafeeds, None when a content changed
+    if [fp['file'] for fp in stored] != [str(fn) for fn in files]:
+        return None
+    fingerprints = []
+    for fp,fn in zip(stored,files):
+        st = fn.stat()
+        if (st.st_size, st.st_mtime_ns) != (fp['size'], fp['mtime']):
+            fp = dict(fileFingerprint(fn), file=str(fn))
+        fingerprints.append(fp)
+    return fingerprints if all(fp['hash'] == old['hash'] for fp,old in zip(fingerprints,stored)) else None
+
+class SkuIndex:
+    # sorted normalized skus for prefix search, trigram postings for substring and typo tolerant search
+    def __init__(self, Items):
+        keys = set()
+        for items in Items.values():
+            keys.update(items.keys())
+        self.keys = sorted(keys)
+        grams = {}
+        for i,k in enumerate(self.keys):
+            for g in trigrams(k):
+                grams.setdefault(g, []).append(i)
+        self.grams = {g : array('I', ids) for g,ids in grams.items()}
+
+    def prefix(self, q):
+        i = bisect_left(self.keys, q)
+        while i < len(self.keys) and self.keys[i].startswith(q):
+            yield self.keys[i]
+            i += 1
+
+    def substring(self, q):
+        grams = trigrams(q)
+        if not grams:   # too short for trigrams
+            return (k for k in self.keys if q in k)
+        rarest = min((self.grams.get(g, ()) for g in grams), key=len)
+        return (self.keys[i] for i in rarest if q in self.keys[i])
+
+    def fuzzy(self, q, maxTypos, maxCandidates=500):
+        # every typo breaks at most 3 trigrams of the query, skus sharing the most trigrams are verified first
+        postings = sorted((self.grams.get(g, ()) for g in trigrams(q)), key=len)
+        need = len(postings) - 3*maxTypos
+        # the most common trigrams are not counted, a matching sku misses at most one count per skipped trigram
+        common = max(1000, len(self.keys)//50)
+        while need > 1 and len(postings[-1]) > common:
+            postings.pop()
+            need -= 1
+        need = max(need, 1)     # short queries, skus sharing no trigram at all are not found
+        counts = Counter()
+        for p in postings:
+            counts.update(p)
+        editDistance = makeEditDistance(q)
+        for i,c in counts.most_common(maxCandidates):
+            if c < need:
+                break
+            d = editDistance(self.keys[i], maxTypos)
+            if d <= maxTypos:
+                yield self.keys[i],d
+
+    def search(self, q, limit=20, maxTypos=None):
+        # returns [(kind, distance, normalized sku)], exact match first, then prefix and substring matches
+        # in sku order, then skus with typos by distance, typos are looked for only without an exact match
+        # and when fewer than limit skus match
+        if maxTypos is None:
+            maxTypos = 1 if len(q) < 10 else 2
+        found = {}
+        for k in islice(self.prefix(q), limit+1):
+            found[k] = (EXACT if k==q else PREFIX, 0)
+        for k in self.substring(q):
+            if len(found) > limit:
+                break
+            found.setdefault(k, (SUBSTRING, 0))
+        if len(found) < limit and q not in found:
+            fuzzy = sorted(self.fuzzy(q, maxTypos), key=lambda e: (e[1], e[0]))
+            for k,d in fuzzy:
+                found.setdefault(k, (FUZZY, d))
+        order = {EXACT : 0, PREFIX : 1, SUBSTRING : 2, FUZZY : 3}
+        ranked = sorted(found.items(), key=lambda e: (order[e[1][0]], e[1][1]))
+        return [(kind,d,k) for k,(kind,d) in ranked[:limit]]
+
+def loadIndex(indexFn, key, files):
+    # returns (index, fingerprints to store when only size or mtime of a datafeed changed) or (None, None)
+    try:
+        with open(indexFn,'rb') as f:
+            stored = pickle.load(f)
+        if stored['key'] == key:
+            fingerprints = sameFiles(stored['files'], files)
+            if fingerprints is not None:
+                return stored['index'],(fingerprints if fingerprints != stored['files'] else None)
+    except Exception:   # missing, corrupted or written by an incompatible version
+        pass
+    return None,None
+
+def saveIndex(indexFn, key, fingerprints, index):
+    indexFn = Path(indexFn)
+    indexFn.parent.mkdir(parents=True, exist_ok=True)
+    tmp = indexFn.with_name(f'{indexFn.name}.{os.getpid()}.tmp')
+    with open(tmp,'wb') as f:
+        pickle.dump({'key' : key, 'files' : fingerprints, 'index' : index}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, indexFn)
+
+def getIndex(indexFn, Suppliers, Items, encodings, verbose):
+    # index saved on disk is reused while datafeeds and their settings stay the same
+    if indexFn is None:
+        return SkuIndex(Items)
+    key = indexKey(Suppliers, Items, encodings)
+    files = indexFiles(Suppliers, Items)
+    index,fingerprints = loadIndex(indexFn, key, files)
+    if index is not None:
+        verbose(f'sku search index loaded from {indexFn}')
+        if fingerprints is not None:
+            saveIndex(indexFn, key, fingerprints, index)
+        return index
+    index = SkuIndex(Items)
+    saveIndex(indexFn, key, [dict(fileFingerprint(fn), file=str(fn)) for fn in files], index)
+    verbose(f'sku search index with {len(index.keys)} skus saved to {indexFn}')
+    return index
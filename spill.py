@@ -0,0 +1,205 @@
+import sys,heapq,pickle,shutil,tempfile
+from contextlib import nullcontext
+from datetime import datetime
+from itertools import chain,groupby
+from operator import itemgetter
+from pathlib import Path
+from common import *
+from output import TableWriter,BATCH_ROWS
+from selection import makeRankOffer,resultColumns,writeResultBatch,DUPLICATES_COLUMNS,writeDuplicatesBatch,NAMES_COLUMNS,writeNamesBatch
+
+# records of a run are pickled in groups, a merge holds one group of every run it reads
+RECORDS_PER_PICKLE = 1024
+# records buffered before the size of a record is estimated
+SAMPLE_RECORDS = 100
+
+def offerSize(record):
+    # rough number of bytes held by a buffered record (key, supplier, part, row, item)
+    key,_,_,_,item = record
+    return (sys.getsizeof(record) + sys.getsizeof(key) + sys.getsizeof(item) + sys.getsizeof(item.sku) + sys.getsizeof(item.orig_availability)
+            + sys.getsizeof(item.values) + sum(map(sys.getsizeof, item.values)) + 4*24)
+
+def readRun(fn):
+    with open(fn,'rb') as f:
+        while True:
+            try:
+                group = pickle.load(f)
+            except EOFError:
+                return
+            yield from group
+
+class OfferSpill:
+    # offers spilled to runs sorted by normalized sku, supplier, file and row, in a temporary directory,
+    # half of the memory limit is used by the buffer, the other half by groups read during the merge
+    def __init__(self, directory, memoryMB):
+        self.dir = Path(tempfile.mkdtemp(prefix='offers_', dir=directory))
+        self.memory = memoryMB * 2**20
+        self.maxRecords = SAMPLE_RECORDS
+        self.fanIn = None
+        self.buffer = []
+        self.runs = []
+        self.written = 0
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def estimate(self):
+        size = sum(map(offerSize, self.buffer)) / len(self.buffer)
+        self.maxRecords = max(16, int(self.memory / 2 // size))
+        self.fanIn = max(2, int(self.memory / 2 // (size * RECORDS_PER_PICKLE)))
+
+    def writeRun(self, records):
+        fn = self.dir / f'run{self.written}'
+        self.written += 1
+        with open(fn,'wb') as f:
+            group = []
+            for r in records:
+                group.append(r)
+                if len(group) == RECORDS_PER_PICKLE:
+                    pickle.dump(group, f, pickle.HIGHEST_PROTOCOL)
+                    group = []
+            if group:
+                pickle.dump(group, f, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(fn)
+
+    def flush(self):
+        if self.buffer:
+            self.buffer.sort()
+            self.writeRun(self.buffer)
+            self.buffer = []
+
+    def add(self, records):
+        # returns the number of records, spills records of one datafeed, nothing of a datafeed failing half way, e.g. with a wrong encoding, stays behind
+        self.flush()
+        first = len(self.runs)
+        n = 0
+        try:
+            buffer = self.buffer
+            for r in records:
+                n += 1
+                buffer.append(r)
+                if len(buffer) >= self.maxRecords:
+                    if self.fanIn is None:
+                        self.estimate()
+                        if len(buffer) < self.maxRecords:
+                            continue
+                    self.flush()
+                    buffer = self.buffer
+            if self.fanIn is None and buffer:
+                self.estimate()
+            self.flush()
+            return n
+        except BaseException:
+            for fn in self.runs[first:]:
+                fn.unlink()
+            del self.runs[first:]
+            self.buffer = []
+            raise
+
+    def merged(self):
+        # all records in sort order, runs are merged fanIn at a time until one pass can read all of them
+        fanIn = self.fanIn or 2
+        while len(self.runs) > fanIn:
+            group = self.runs[:fanIn]
+            del self.runs[:fanIn]
+            self.writeRun(heapq.merge(*(readRun(fn) for fn in group)))
+            for fn in group:
+                fn.unlink()
+        return heapq.merge(*(readRun(fn) for fn in self.runs))
+
+def mergeOffer(merged, item, rule):
+    # offer of a sku kept from files of one supplier, same rule as mergeParts
+    if merged is None or rule != 'cheapest' or (item.tot_cost < merged.tot_cost and item.avail_hi > 0):
+        return item
+    return merged
+
+def skuOffers(records, rules):
+    # one offer per supplier in supplier order, the last row of a file wins, files of a supplier are merged oldest first
+    offers = []
+    s = p = merged = current = None
+    for _,sidx,pidx,_,item in records:
+        if sidx != s:
+            if current is not None:
+                offers.append(mergeOffer(merged, current, rules[s]))
+            s,p,merged = sidx,pidx,None
+        elif pidx != p:
+            merged = mergeOffer(merged, current, rules[s])
+            p = pidx
+        current = item
+    offers.append(mergeOffer(merged, current, rules[s]))
+    return offers
+
+def spillSuppliers(spill, Suppliers, encodings, verbose):
+    # parses every datafeed straight into the spill, returns the output encoding
+    output_encoding = OutputEncoding(verbose)
+    for sidx,(name,supp) in enumerate(Suppliers.items()):
+        for pidx,part in enumerate(supplierParts(supp)):
+            t0 = datetime.utcnow()
+            def collect(titles, rows, quoted, sep):
+                counts = {}
+                offers = spill.add((key,sidx,pidx,seq,item) for seq,(key,item) in enumerate(iterItems(part, rows, titles, counts, quoted)))
+                return titles,sep,counts,offers
+            loaded,encoding = readFeed(part, encodings, verbose, collect)
+            if loaded is None:
+                continue
+            titles,sep,counts,offers = loaded
+            # repeated skus of a file are counted here and dropped by the merge
+            verboseLoadSummary(verbose, part.data, sep, encoding, offers, t0, counts['price'], counts['sku'], counts['out_of_stock'], counts['invalid'], titles, None)
+            output_encoding.add(name, encoding)
+    return output_encoding.value
+
+def selectSpilled(Cfg, Suppliers, verbose):
+    # memory bounded selection: offers are spilled to sorted runs, a k-way merge selects one sku at a time
+    # and streams the result, duplicates and names files, all in normalized sku order
+    t0 = datetime.utcnow()
+    spill = OfferSpill(Cfg['spill_dir'], Cfg['memory_limit_mb'])
+    try:
+        encoding = spillSuppliers(spill, Suppliers, Cfg['encodings'], verbose)
+        verbose(f'offers spilled to {len(spill.runs)} runs in {spill.dir} time {datetime.utcnow()-t0}')
+        t0 = datetime.utcnow()
+        rules = [supp.merge_parts for supp in Suppliers.values()]
+        rankOffer = makeRankOffer(Suppliers.keys(), Cfg['availability_weight'])
+        topK = max(Cfg['top_k'], 1)
+        def selected():
+            for _,records in groupby(spill.merged(), key=itemgetter(0)):
+                offers = skuOffers(records, rules)
+                if len(offers) == 1:
+                    yield offers[0],(),offers
+                else:
+                    ranked = sorted(offers, key=rankOffer, reverse=True)[:topK]
+                    yield ranked[0],ranked[1:],offers
+        skus = selected()
+        first = next(skus, None)
+        format = Cfg['output_format']
+        if format == 'binary':
+            # binary columns are kept in memory until the file is complete
+            verbose('binary output format does not bound memory, writing csv in memory limited mode')
+            format = 'csv'
+        duplicatesFn,namesFn = Cfg[fDuplicatesFilename],Cfg[fAllNamesFilename]
+        selCnt = dupCnt = 0
+        with TableWriter(Path(Cfg[fOutputFilename]), resultColumns(first[0].layout if first else ()), encoding, format) as outf, \
+             (TableWriter(duplicatesFn, DUPLICATES_COLUMNS, encoding, format) if duplicatesFn is not None else nullcontext()) as dupf, \
+             (TableWriter(namesFn, NAMES_COLUMNS, encoding, format) if namesFn is not None else nullcontext()) as namesf:
+            results,duplicates,names = [],[],[]
+            def flush():
+                nonlocal selCnt,dupCnt
+                selCnt += len(results)
+                dupCnt += len(duplicates)
+                writeResultBatch(outf, results)
+                if dupf is not None and duplicates:
+                    writeDuplicatesBatch(dupf, duplicates)
+                if namesf is not None:
+                    writeNamesBatch(namesf, names)
+                results.clear()
+                duplicates.clear()
+                names.clear()
+            for selItem,others,offers in chain([first] if first else [], skus):
+                results.append(selItem)
+                duplicates.extend((item,selItem) for item in others)
+                names.extend(offers)
+                if len(results) >= BATCH_ROWS:
+                    flush()
+            flush()
+        verbose(f'selected {selCnt} items, {dupCnt} duplicates from the merge time {datetime.utcnow()-t0}')
+    finally:
+        spill.close()